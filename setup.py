@@ -408,6 +408,7 @@ else:  # =================================================================
             ],
             'console_scripts': [
                 'mtunnel=mullvad.tunnelprocess:main',
+                'mullvad-daemon=mullvad.daemon:main',
             ],
         },
         **common_args
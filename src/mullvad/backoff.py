@@ -0,0 +1,84 @@
+#!/usr/bin/env python2
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import random
+
+from mullvad import util
+
+"""Decide when to try connecting again after a failed attempt."""
+
+
+class RetryPolicy(object):
+    """Exponential backoff with decorrelated jitter.
+
+    Each delay is drawn at random between base and three times the previous
+    delay, and capped. Clients that fail at the same moment, e.g. after a
+    network outage, soon try again at different times instead of all at
+    once. A policy with base equal to cap waits the same time every time.
+
+    The tunnel only uses configure(), failed(), succeeded(),
+    network_changed() and time_to_next_attempt(), anything implementing
+    those can replace it.
+    """
+    def __init__(self, base=1, cap=60, clock=util.monotonic):
+        """
+        Args:
+            base: Seconds to wait after the first failure, at least.
+            cap: Seconds to wait at most.
+            clock: Returns the current time in seconds.
+        """
+        self.base = base
+        self.cap = max(base, cap)
+        self.defaults = (self.base, self.cap)  # For malformed settings
+        self.clock = clock
+        self.failures = 0  # In a row
+        self.delay = None  # Current delay, None when not waiting
+        self.next_attempt = None  # By clock, None when not waiting
+
+    def configure(self, settings):
+        """Take base and cap from the reconnect_delay_min and
+        reconnect_delay_max settings, or the ones given at construction if
+        either is malformed."""
+        try:
+            base = settings.getint('reconnect_delay_min')
+            cap = max(base, settings.getint('reconnect_delay_max'))
+        except ValueError:
+            base, cap = self.defaults
+        self.base = base
+        self.cap = cap
+
+    def failed(self):
+        """Record a failed attempt.
+
+        Returns:
+            The seconds to wait before the next attempt.
+        """
+        self.failures += 1
+        previous = self.base if self.delay is None else self.delay
+        self.delay = min(self.cap, random.uniform(self.base, previous * 3))
+        self.next_attempt = self.clock() + self.delay
+        return self.delay
+
+    def succeeded(self):
+        """Record a successful attempt, starting over from base."""
+        self.failures = 0
+        self.delay = None
+        self.next_attempt = None
+
+    def network_changed(self):
+        """The network the earlier attempts failed on is gone, so try again
+        at once, and back off from base if that fails too."""
+        self.delay = None
+        if self.next_attempt is not None:
+            self.next_attempt = self.clock()
+
+    def time_to_next_attempt(self):
+        """Return the seconds until the next attempt is due, 0 if it is due,
+        None if no attempt has failed."""
+        if self.next_attempt is None:
+            return None
+        return max(0.0, self.next_attempt - self.clock())
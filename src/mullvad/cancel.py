@@ -0,0 +1,131 @@
+#!/usr/bin/env python2
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import contextlib
+import errno
+import os
+import platform
+import select
+import socket
+import threading
+
+from mullvad import logger
+from mullvad import util
+
+"""Abort a blocking operation from another thread."""
+
+# Where select() can not wait for the token, how often it is checked
+_POLL_INTERVAL = 0.05
+
+
+class Cancelled(Exception):
+    """Raised by an operation stopped through its CancelToken."""
+    def __init__(self, message='Cancelled'):
+        Exception.__init__(self, message)
+
+
+class CancelToken(object):
+    """Tells an operation, and everything it is blocked on, to stop.
+
+    cancel() may be called from any thread. It runs the callbacks the
+    operation has registered, e.g. killing the child process it waits for,
+    and from then on check() raises Cancelled. Sockets are waited for with
+    wait_for_socket(), which returns as soon as the token is cancelled.
+
+    A token is used for one operation, and closed when that is over.
+    """
+    def __init__(self):
+        self.log = logger.create_logger(self.__class__.__name__)
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.callbacks = []
+        self.read_fd = None
+        self.write_fd = None
+        if platform.system() != 'Windows':
+            # Readable once cancelled, for select()
+            self.read_fd, self.write_fd = os.pipe()
+
+    def cancel(self):
+        with self.lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks = list(self.callbacks)
+            if self.write_fd is not None:
+                os.write(self.write_fd, b'.')
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                self.log.debug('Cancel callback failed: %s', e)
+
+    def check(self):
+        """Raise Cancelled if the token has been cancelled."""
+        if self.cancelled:
+            raise Cancelled()
+
+    def add_callback(self, callback):
+        """Call callback when cancelled, at once if already cancelled."""
+        with self.lock:
+            if not self.cancelled:
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+    def wait_for_socket(self, sock, timeout, write=False):
+        """Wait until sock is readable, or writable if write is set.
+
+        Raises:
+            Cancelled: If the token is cancelled first.
+            socket.timeout: If timeout seconds pass first.
+        """
+        end = util.monotonic() + timeout
+        cancel_fds = [self.read_fd] if self.read_fd is not None else []
+        while True:
+            self.check()
+            remaining = end - util.monotonic()
+            if remaining <= 0:
+                raise socket.timeout('timed out')
+            if not cancel_fds:
+                remaining = min(remaining, _POLL_INTERVAL)
+            try:
+                readable, writable, __ = select.select(
+                    cancel_fds + ([] if write else [sock]),
+                    [sock] if write else [], [], remaining)
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+            if sock in readable or sock in writable:
+                return
+
+    def close(self):
+        with self.lock:
+            self.callbacks = []
+            for fd in (self.read_fd, self.write_fd):
+                if fd is not None:
+                    os.close(fd)
+            self.read_fd = self.write_fd = None
+
+
+@contextlib.contextmanager
+def registered(token, callback):
+    """Add callback to token for the duration of the block. A token of None
+    is allowed and ignored."""
+    if token is None:
+        yield
+        return
+    token.add_callback(callback)
+    try:
+        yield
+    finally:
+        token.remove_callback(callback)
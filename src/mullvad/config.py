@@ -43,6 +43,16 @@ _DEFAULT_SETTINGS = {
     'send_recv_buffers': 'auto',
     'autoconnect_on_start': 'True',
     'custom_ovpn_args': '',
+    'remember_network_transport': 'True',
+    'throughput_updates_per_second': '1',
+    'key_algorithm': 'rsa',
+    'fast_reconnect_window': '300',
+    'metrics_port': '0',
+    'trace_requests': 'False',
+    'hot_standby': 'False',
+    'reconnect_delay_min': '1',
+    'reconnect_delay_max': '60',
+    'command_executor': 'False',
 }
 
 # Increase socket buffer sizes on Windows 7 and earlier.
@@ -110,6 +120,10 @@ class ReadOnlySettings(object):
     def getint(self, option):
         return self.parser.getint(_SETTINGS_SECTION, option)
 
+    def override(self, option, value):
+        """Change an option in this copy only, nothing is written."""
+        self.parser.set(_SETTINGS_SECTION, option, str(value))
+
     def __str__(self):
         return ReadOnlySettings._parser_to_str(self.parser)
 
@@ -0,0 +1,334 @@
+#!/usr/bin/env python2
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import json
+import os
+import Queue
+import signal
+import SocketServer
+import socket
+import sys
+import threading
+import time
+
+from mullvad import config
+from mullvad import exceptioncatcher
+from mullvad import logger
+from mullvad import mtunnel
+from mullvad import netstring
+from mullvad import proc
+from mullvad import tunnelprocess
+from mullvad import util
+
+"""Run the tunnel without a GUI, controlled through a Unix domain socket.
+
+Clients write netstring framed JSON requests,
+
+    {"id": 1, "method": "connect", "args": []}
+
+and get replies with the same id, holding either a result or an error:
+
+    {"id": 1, "result": null}
+    {"id": 1, "error": "Unknown method: foo"}
+
+After calling subscribe, a client also gets event messages,
+
+    {"event": "connection", "data": "connected"}
+
+for the events connection, server, error, throughput and timing. Replies and
+events are written in the order they happen, any number of clients can be
+connected at once.
+"""
+
+DEFAULT_SOCKET_PATH = '/var/run/mullvad/control.sock'
+EVENTS = ('connection', 'server', 'error', 'throughput', 'timing')
+
+_CLIENT_QUEUE_SIZE = 1000  # Messages waiting for a slow client
+_CLOSE_TIMEOUT = 1  # Seconds to let a client get its last messages
+
+
+class ControlError(Exception):
+    pass
+
+
+class AlreadyRunningError(Exception):
+    pass
+
+
+class TunnelDaemon(object):
+    """Owns the Tunnel and serves the control API on a Unix socket."""
+    def __init__(self, tunnel, socket_path):
+        self.log = logger.create_logger(self.__class__.__name__)
+        self.tunnel = tunnel
+        self.socket_path = socket_path
+        self.call_lock = threading.Lock()  # Tunnel calls one at a time
+        self.clients_lock = threading.Lock()
+        self.clients = set()
+        self.stopped = threading.Event()
+        self.methods = {
+            'connect': self.connect,
+            'disconnect': self.disconnect,
+            'status': self.status,
+            'metrics': self.metrics,
+            'shutdown': self.shutdown,
+        }
+        tunnel.add_connection_listener(
+            lambda state: self.publish(
+                'connection', mtunnel.ConState.names.get(state)))
+        tunnel.add_server_listener(
+            lambda server: self.publish('server', _server_dict(server)))
+        tunnel.add_error_listener(
+            lambda error: self.publish('error', {
+                'type': error.__class__.__name__,
+                'message': unicode(str(error), errors='replace')}))
+        tunnel.add_throughput_listener(
+            lambda stats: self.publish('throughput', stats))
+        tunnel.add_timing_listener(
+            lambda record: self.publish('timing', record))
+
+        if os.path.exists(socket_path):
+            if is_running(socket_path):
+                raise AlreadyRunningError(
+                    'A daemon is already listening on ' + socket_path)
+            os.remove(socket_path)  # Left behind by a crash
+        daemon = self
+
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                daemon._serve_client(self.connection, self.rfile)
+
+        # Created as srw-rw----, never accessible to others, even briefly
+        old_umask = os.umask(0o117)
+        try:
+            self.server = SocketServer.ThreadingUnixStreamServer(socket_path,
+                                                                 Handler)
+        finally:
+            os.umask(old_umask)
+        self.server.daemon_threads = True
+
+    def serve(self):
+        """Serve clients until shutdown() is called."""
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.log.info('Listening on %s', self.socket_path)
+        try:
+            while not self.stopped.wait(1):
+                pass
+        except KeyboardInterrupt:
+            self.shutdown()
+        self.server.shutdown()
+        self.server.server_close()
+        os.remove(self.socket_path)
+        with self.clients_lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.close()
+        # The handlers remove their clients once the connections are closed
+        util.poll(lambda: self.clients, 0.05, _CLOSE_TIMEOUT)
+        self.tunnel.destroy()
+
+    def connect(self):
+        self.tunnel.connect()
+
+    def disconnect(self):
+        self.tunnel.disconnect()
+
+    def metrics(self):
+        return self.tunnel.metrics()
+
+    def shutdown(self):
+        self.log.info('Shutting down')
+        self.tunnel.shutDown()
+        self.stopped.set()
+
+    def status(self):
+        expiry = self.tunnel.subscription_expiry
+        return {
+            'state': mtunnel.ConState.names.get(
+                self.tunnel.connectionState()),
+            'desired_state': mtunnel.ConState.names.get(
+                self.tunnel.desiredConnectionState()),
+            'server': _server_dict(self.tunnel.serverInfo()),
+            'time_left': (int(expiry - time.time())
+                          if expiry is not None else None),
+            'traffic': self.tunnel.traffic.stats(),
+        }
+
+    def publish(self, event, data):
+        with self.clients_lock:
+            clients = list(self.clients)
+        for client in clients:
+            if event in client.events:
+                client.send({'event': event, 'data': data})
+
+    def _serve_client(self, sock, rfile):
+        client = _Client(sock)
+        with self.clients_lock:
+            self.clients.add(client)
+        try:
+            while True:
+                try:
+                    request = json.loads(netstring.read_string(rfile))
+                except IOError:
+                    break  # Closed by the client
+                except ValueError as e:
+                    client.send({'id': None, 'error': 'Invalid JSON: {}'
+                                 .format(e)})
+                    continue
+                client.send(self._handle(client, request))
+        finally:
+            with self.clients_lock:
+                self.clients.discard(client)
+            client.close()
+
+    def _handle(self, client, request):
+        request_id = request.get('id') if isinstance(request, dict) \
+            else None
+        try:
+            if not isinstance(request, dict):
+                raise ControlError('Request must be an object')
+            name = request.get('method')
+            args = request.get('args', [])
+            if not isinstance(args, list):
+                raise ControlError('args must be a list')
+            if name == 'subscribe':
+                result = client.subscribe(*args)
+            elif name == 'unsubscribe':
+                result = client.unsubscribe(*args)
+            elif name in self.methods:
+                with self.call_lock:
+                    result = self.methods[name](*args)
+            else:
+                raise ControlError('Unknown method: {}'.format(name))
+        except (ControlError, TypeError) as e:
+            return {'id': request_id, 'error': unicode(e)}
+        except Exception as e:
+            self.log.error('%s failed: %s', request.get('method'), e)
+            return {'id': request_id, 'error': unicode(e)}
+        return {'id': request_id, 'result': result}
+
+
+class _Client(object):
+    """A connected client and the messages waiting to be written to it.
+
+    Messages are written by a thread of its own, so a slow client never
+    holds up the tunnel threads publishing events. A client that falls too
+    far behind is disconnected.
+    """
+    def __init__(self, sock):
+        self.log = logger.create_logger(self.__class__.__name__)
+        self.sock = sock
+        self.events = set()
+        self.queue = Queue.Queue(_CLIENT_QUEUE_SIZE)
+        self.writer = threading.Thread(target=self._write)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def subscribe(self, events=None):
+        events = EVENTS if events is None else events
+        unknown = set(events) - set(EVENTS)
+        if unknown:
+            raise ControlError('Unknown events: {}'.format(
+                ', '.join(sorted(unknown))))
+        self.events.update(events)
+        return sorted(self.events)
+
+    def unsubscribe(self, events=None):
+        self.events.difference_update(EVENTS if events is None else events)
+        return sorted(self.events)
+
+    def send(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except Queue.Full:
+            self.log.warning('Client too slow, disconnecting it')
+            self.close()
+
+    def close(self):
+        """Close the connection once the queued messages are written."""
+        self.events = set()
+        try:
+            self.queue.put_nowait(None)
+        except Queue.Full:
+            self._shutdown()
+
+    def _shutdown(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def _write(self):
+        wfile = self.sock.makefile('wb')
+        try:
+            for message in iter(self.queue.get, None):
+                netstring.write_string(json.dumps(message), wfile)
+                wfile.flush()
+        except socket.error:
+            pass
+        finally:
+            wfile.close()
+            self._shutdown()
+
+
+def _server_dict(server):
+    if server is None:
+        return None
+    return dict(name=server.name, address=server.address,
+                protocol=server.protocol, port=server.port,
+                location=server.location)
+
+
+def is_running(socket_path):
+    """Return True if a daemon is listening on socket_path."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run the Mullvad tunnel without a GUI.')
+    parser.add_argument('--logdir', dest='logdir', help='Write logs here')
+    parser.add_argument('--confdir', dest='confdir', help='Use this conf dir')
+    parser.add_argument('--socket', dest='socket',
+                        default=DEFAULT_SOCKET_PATH,
+                        help='Control socket path (default: %(default)s)')
+    args = parser.parse_args()
+
+    logger.init(args.logdir)
+    log = logger.create_logger('mullvad_daemon')
+    exceptioncatcher.activate(log)
+
+    # Before the tunnel is created, which kills the OpenVPN of the other
+    if is_running(args.socket):
+        log.error('Another daemon is listening on %s', args.socket)
+        sys.exit(1)
+    socket_dir = os.path.dirname(args.socket)
+    if socket_dir and not os.path.isdir(socket_dir):
+        os.makedirs(socket_dir)
+    tunnelprocess.setup_file_paths()
+    settings = config.Settings(directory=args.confdir)
+    if settings.getboolean('command_executor'):
+        proc.use_executor()
+    tunnel = mtunnel.Tunnel(settings, args.confdir)
+    daemon = TunnelDaemon(tunnel, args.socket)
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.shutdown())
+    if settings.getboolean('autoconnect_on_start'):
+        tunnel.connect()
+    daemon.serve()
+    sys.exit(0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python2
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+
+from mullvad import logger
+from mullvad import netstring
+
+if platform.system() != 'Windows':
+    import fcntl
+
+"""Run commands in long-lived helper processes.
+
+Forking the tunnel process, which is large and runs many threads, for
+every route and firewall command is slow. The helpers are small and
+single threaded, and start the commands instead.
+
+Requests and replies are JSON in netstrings, over the stdin and stdout of
+the helper. A request is a list of commands, each a dict with 'args' and
+'stdin'. A reply is written for each command as soon as it has finished,
+with 'code', 'stdout' and 'stderr', or with 'error' and 'errno' if it
+could not be started. Byte strings are sent as latin-1, which any byte
+sequence decodes from.
+"""
+
+
+_MAX_IDLE = 4  # Helpers kept for later batches
+
+# Held by proc.open while starting a process, so that no process started on
+# another thread inherits the pipes of a helper before they are made
+# close-on-exec.
+spawn_lock = threading.Lock()
+
+
+class ExecutorError(Exception):
+    """A helper is not running, or stopped answering."""
+    def __init__(self, message, sent):
+        """
+        Args:
+            sent: Whether the batch reached the helper, in which case its
+                  commands may or may not have run.
+        """
+        Exception.__init__(self, message)
+        self.sent = sent
+
+
+class Executor(object):
+    """Client of the helper processes, started on first use.
+
+    Each batch gets a helper of its own, so commands from several threads
+    still run at the same time. Helpers are kept between batches. Once a
+    helper has failed, every call raises ExecutorError.
+    """
+    def __init__(self):
+        self.log = logger.create_logger(self.__class__.__name__)
+        self.lock = threading.Lock()  # Guards idle and failed
+        self.idle = []  # Helper processes not running a batch
+        self.failed = False
+
+    def run(self, args, stdin=None):
+        """Run one command.
+
+        Args:
+            args: The list of args, byte strings as for subprocess.Popen.
+            stdin: A byte string passed to stdin of the command.
+
+        Returns:
+            A tuple of the exit code, stdout and stderr, as byte strings.
+
+        Raises:
+            OSError: If the command could not be started.
+            ExecutorError: If the helper failed. The command may have run
+                           if its sent attribute is True.
+        """
+        result = self.run_batch([(args, stdin)])[0]
+        if isinstance(result, OSError):
+            raise result
+        return result
+
+    def run_batch(self, commands):
+        """Run commands in order.
+
+        Args:
+            commands: A list of (args, stdin) tuples, as for run().
+
+        Returns:
+            A list with a tuple of the exit code, stdout and stderr for each
+            command, or an OSError for those that could not be started.
+
+        Raises:
+            ExecutorError: If the helper failed.
+        """
+        request = json.dumps([{'args': [_to_json(arg) for arg in args],
+                               'stdin': _to_json(stdin)}
+                              for args, stdin in commands])
+        with self.lock:
+            if self.failed:
+                raise ExecutorError('A helper has failed before', False)
+            process = self.idle.pop() if self.idle else None
+        sent = False
+        try:
+            if process is None:
+                process = self._start()
+            netstring.write_string(request, process.stdin)
+            process.stdin.flush()
+            sent = True
+            replies = [json.loads(netstring.read_string(process.stdout))
+                       for __ in commands]
+        except (IOError, OSError, ValueError) as e:
+            self._fail(process, e)
+            raise ExecutorError('The helper failed: {}'.format(e), sent)
+        with self.lock:
+            if not self.failed and len(self.idle) < _MAX_IDLE:
+                self.idle.append(process)
+                process = None
+        if process is not None:
+            _stop(process)
+        return [_from_reply(reply) for reply in replies]
+
+    def close(self):
+        """Stop the idle helpers."""
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for process in idle:
+            _stop(process)
+
+    def _start(self):
+        package_parent = os.path.dirname(
+            os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ)
+        env[b'PYTHONPATH'] = os.pathsep.join(
+            [package_parent] + filter(None, [env.get(b'PYTHONPATH')]))
+        with spawn_lock:
+            process = subprocess.Popen(
+                [sys.executable, '-m', 'mullvad.executor'],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                close_fds=True, env=env)
+            # Not inherited by OpenVPN, the helper would outlive us otherwise
+            for pipe in (process.stdin, process.stdout):
+                flags = fcntl.fcntl(pipe.fileno(), fcntl.F_GETFD)
+                fcntl.fcntl(pipe.fileno(), fcntl.F_SETFD,
+                            flags | fcntl.FD_CLOEXEC)
+        self.log.debug('Started helper, pid %s', process.pid)
+        return process
+
+    def _fail(self, process, error):
+        self.log.error('Command helper failed: %s', error)
+        with self.lock:
+            self.failed = True
+            idle, self.idle = self.idle, []
+        if process is not None and process.poll() is None:
+            process.kill()
+        for p in filter(None, [process]) + idle:
+            _stop(p)
+
+
+def _stop(process):
+    """Stop a helper, which exits when its stdin is closed."""
+    try:
+        process.stdin.close()
+    except IOError:
+        pass  # Could not flush to a dead helper
+    process.wait()
+    process.stdout.close()
+
+
+def _to_json(data):
+    return data.decode('latin-1') if data is not None else None
+
+
+def _from_json(data):
+    return data.encode('latin-1') if data is not None else None
+
+
+def _from_reply(reply):
+    if 'error' in reply:
+        return OSError(reply['errno'], reply['error'])
+    return (reply['code'], _from_json(reply['stdout']),
+            _from_json(reply['stderr']))
+
+
+def _execute(command):
+    try:
+        process = subprocess.Popen(
+            [_from_json(arg) for arg in command['args']],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, close_fds=True)
+    except OSError as e:
+        return {'error': e.strerror, 'errno': e.errno}
+    out, err = process.communicate(_from_json(command['stdin']))
+    return {'code': process.returncode, 'stdout': _to_json(out),
+            'stderr': _to_json(err)}
+
+
+def serve(requests, replies):
+    """Run the commands read from requests until it is closed, and write
+    the replies to replies."""
+    while True:
+        try:
+            message = netstring.read_string(requests)
+        except IOError:
+            return  # Closed by the tunnel
+        for command in json.loads(message):
+            netstring.write_string(json.dumps(_execute(command)), replies)
+            replies.flush()
+
+
+if __name__ == '__main__':
+    serve(sys.stdin, sys.stdout)
@@ -21,13 +21,19 @@ from mullvad import util
 _PRIVATE_NETS = ['10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16']
 
 
-def get_firewall():
+def get_firewall(chain=None):
+    """Return the firewall of this platform.
+
+    Args:
+        chain: Name of the iptables chain to keep the rules in, on Linux.
+               Several tunnels on one host need one chain each.
+    """
     if platform.system() == 'Windows':
         return WindowsFirewall()
     elif platform.system() == 'Darwin':
         return OSXFirewall()
     elif platform.system() == 'Linux':
-        return LinuxFirewall()
+        return LinuxFirewall(chain or LinuxFirewall.CHAIN_NAME)
     else:
         raise OSError('No firewall implementation for ' + platform.system())
 
@@ -49,12 +55,19 @@ class FirewallError(Exception):
 
 
 class Firewall(object):
+    # If traffic to a second server can be allowed with set_standby_ip()
+    supports_standby = True
+
     def __init__(self):
         pass
 
     def set_allowed_ip(self, ip):
         pass
 
+    def set_standby_ip(self, ip):
+        """Allow traffic to the server of a standby tunnel as well."""
+        pass
+
     def block_local_network(self):
         pass
 
@@ -163,6 +176,9 @@ class OSXFirewall(Firewall):
             self.pfconf.insert_mullvad_anchor()
         self.pfctl.flush_pf_conf()
 
+    # pf only has room for one allowed address
+    supports_standby = False
+
     def set_allowed_ip(self, ip):
         self.pfctl.set_allowed_ip(ip)
 
@@ -188,7 +204,7 @@ class OSXFirewall(Firewall):
 
 
 class LinuxFirewall(Firewall):
-    _CHAIN_NAME = 'MULLVAD'
+    CHAIN_NAME = 'MULLVAD'
     iptables = ['iptables']
     ip6tables = ['ip6tables']
 
@@ -199,17 +215,22 @@ class LinuxFirewall(Firewall):
     _IPV6_MAC_IF_PATH = '/proc/net/if_inet6'
     _IPV6_DISABLE_PATH = '/proc/sys/net/ipv6/conf/all/disable_ipv6'
 
-    _BLOCK_TRAFFIC_RULE = [_CHAIN_NAME, '-j', 'REJECT']
-    _BLOCK_INCOMING_UDP_RULE = [_CHAIN_NAME, '-p', 'udp', '-j', 'DROP']
-
-    def __init__(self):
+    def __init__(self, chain=CHAIN_NAME):
         self.log = logger.create_logger(self.__class__.__name__)
+        self.chain = chain
+        # Any other chain belongs to an isolated tunnel. It is jumped to
+        # from INPUT, FORWARD and OUTPUT like the default one, so it must
+        # not block IPv6, which would block it for every program.
+        self.isolated = chain != LinuxFirewall.CHAIN_NAME
+        self.block_traffic_rule = [chain, '-j', 'REJECT']
+        self.block_incoming_udp_rule = [chain, '-p', 'udp', '-j', 'DROP']
         self.has_ipv6 = self._has_ipv6()
         # Give the instance its own copies of the class variables to avoid
         # modifying the shared instance when adding the wait flag
         self.iptables = list(self.iptables)
         self.ip6tables = list(self.ip6tables)
         self.allowed_ip = None
+        self.standby_ip = None
         self.block_traffic_state = False
         self.block_ipv6_state = False
         try:
@@ -227,7 +248,7 @@ class LinuxFirewall(Firewall):
             proc.run(self.ip6tables)
 
     def _setup_chain(self):
-        chain = LinuxFirewall._CHAIN_NAME
+        chain = self.chain
         cmds = [self.iptables]
         if self.has_ipv6:
             cmds.append(self.ip6tables)
@@ -254,47 +275,62 @@ class LinuxFirewall(Firewall):
     def set_allowed_ip(self, ip):
         old = self.allowed_ip
         self.allowed_ip = ip
+        self._replace_accept_rules(old, ip, self.standby_ip)
+
+    def set_standby_ip(self, ip):
+        old = self.standby_ip
+        self.standby_ip = ip
+        self._replace_accept_rules(old, ip, self.allowed_ip)
+
+    def _replace_accept_rules(self, old, ip, other):
+        """Replace the rules accepting traffic to and from old with rules
+        for ip. The rules for other, the other accepted address, are left
+        alone, so promoting the standby server never drops its traffic."""
         if old == ip:
             return
 
-        rule = '{} MULLVAD {} {} -j ACCEPT'
+        rule = '{} {} {} {} -j ACCEPT'
         for direction in ['-s', '-d']:
-            if old is not None:
+            if old is not None and old != other:
                 self._run_iptables_until_fail(
-                    rule.format('-D', direction, old).split(),
+                    rule.format('-D', self.chain, direction, old).split(),
+                    skip_ipv6=True)
+            if ip is not None and ip != other:
+                self._run_iptables(
+                    rule.format('-I', self.chain, direction, ip).split(),
                     skip_ipv6=True)
-            if ip is not None:
-                self._run_iptables(rule.format('-I', direction, ip).split(),
-                                   skip_ipv6=True)
 
     def block_local_network(self):
         self.block_traffic_state = True
-        self._run_iptables(['-A'] + LinuxFirewall._BLOCK_TRAFFIC_RULE)
+        self._run_iptables(['-A'] + self.block_traffic_rule)
 
     def unblock_local_network(self):
         self.block_traffic_state = False
         self._run_iptables_until_fail(
-            ['-D'] + LinuxFirewall._BLOCK_TRAFFIC_RULE,
+            ['-D'] + self.block_traffic_rule,
             skip_ipv6=self.block_ipv6_state)
 
     def block_incoming_udp(self):
-        self._run_iptables(['-A'] + LinuxFirewall._BLOCK_INCOMING_UDP_RULE)
+        self._run_iptables(['-A'] + self.block_incoming_udp_rule)
 
     def unblock_incoming_udp(self):
         self._run_iptables_until_fail(
-            ['-D'] + LinuxFirewall._BLOCK_INCOMING_UDP_RULE)
+            ['-D'] + self.block_incoming_udp_rule)
 
     def block_ipv6(self):
+        if self.isolated:
+            self.log.debug('Not blocking IPv6 from chain %s', self.chain)
+            return
         self.block_ipv6_state = True
         if self.has_ipv6:
             proc.run_assert_ok(self.ip6tables + ['-A'] +
-                               LinuxFirewall._BLOCK_TRAFFIC_RULE)
+                               self.block_traffic_rule)
 
     def unblock_ipv6(self):
         self.block_ipv6_state = False
         if self.has_ipv6 and not self.block_traffic_state:
             while proc.run_get_exit(self.ip6tables + ['-D'] +
-                                    LinuxFirewall._BLOCK_TRAFFIC_RULE) == 0:
+                                    self.block_traffic_rule) == 0:
                 pass
 
     def _run_iptables(self, args, skip_ipv6=False):
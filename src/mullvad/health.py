@@ -0,0 +1,228 @@
+#!/usr/bin/env python2
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import collections
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+from mullvad import logger
+from mullvad import util
+
+"""Measure round trip time, jitter and loss to the first hop of the
+tunnel."""
+
+_PROBE_DEST = '193.0.14.129'  # Never reached, the first hop answers
+_PROBE_PORT_BASE = 65400  # Destination ports identify the probes
+_PROBE_PORTS = 100
+_PROBE_MAGIC = b'mullvad-probe'
+_ICMP_TIME_EXCEEDED = 11
+_TRAIN_LENGTH = 3
+_TRAIN_SPACING = 0.02
+_REPLY_TIMEOUT = 1.0
+
+_HISTORY = 60  # Probes kept for the statistics
+_DEGRADED_WINDOW = 9  # Latest probes judged by degraded()
+_DEGRADED_LOSS = 0.5
+
+MIN_INTERVAL = 5
+MAX_INTERVAL = 30
+
+
+class ProbeStats(object):
+    """Ring buffer of probe results, and the probe interval they call for.
+
+    The interval is MIN_INTERVAL after a train that lost probes, and
+    doubles after every train without loss, up to MAX_INTERVAL.
+    """
+    def __init__(self, size=_HISTORY):
+        self.lock = threading.Lock()
+        self.samples = collections.deque(maxlen=size)  # RTT, None if lost
+        self.hop = None  # Address that answered the latest probe
+        self.answered = False  # Whether the hop has ever answered
+        self.interval = MIN_INTERVAL
+
+    def add_train(self, rtts, hop):
+        """Record a train of probes.
+
+        Args:
+            rtts: Round trip time of each probe in seconds, None if lost.
+            hop: Address that answered, None if none did.
+        """
+        with self.lock:
+            self.samples.extend(rtts)
+            if hop is not None:
+                self.hop = hop
+                self.answered = True
+            if None in rtts:
+                self.interval = MIN_INTERVAL
+            else:
+                self.interval = min(self.interval * 2, MAX_INTERVAL)
+
+    def degraded(self):
+        """Whether too many of the latest probes were lost. A hop that has
+        never answered probably filters them, and is not judged."""
+        with self.lock:
+            latest = list(self.samples)[-_DEGRADED_WINDOW:]
+            if not self.answered or len(latest) < _DEGRADED_WINDOW:
+                return False
+        return latest.count(None) / len(latest) >= _DEGRADED_LOSS
+
+    def stats(self):
+        """Return a dict with the number of probes in the buffer, the
+        fraction lost, the min, mean and max RTT, the jitter as the mean
+        difference between consecutive RTTs, the hop and the interval."""
+        with self.lock:
+            samples = list(self.samples)
+            hop = self.hop
+            interval = self.interval
+        rtts = [rtt for rtt in samples if rtt is not None]
+        stats = {
+            'probes': len(samples),
+            'loss': (round(1 - len(rtts) / len(samples), 4)
+                     if samples else None),
+            'rtt_min': None,
+            'rtt_mean': None,
+            'rtt_max': None,
+            'jitter': None,
+            'hop': hop,
+            'interval': interval,
+        }
+        if rtts:
+            stats['rtt_min'] = round(min(rtts), 6)
+            stats['rtt_mean'] = round(sum(rtts) / len(rtts), 6)
+            stats['rtt_max'] = round(max(rtts), 6)
+        if len(rtts) > 1:
+            stats['jitter'] = round(
+                sum(abs(b - a) for a, b in zip(rtts, rtts[1:])) /
+                (len(rtts) - 1), 6)
+        return stats
+
+
+class HealthProber(object):
+    """Sends trains of probes to the first hop of the tunnel.
+
+    A probe is a small UDP packet with a TTL of 1. The first router, which
+    is the VPN server when traffic goes through the tunnel, answers with an
+    ICMP time exceeded message, read from a raw socket. Both sockets are
+    opened once and reused for every train. Opening the raw socket needs
+    root, socket.error is raised otherwise.
+    """
+    def __init__(self, source=None):
+        """
+        Args:
+            source: Address to send the probes from, for tunnels only
+                    routed for their own address.
+        """
+        self.log = logger.create_logger(self.__class__.__name__)
+        self.stats = ProbeStats()
+        self.token = os.urandom(4)  # Tells our probes from other tunnels'
+        self.seq = 0
+        self.icmp = socket.socket(socket.AF_INET, socket.SOCK_RAW,
+                                  socket.IPPROTO_ICMP)
+        try:
+            # Windows only delivers replies to a bound raw socket. Bound to
+            # the source, it only gets the replies to our probes elsewhere.
+            self.icmp.bind((source or '', 0))
+            self.icmp.setblocking(False)
+            self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                                     socket.IPPROTO_UDP)
+            self.udp.setsockopt(socket.SOL_IP, socket.IP_TTL, 1)
+            if source is not None:
+                self.udp.bind((source, 0))
+        except socket.error:
+            self.icmp.close()
+            raise
+
+    def probe(self):
+        """Send a train of probes and wait for the answers.
+
+        Returns:
+            The address of the first hop, '*' if no probe was answered.
+        """
+        self._drain()
+        sent = collections.OrderedDict()  # port -> (payload, time sent)
+        for i in range(_TRAIN_LENGTH):
+            if i > 0:
+                time.sleep(_TRAIN_SPACING)
+            port = _PROBE_PORT_BASE + self.seq % _PROBE_PORTS
+            payload = _PROBE_MAGIC + self.token + struct.pack(b'!I',
+                                                              self.seq)
+            self.seq += 1
+            sent[port] = (payload, util.monotonic())
+            try:
+                self.udp.sendto(payload, (_PROBE_DEST, port))
+            except socket.error as e:
+                self.log.debug('Sending probe failed: %s', e)
+
+        rtts = {}
+        hop = None
+        end = util.monotonic() + _REPLY_TIMEOUT
+        while len(rtts) < len(sent):
+            remaining = end - util.monotonic()
+            if remaining <= 0:
+                break
+            readable, __, __ = select.select([self.icmp], [], [], remaining)
+            if not readable:
+                break
+            try:
+                data, addr = self.icmp.recvfrom(1024)
+            except socket.error:
+                continue
+            received = util.monotonic()
+            port = parse_reply(data, sent)
+            if port is not None and port not in rtts:
+                rtts[port] = received - sent[port][1]
+                hop = addr[0]
+        self.stats.add_train([rtts.get(p) for p in sent], hop)
+        return hop if hop is not None else '*'
+
+    def close(self):
+        self.udp.close()
+        self.icmp.close()
+
+    def _drain(self):
+        """Throw away the ICMP messages received since the last train."""
+        while True:
+            try:
+                self.icmp.recv(1024)
+            except socket.error:
+                return
+
+
+def parse_reply(data, sent):
+    """Return the destination port of the probe an ICMP message answers,
+    None if it answers none of them.
+
+    Args:
+        data: The IP packet read from the raw socket.
+        sent: A dict from destination port to the payload and send time
+              of each probe.
+    """
+    def payload(packet):
+        return packet[(ord(packet[0]) & 0xF) * 4:]
+
+    try:
+        icmp = payload(data)
+        if ord(icmp[0]) != _ICMP_TIME_EXCEEDED:
+            return None
+        original = icmp[8:]  # The start of the probe, with its IP header
+        if original[16:20] != socket.inet_aton(_PROBE_DEST):
+            return None
+        udp = payload(original)
+        port = struct.unpack(b'!H', udp[2:4])[0]
+    except (IndexError, struct.error):
+        return None
+    if port not in sent:
+        return None
+    # Routers may quote only the first 8 bytes of the probe, the UDP header
+    if not sent[port][0].startswith(udp[8:]):
+        return None
+    return port
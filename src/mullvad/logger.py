@@ -109,15 +109,22 @@ def get_error_log_path():
     return os.path.join(_log_dir, _ERROR_LOG_FILE)
 
 
-def get_new_openvpn_path():
-    """Returns a path to a non-existing openvpn log."""
+def get_new_openvpn_path(directory=None):
+    """Returns a path to a non-existing openvpn log.
+
+    Args:
+        directory: Where to put the log, the log directory if None. Tunnels
+                   running at the same time need a directory each, or they
+                   may be given the same log.
+    """
     _assert_dir_initiated()
+    directory = directory or _log_dir
     num = 1
-    existing_logs = _get_openvpn_logs()
+    existing_logs = _get_openvpn_logs(directory)
     if existing_logs:
         num = existing_logs[-1][1] + 1
     filename = _create_openvpn_filename(num)
-    return os.path.join(_log_dir, filename)
+    return os.path.join(directory, filename)
 
 
 def get_openvpn_path():
@@ -141,11 +148,12 @@ def get_openvpn_backup_path():
         return None
 
 
-def _get_openvpn_logs():
+def _get_openvpn_logs(directory=None):
     """Returns a list of (filename, num) tuples, oldest first."""
     _assert_dir_initiated()
-    files = [f for f in os.listdir(_log_dir)
-             if os.path.isfile(os.path.join(_log_dir, f))]
+    directory = directory or _log_dir
+    files = [f for f in os.listdir(directory)
+             if os.path.isfile(os.path.join(directory, f))]
     openvpn_logs = []
     for f in files:
         match = re.match(_OPENVPN_LOG_REGEX, f)
@@ -160,11 +168,13 @@ def _create_openvpn_filename(num):
     return _OPENVPN_LOG_TEMPLATE.format(num)
 
 
-def remove_old_openvpn_logs():
-    """Deletes all except the two newest openvpn logs."""
+def remove_old_openvpn_logs(directory=None):
+    """Deletes all except the two newest openvpn logs in directory, the log
+    directory if None."""
     _assert_dir_initiated()
-    for log in _get_openvpn_logs()[:-2]:
-        path = os.path.join(_log_dir, log[0])
+    directory = directory or _log_dir
+    for log in _get_openvpn_logs(directory)[:-2]:
+        path = os.path.join(directory, log[0])
         try:
             os.remove(path)
         except (WindowsError, OSError) as e:
@@ -0,0 +1,177 @@
+#!/usr/bin/env python2
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import BaseHTTPServer
+import threading
+
+from mullvad import logger
+from mullvad import proc
+
+"""Serve tunnel metrics in the Prometheus text format on the loopback
+interface."""
+
+_ADDRESS = '127.0.0.1'
+_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_STATES = ('connected', 'disconnected', 'connecting', 'off',
+           'unrecoverable')
+
+
+def render(snapshot, fork_counts):
+    """Format a Tunnel.metrics() snapshot and proc.get_fork_counts() as
+    Prometheus text."""
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for labels, value in samples:
+            lines.append('{}{} {}'.format(name, _labels(labels),
+                                          _value(value)))
+
+    metric('mullvad_connection_state', 'gauge',
+           'Current connection state, 1 for the active state.',
+           [({'state': state}, int(state == snapshot['state']))
+            for state in _STATES])
+    server = snapshot['server']
+    metric('mullvad_server_info', 'gauge',
+           'The server currently connected to.',
+           [({'name': server['name'], 'address': server['address'],
+              'protocol': server['protocol'], 'port': server['port']}, 1)]
+           if server is not None else [])
+    metric('mullvad_connect_attempts_total', 'counter',
+           'Connect attempts by outcome.',
+           [({'result': result}, count) for result, count
+            in sorted(snapshot['connect_outcomes'].items())])
+    metric('mullvad_reconnects_total', 'counter',
+           'Times an established tunnel was lost and reconnected.',
+           [({}, snapshot['reconnects'])])
+
+    phase_samples = []
+    for phase, stats in sorted(snapshot['connect_phases'].items()):
+        for quantile in ('median', 'p90'):
+            phase_samples.append((
+                {'phase': phase,
+                 'quantile': '0.5' if quantile == 'median' else '0.9'},
+                stats[quantile]))
+    metric('mullvad_connect_phase_seconds', 'summary',
+           'Duration of connect phases over the last connect attempts.',
+           phase_samples)
+    # Since the start, not over the window of the quantiles, or they would
+    # drop once it is full
+    lines += ['mullvad_connect_phase_seconds_sum{} {}'.format(
+        _labels({'phase': phase}), _value(stats['total_sum']))
+        for phase, stats in sorted(snapshot['connect_phases'].items())]
+    lines += ['mullvad_connect_phase_seconds_count{} {}'.format(
+        _labels({'phase': phase}), stats['total_count'])
+        for phase, stats in sorted(snapshot['connect_phases'].items())]
+
+    master_race = snapshot['connect_phases'].get('master_race')
+    metric('mullvad_master_race_seconds', 'gauge',
+           'Median time to reach the master over the last attempts.',
+           [({}, master_race['median'])] if master_race else [])
+
+    traffic = snapshot['traffic']
+    metric('mullvad_tunnel_bytes_total', 'counter',
+           'Bytes through the tunnel as reported by OpenVPN.',
+           [({'direction': 'rx'}, traffic['rx_total']),
+            ({'direction': 'tx'}, traffic['tx_total'])])
+    metric('mullvad_tunnel_bytes_per_second', 'gauge',
+           'Recent tunnel throughput.',
+           [({'direction': 'rx'}, traffic['rx_rate']),
+            ({'direction': 'tx'}, traffic['tx_rate'])])
+
+    tasks = sorted(snapshot['periodic_tasks'].items())
+    metric('mullvad_periodic_task_runs_total', 'counter',
+           'Runs of the periodic checks of the tunnel.',
+           [({'task': name}, stats['runs']) for name, stats in tasks])
+    metric('mullvad_periodic_task_missed_total', 'counter',
+           'Runs of periodic checks that started after their deadline.',
+           [({'task': name}, stats['missed']) for name, stats in tasks])
+    metric('mullvad_periodic_task_max_late_seconds', 'gauge',
+           'Longest time a periodic check started after its deadline.',
+           [({'task': name}, stats['max_late']) for name, stats in tasks])
+
+    health = snapshot['health'] or {}
+    metric('mullvad_tunnel_rtt_seconds', 'gauge',
+           'Mean round trip time to the first hop of the tunnel.',
+           [({}, health['rtt_mean'])]
+           if health.get('rtt_mean') is not None else [])
+    metric('mullvad_tunnel_jitter_seconds', 'gauge',
+           'Mean difference between consecutive round trip times.',
+           [({}, health['jitter'])]
+           if health.get('jitter') is not None else [])
+    metric('mullvad_tunnel_probe_loss_ratio', 'gauge',
+           'Fraction of the latest probes of the tunnel that were lost.',
+           [({}, health['loss'])]
+           if health.get('loss') is not None else [])
+    metric('mullvad_subprocess_forks_total', 'counter',
+           'Subprocesses started, by program.',
+           [({'program': program}, count)
+            for program, count in sorted(fork_counts.items())])
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(key, _escape(labels[key]))
+        for key in sorted(labels)) + '}'
+
+
+def _escape(value):
+    return ('{}'.format(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return '{}'.format(value)
+
+
+class MetricsExporter(object):
+    """HTTP server answering GET /metrics in a daemon thread.
+
+    Every scrape only copies in-memory counters of the tunnel, it never
+    waits for the state machine.
+    """
+    def __init__(self, tunnel, port):
+        self.log = logger.create_logger(self.__class__.__name__)
+        self.tunnel = tunnel
+        exporter = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = render(exporter.tunnel.metrics(),
+                              proc.get_fork_counts()).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', _CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer((_ADDRESS, port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        self.log.info('Serving metrics on http://%s:%d/metrics',
+                      _ADDRESS, self.port)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
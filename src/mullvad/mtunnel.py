@@ -5,11 +5,14 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import collections
 import ctypes
 import errno
 import itertools
+import json
 import os
 import platform
+import Queue
 import random
 import socket
 import sys
@@ -20,29 +23,49 @@ import netifaces
 
 import ipaddr
 
+from mullvad import backoff
 from mullvad import bins
+from mullvad import cancel
 from mullvad import dnsconfig
 from mullvad import firewall
+from mullvad import health
 from mullvad import logger
 from mullvad import mullvadclient
+from mullvad import netprofile
 from mullvad import obfsproxy
+from mullvad import openvpn_capabilities
+from mullvad import openvpn_management
+from mullvad import pidfile
 from mullvad import proc
 from mullvad import route
 from mullvad import serverinfo
 from mullvad import ssl_keys
+from mullvad import standby
+from mullvad import taskgraph
+from mullvad import timing
+from mullvad import traffic
 from mullvad import util
 
 
 backup_server_file = 'backupservers.txt'
 harddns_backup_file = 'harddnsbackup.txt'
+children_file = 'children.json'  # Processes started by the tunnel
 
 SYSTEM_UPDOWN_SCRIPT = '/etc/openvpn/update-resolv-conf'
 BUNDLED_UPDOWN_SCRIPT = 'update-resolv-conf'
 
 _OPENVPN_MANAGEMENT_ADDR = '127.0.0.1'
 _OPENVPN_MANAGEMENT_PORT = 7505
+_OPENVPN_STANDBY_MANAGEMENT_PORT = 7506
 
+_ROUTE_CHECK_INTERVAL = 30
 _GW_CHECK_INTERVAL = 30
+_CHECK_JITTER = 0.1  # Spreads out the checks of several tunnels
+_RESUME_CHECK_INTERVAL = 5
+# Suspended longer than this, the server has dropped the tunnel, as with
+# ping-exit 60 in the client configuration
+_RESUME_RECONNECT_AFTER = 60
+_NETWORK_CHECK_INTERVAL = 2  # While waiting to retry a failed connect
 
 _MASTER_VIA_RELAY_PORT = 53
 _MASTER_PORT = 51678
@@ -51,6 +74,19 @@ _MASTER_IP = '193.138.219.42'
 _SEND_RECV_BUFFERS_MIN = 8192
 _SEND_RECV_BUFFERS_MAX = 67108864
 
+_ROUTE_TABLE_BASE = 100
+
+# Settings that change the whole host, disabled for isolated tunnels
+_HOST_WIDE_SETTINGS = {
+    'delete_default_route': False,
+    'stop_dns_leaks': False,
+    'block_local_network': False,
+    'block_incoming_udp': False,
+    'tunnel_ipv6': True,  # Or IPv6 would be blocked for the whole host
+    'hot_standby': False,
+    'obfsproxy': 'no',  # Listens on a fixed port
+}
+
 
 class ConState:
     connected = 1
@@ -59,6 +95,44 @@ class ConState:
     off = 4
     unrecoverable = 5
 
+    names = {
+        connected: 'connected',
+        disconnected: 'disconnected',
+        connecting: 'connecting',
+        off: 'off',
+        unrecoverable: 'unrecoverable',
+    }
+
+
+class TunnelInstance(object):
+    """Which of several tunnels on the host a Tunnel is, and so where it
+    keeps its state and which ports, routing table and firewall chain it
+    uses.
+
+    Index 0, the default, is the only tunnel on the host. It owns the main
+    routing table, DNS and every OpenVPN process. Other indexes are
+    isolated: their routes go into a table of their own, used for traffic
+    from the tunnel address, and they leave DNS, the default gateway and
+    other tunnels' OpenVPN processes alone.
+    """
+    def __init__(self, index=0, state_dir=''):
+        self.index = index
+        self.isolated = index > 0
+        self.state_dir = state_dir
+        self.management_port = _OPENVPN_MANAGEMENT_PORT + 2 * index
+        self.standby_management_port = \
+            _OPENVPN_STANDBY_MANAGEMENT_PORT + 2 * index
+        if self.isolated:
+            self.route_table = _ROUTE_TABLE_BASE + index
+            self.firewall_chain = '{}-{}'.format(
+                firewall.LinuxFirewall.CHAIN_NAME, index)
+        else:
+            self.route_table = None
+            self.firewall_chain = None
+
+    def path(self, filename):
+        return os.path.join(self.state_dir, filename)
+
 
 class ConnectError(mullvadclient.MullvadClientError):
     pass
@@ -76,79 +150,101 @@ class ObfsproxyMissingError(mullvadclient.MullvadClientError):
     pass
 
 
-class OpenVPNManagement:
-    def __init__(self):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.settimeout(2)
-        self.sock.connect((_OPENVPN_MANAGEMENT_ADDR, _OPENVPN_MANAGEMENT_PORT))
-        self.sock.recv(500)
-
-    def connection_state(self):
-        result = self.connection_info()
-        return result.split(',')[1]
-
-    def connection_info(self):
-        self.sock.sendall('state' + '\n')
-        result = ''
-        while not result.endswith('END\r\n'):
-            new = self.sock.recv(2 ** 16)
-            if new == '':
-                raise socket.error('closed')
-            result += new
-        return result
-
-    def kill(self):
-        self.sock.sendall('signal SIGINT' + '\n')
-        result = ''
-        while len(result) < 8:
-            new = self.sock.recv(2 ** 16)
-            if new == '':
-                raise socket.error('closed')
-            result += new
-        return result.startswith('SUCCESS:')
-
-    def close(self):
-        self.sock.shutdown(socket.SHUT_RDWR)
-        self.sock.close()
-
-
 class Tunnel:
-    def __init__(self, settings, conf_dir=None):
+    def __init__(self, settings, conf_dir=None, instance=None):
         self.log = logger.create_logger(self.__class__.__name__)
+        self.instance = instance if instance is not None \
+            else TunnelInstance()
         self.settings = settings
         self.rw_settings = settings
         self.ssl_keys = ssl_keys.SSLKeys(conf_dir)
+        self.openvpn_capabilities = \
+            openvpn_capabilities.OpenVPNCapabilities(conf_dir)
         self.dnsconfig = dnsconfig.get_dnsconfig()
 
-        self.backup_server_file = backup_server_file
-        self.harddns_backup_file = harddns_backup_file
+        self.backup_server_file = self.instance.path(backup_server_file)
+        self.harddns_backup_file = self.instance.path(harddns_backup_file)
+        self.children = pidfile.PidFile(self.instance.path(children_file))
 
         self.conState = ConState.disconnected
         self.desiredConState = ConState.disconnected
         self.connection_listeners = []
         self.server_listeners = []
         self.error_listeners = []
+        self.throughput_listeners = []
+        self.timing_listeners = []
+        self.connect_timing = timing.ConnectTiming()
+        self.connect_histograms = timing.PhaseHistograms()
+        self.connect_outcomes = collections.Counter()
+        self.reconnects = 0
         self.maybeBlockedByFirewall = False
         self.dpiOpenvpnFiltering = 0
+        self.network_profiles = netprofile.NetworkProfiles(conf_dir)
+        self.network_fingerprint = None
+        self.network_profile = None  # Transport known to work on this network
         self.connectTimeout = 35
+        # Wakes the state machine when there may be something to do
+        self.wakeup = util.Wakeup()
+        self.retry_policy = backoff.RetryPolicy()
         self.openvpn_proc = None  # Process handle to openvpn when running
+        self.management = openvpn_management.ManagementClient(
+            _OPENVPN_MANAGEMENT_ADDR, self.instance.management_port)
+        self.management.subscribe('state on')
+        self.management.subscribe('log on')
+        self.management.subscribe('bytecount 1')
+        self.management.add_listener(self._on_management_event)
+        # Used by the hot-standby OpenVPN. The two clients swap roles when
+        # failing over to it.
+        self.spare_management = openvpn_management.ManagementClient(
+            _OPENVPN_MANAGEMENT_ADDR, self.instance.standby_management_port)
+        self.spare_management.subscribe('state on')
+        self.spare_management.subscribe('log on')
+        self.spare_management.subscribe('bytecount 1')
+        self.standby_tunnel = None  # StandbyTunnel if one is running
+        self.failover_routes = []  # (net, mask, gateway) added on failover
+        self.traffic = traffic.TrafficMeter()
+        self.time_throughput_update = 0
         self.obfsproxy = None  # Handle to Obfsproxy instance if used.
         self.server = None
         self.customerId = None
         self.master_address_cache = None
+        self.key_pool_thread = None  # Pre-generates the next client key
+        self.connect_cancel = None  # CancelToken of the connect under way
+        self.subscription_expiry = None  # As reported by the master
+        # Fetched by _refresh_master_data, for the state machine to apply
+        self.master_refresh = None
+        self.master_refresh_lock = threading.Lock()
+        # What the last working tunnel used, and when it stopped working.
+        # Allows reconnecting without asking the master first.
+        self.last_connection = None
+        self.time_connection_lost = None
         self.current_master_address = None
 
-        # Set when to update route check and monitor_default_gw
-        self.time_route_check = time.time() + 15
-        self.time_monitor_default_gw = self.time_route_check + 15
+        # Periodic checks while connected, first due 15 and 30 s after
+        # connecting
+        self.scheduler = util.PeriodicScheduler()
+        self.scheduler.add('route_check', self._routeCheck,
+                           _ROUTE_CHECK_INTERVAL, delay=15,
+                           jitter=_CHECK_JITTER)
+        self.scheduler.add('default_gw', self._check_default_gw,
+                           _GW_CHECK_INTERVAL, delay=30,
+                           jitter=_CHECK_JITTER)
+        self.resume_detector = util.ResumeDetector()
+        self.health_prober = None  # While connected
+        self.scheduler.add('resume_check', self._check_resume,
+                           _RESUME_CHECK_INTERVAL)
 
         self.logged_first_next_hop = False
 
         self.firewall = None
 
         self.route_manager = route.get_route_manager()
-        if self.route_manager.get_default_gateway() is None:
+        self.policy_routes = None
+        if self.instance.isolated:
+            self.policy_routes = route.PolicyRoutes(self.instance.route_table)
+        elif self.route_manager.get_default_gateway() is None:
             self.route_manager.restore_saved_default_gateway()
+        self._kill_orphans()
         self.machine = threading.Thread(target=self._machine)
         self.machine.start()
 
@@ -168,20 +264,37 @@ class Tunnel:
         self.desiredConState = ConState.connected
         if self.conState == ConState.unrecoverable:
             self.conState = ConState.disconnected
+        self.wakeup.wake()
 
     def disconnect(self):
         self.desiredConState = ConState.disconnected
-        if self.settings.getboolean('delete_default_route'):
+        self.wakeup.wake()
+        self._cancel_connect()
+        if self._deletes_default_route():
             self._cleanupRoutes()
 
     def shutDown(self):
         self.desiredConState = ConState.off
-        if self.settings.getboolean('delete_default_route'):
+        self.wakeup.wake()
+        self._cancel_connect()
+        if self._deletes_default_route():
             self._cleanupRoutes()
 
+    def _cancel_connect(self):
+        """Abort a connect under way, the state machine then cleans up."""
+        token = self.connect_cancel
+        if token is not None:
+            token.cancel()
+
+    def _deletes_default_route(self):
+        return not self.instance.isolated and \
+            self.settings.getboolean('delete_default_route')
+
     def destroy(self):
         self.desiredConState = ConState.off
+        self.wakeup.wake()
         self.machine.join()
+        self.wakeup.close()
         return True
 
     def finished(self):
@@ -195,18 +308,27 @@ class Tunnel:
 
     def _machine(self):
         self.log.debug('Starting state machine')
-        self.time_route_check = time.time() + 15
-        self.time_monitor_default_gw = self.time_route_check + 15
+        self.scheduler.reset()
         while self.conState != ConState.off:
             # Connected
             if self.conState == ConState.connected:
-                if not self._monitor():
+                if not self._apply_master_refresh():
+                    self.log.info('Subscription expired, closing tunnel')
+                    # The full connect that follows reports the expiry
+                    self.last_connection = None
+                    self._disconnect()
+                    self.conState = ConState.disconnected
+                    self.update_connection(self.conState)
+                elif not self._monitor() and not self._failover():
                     self.log.warning('Unable to monitor tunnel, disconnecting')
+                    self.time_connection_lost = util.monotonic()
+                    self.reconnects += 1
                     self._disconnect()
                     self.conState = ConState.disconnected
                     self.update_connection(self.conState)
                 elif self.desiredConState == ConState.disconnected:
                     self.log.info('Instructed to close tunnel, disconnecting')
+                    self.last_connection = None
                     self._disconnect()
                     self.conState = ConState.disconnected
                     self.update_connection(self.conState)
@@ -216,8 +338,9 @@ class Tunnel:
                     self.conState = ConState.off
                     self.update_connection(self.conState)
                 else:
-                    self._monitor_default_gw()
-                    time.sleep(1)
+                    # Until a check is due, unless OpenVPN exits, changes
+                    # state or a state change is requested
+                    self.wakeup.wait(self.scheduler.time_to_next())
             # Disconnected
             elif self.conState == ConState.disconnected:
                 if self.desiredConState == ConState.connected:
@@ -226,8 +349,19 @@ class Tunnel:
                     self.update_connection(self.conState)
                     self.conState = self._connect()
                     if self.conState == ConState.disconnected:
-                        time.sleep(5)
-                    self.update_connection(self.conState)
+                        self.retry_policy.configure(self.settings)
+                        self.log.info('Connecting again in %.1f s',
+                                      self.retry_policy.failed())
+                        self.update_connection(self.conState)
+                        self._wait_for_retry()
+                    else:
+                        if self.conState == ConState.connected:
+                            self.retry_policy.succeeded()
+                            # The time spent connecting is neither missed
+                            # checks nor a suspend
+                            self.scheduler.reset()
+                            self.resume_detector.reset()
+                        self.update_connection(self.conState)
                 elif self.desiredConState == ConState.off:
                     self.log.info('Instructed to shut down,'
                                   ' making sure disconnected')
@@ -235,54 +369,112 @@ class Tunnel:
                     self.conState = ConState.off
                     self.update_connection(self.conState)
                 else:
-                    time.sleep(1)
+                    self.wakeup.wait()
             # Unrecoverable error
             elif self.conState == ConState.unrecoverable:
                 self.log.info('Tunnel state machine in unrecoverable state')
                 if self.desiredConState == ConState.off:
                     self.conState = ConState.off
                     self.update_connection(self.conState)
-                time.sleep(1)
+                else:
+                    self.wakeup.wait()
+        self.management.close()
+        self.spare_management.close()
         self.log.debug('Tunnel manager dying')
 
+    def _wait_for_retry(self):
+        """Sleep until the retry policy allows the next connect attempt, or
+        until asked to stop connecting. Retries at once if the network
+        changes meanwhile."""
+        network = self._network_state()
+        while self.desiredConState == ConState.connected:
+            remaining = self.retry_policy.time_to_next_attempt()
+            if not remaining:
+                break
+            self.wakeup.wait(min(remaining, _NETWORK_CHECK_INTERVAL))
+            if self._network_state() != network:
+                self.log.info('Network changed, connecting at once')
+                self.retry_policy.network_changed()
+
+    def _network_state(self):
+        """Return the local IPv4 addresses, which change with the network.
+        Cheap, as nothing is run."""
+        addresses = set()
+        for iface in netifaces.interfaces():
+            for address in netifaces.ifaddresses(iface).get(
+                    netifaces.AF_INET, []):
+                addresses.add((iface, address.get('addr')))
+        return addresses
+
+    def next_connect_attempt(self):
+        """Return when the next connect attempt is made, as a time.time()
+        value, or None if not waiting to retry a failed connect."""
+        remaining = self.retry_policy.time_to_next_attempt()
+        if (remaining is None or self.conState != ConState.disconnected or
+                self.desiredConState != ConState.connected):
+            return None
+        return time.time() + remaining
+
     def _monitor(self):
-        try:
-            good = self.openvpnManagement.connection_state() == 'CONNECTED'
-        except Exception as e:
+        # The state is kept up to date by notifications from OpenVPN. It is
+        # unknown for a moment after reconnecting to the management interface.
+        state = self.management.state
+        if not self._is_alive():
+            self.log.debug('OpenVPN is not running')
             good = False
-            err = unicode(str(e), errors='replace')
-            self.log.debug(err)
-        # Verify that traffic is correctly routed every 30 s
-        currentTime = time.time()
-        # Check route when time has come or clock has changed
-        if (currentTime - self.time_route_check > 0.0 or
-                currentTime - self.time_route_check < -200.0):
-            # Allow update in 30 seconds
-            self.time_route_check = ((int(currentTime) / 30) * 30 +
-                                     self.time_route_check % 30)
-            if self.time_route_check <= currentTime:
-                self.time_route_check += 30
-
-            good = good and self._routeCheck()
+        elif state is not None and state.state != 'CONNECTED':
+            self.log.debug('OpenVPN state: %s', state)
+            good = False
+        else:
+            good = True
+        if good:
+            # Verify that traffic is correctly routed, and that the tunnel
+            # survived if the host slept, among the other periodic checks
+            # that are due
+            results = self.scheduler.run_due()
+            good = (results.get('route_check') is not False and
+                    results.get('resume_check') is not False)
         return good
 
-    def _monitor_default_gw(self):
-        current_time = time.time()
+    def _check_resume(self):
+        """Verify the tunnel at once if the host has been suspended.
 
-        # Check default gateway when time has come or clock has changed
-        if (current_time - self.time_monitor_default_gw > 0.0 or
-                current_time - self.time_monitor_default_gw < -200.0):
-            self.time_monitor_default_gw = current_time + _GW_CHECK_INTERVAL
+        Returns:
+            False if the tunnel should be reconnected.
+        """
+        suspended = self.resume_detector.check()
+        if not suspended:
+            return True
+        self.log.info('Resumed after about %d s asleep', suspended)
+        if suspended > _RESUME_RECONNECT_AFTER:
+            self.log.info('Asleep too long for the tunnel to be kept')
+            self._stop_standby()  # Dropped as well, no use failing over
+            return False
+        try:
+            state = self.management.query_state()
+        except socket.error as e:
+            self.log.warning('No state from OpenVPN after resume: %s', e)
+            return False
+        if state is None or state.state != 'CONNECTED':
+            self.log.info('OpenVPN state after resume: %s', state)
+            return False
+        return self._routeCheck()
 
-            # Make sure there is no default route if there shouldn't be
-            if self.settings.getboolean('delete_default_route'):
-                self.route_manager.delete_default_gateway()
+    def _check_default_gw(self):
+        # Make sure there is no default route if there shouldn't be
+        if self.settings.getboolean('delete_default_route'):
+            self.route_manager.delete_default_gateway()
 
     def _routeCheck(self):
-        """Verify that traffic is correctly routed."""
+        """Verify that traffic is correctly routed, and that not too many
+        probes of the tunnel are lost."""
         ok = True
+        prober = self.health_prober
         try:
-            nh = self.nextHop()
+            if prober is not None:
+                nh = prober.probe()
+            else:
+                nh = self.nextHop(self._tunnel_source())
         except socket.error, e:
             self.log.debug('nextHop failed: %s', e)
         else:
@@ -292,8 +484,36 @@ class Tunnel:
             elif not self.logged_first_next_hop:
                 self.logged_first_next_hop = True
                 self.log.info('Success, packet went through the tunnel')
+        if prober is not None:
+            # Probe often while the link is unstable
+            self.scheduler.set_interval('route_check', prober.stats.interval)
+            if ok and prober.stats.degraded():
+                self.log.warning('Tunnel degraded, %s',
+                                 json.dumps(prober.stats.stats()))
+                ok = False
         return ok
 
+    def _tunnel_source(self):
+        """Return the address to send from to reach the tunnel, None if
+        any address will do."""
+        if not self.instance.isolated:
+            return None
+        # Only traffic from the tunnel address uses the tunnel
+        state = self.management.state
+        return state.local_ip if state is not None else None
+
+    def _start_health_prober(self):
+        self._stop_health_prober()
+        try:
+            self.health_prober = health.HealthProber(self._tunnel_source())
+        except socket.error as e:
+            self.log.warning('Unable to probe the tunnel health: %s', e)
+
+    def _stop_health_prober(self):
+        if self.health_prober is not None:
+            self.health_prober.close()
+            self.health_prober = None
+
     def _masterFailure(self, operation, error):
         message = 'master: %s: %s' % (operation, error)
         if not self.settings.has_option('id'):
@@ -305,6 +525,7 @@ class Tunnel:
     def _connectMaster(self):
         master = None
         for address, port in self._ordered_master_connection_addresses():
+            self.connect_cancel.check()
             # Add route to master/proxy if Stop DNS leaks enabled
             if self.settings.getboolean('delete_default_route'):
                 self.route_manager.route_add(address)
@@ -312,19 +533,21 @@ class Tunnel:
             try:
                 master = mullvadclient.MullvadClient(
                     address, self.ssl_keys,
-                    port=port, timeout=10, connectTimeout=4)
+                    port=port, timeout=10, connectTimeout=4,
+                    cancel=self.connect_cancel)
                 v = master.version()
                 self.log.debug('Version reply from master: %s', v)
                 # Set address of successful connection as
                 # master for this tunnel instance
                 self.current_master_address = address
                 break
-            except socket.error as e:
+            except (socket.error, cancel.Cancelled) as e:
                 master = None
                 self.log.debug('Connection to master failed: %s', e)
                 # Delete route for master/proxy if it fails
                 if self.settings.getboolean('delete_default_route'):
                     self.route_manager.route_del(address)
+                self.connect_cancel.check()
         return master
 
     def _ordered_master_connection_addresses(self):
@@ -356,11 +579,74 @@ class Tunnel:
         # data center goes down.
         servers_to_try += other_servers[:2]
 
+        # Start with the address that last worked on this network
+        if (self.network_profile is not None and
+                self.network_profile.get('master') is not None):
+            known_address = self.network_profile['master']
+            if known_address == _MASTER_IP:
+                known = (known_address, _MASTER_PORT)
+            else:
+                known = (known_address, _MASTER_VIA_RELAY_PORT)
+            if known in servers_to_try:
+                servers_to_try.remove(known)
+            servers_to_try.insert(0, known)
+
         return servers_to_try
 
     def _connectOpenVPN(self, server, port, proto, cipher, useObfsp=False):
-        customerId = self.settings.getint('id')
         result = ConState.disconnected
+        ovpn_command = self._openvpn_command(
+            server, port, proto, cipher, useObfsp, self.management.port,
+            configure_host=not self.instance.isolated)
+
+        events = Queue.Queue()
+        self.management.add_listener(events.put)
+
+        def abort():
+            # Stop OpenVPN at once, the rest is undone by the state machine.
+            # None is queued first, so it is not taken for an OpenVPN exit.
+            events.put(None)
+            openvpn_proc = self.openvpn_proc
+            if openvpn_proc is not None and openvpn_proc.poll() is None:
+                openvpn_proc.terminate()
+
+        try:
+            with self.connect_timing.phase('openvpn_spawn'):
+                self.openvpn_proc = proc.open(ovpn_command,
+                                              stream_target=None)
+            self.children.add(self.openvpn_proc, bins.openvpn_name)
+            # OpenVPN waits for us, because of --management-hold. Attached
+            # before the monitor starts, so that an OpenVPN exiting at once
+            # is reported as a DisconnectedEvent when it detaches.
+            self.management.attach()
+            self.openvpn_monitor = threading.Thread(
+                target=self._monitor_openvpn, args=(self.openvpn_proc,))
+            self.openvpn_monitor.start()
+            with cancel.registered(self.connect_cancel, abort):
+                result = self._wait_for_openvpn(events, self.connectTimeout)
+        finally:
+            self.management.remove_listener(events.put)
+
+        # Check if the connect timeout stopped the connection
+        if self.server is None:
+            result = ConState.disconnected
+
+        self.log.debug('Done waiting for OpenVPN')
+        if result != ConState.connected:
+            self.log.debug('Not connected')
+            self.maybeBlockedByFirewall = not self.maybeBlockedByFirewall
+        else:
+            self.maybeBlockedByFirewall = False
+        return result
+
+    def _openvpn_command(self, server, port, proto, cipher, useObfsp,
+                         management_port, configure_host=True):
+        """Return the command line starting OpenVPN.
+
+        Without configure_host OpenVPN neither installs routes nor runs the
+        scripts configuring DNS, it only connects to the server.
+        """
+        customerId = self.settings.getint('id')
         client_cert = self.ssl_keys.get_client_cert_path(customerId)
         client_key = self.ssl_keys.get_client_key_path(customerId)
         if platform.system() == 'Windows':
@@ -374,9 +660,12 @@ class Tunnel:
         if cipher == 'aes256':
             cipher = 'AES-256-CBC'
 
-        ovpn_log = logger.get_new_openvpn_path()  # This log does not exist yet
+        # Isolated tunnels keep their logs apart, in their state directory
+        log_dir = self.instance.state_dir if self.instance.isolated else None
+        # This log does not exist yet
+        ovpn_log = logger.get_new_openvpn_path(log_dir)
         open(ovpn_log, 'w').close()  # Create and empty the log
-        logger.remove_old_openvpn_logs()  # Delete old logs
+        logger.remove_old_openvpn_logs(log_dir)  # Delete old logs
         ovpn_args = [
             (bins.openvpn,),
             ('--config', ovpn_conf),
@@ -384,16 +673,17 @@ class Tunnel:
             ('--remote', server, str(port)),
             ('--cert', client_cert),
             ('--key', client_key),
-            ('--management',
-                _OPENVPN_MANAGEMENT_ADDR, str(_OPENVPN_MANAGEMENT_PORT)),
+            ('--management', _OPENVPN_MANAGEMENT_ADDR, str(management_port)),
+            ('--management-hold',),
             ('--cipher', cipher),
         ]
 
-        ovpn_version = self._get_openvpn_version()
+        capabilities = self.openvpn_capabilities.get(bins.openvpn)
 
         if self.settings.getboolean('tunnel_ipv6'):
             ovpn_args.append(('--tun-ipv6',))
-        elif ovpn_version[0] == 2 and ovpn_version[1] >= 4:
+        elif (capabilities.at_least(2, 4) and
+                capabilities.supports('--pull-filter')):
             if proto in ['tcp', 'udp'] and not proto.endswith('4'):
                 proto = proto + '4'
             ovpn_args.append(('--pull-filter', 'ignore', 'ifconfig-ipv6 '))
@@ -421,6 +711,8 @@ class Tunnel:
             try:
                 self.obfsproxy = obfsproxy.Obfsproxy()
                 self.obfsproxy.start()
+                self.children.add(self.obfsproxy.process,
+                                  bins.obfsproxy_name)
                 obfsPort = self.obfsproxy.local_port()
                 ovpn_args.append((obfsproxyOpt, obfsAddr, str(obfsPort)))
             except OSError as e:
@@ -438,15 +730,18 @@ class Tunnel:
         # configure the DNS settings and also restore them should the be
         # overwritten by DHCP. This is not needed if we manually set the DNS
         # through the 'Stop DNS Leaks' setting.
-        if 'Darwin' in platform.platform() and (
+        if 'Darwin' in platform.platform() and configure_host and (
                 not self.settings.getboolean('stop_dns_leaks')):
             ovpn_args.append(
                 ('--up', 'client.up.osx.sh -m -w -d -f -ptADGNWradsgnw'))
             ovpn_args.append(
                 ('--down', 'client.down.osx.sh -m -w -d -f -ptADGNWradsgnw'))
 
-        if platform.system() == 'Windows':
+        if platform.system() == 'Windows' and configure_host:
             if self.settings.getboolean('windows_block_outside_dns'):
+                if not capabilities.supports('--block-outside-dns'):
+                    self.log.warning('OpenVPN does not list '
+                                     '--block-outside-dns, using it anyway')
                 ovpn_args.append(('--block-outside-dns',))
             if self.settings.getboolean('block_incoming_udp'):
                 ovpn_args.append(('--plugin', bins.block_udp_plugin))
@@ -454,7 +749,7 @@ class Tunnel:
         # The OpenVPN package for some Linux distributions do not come with an
         # update-resolv-conf script, thus we bundle one with the client and use
         # that in cases where the default one is missing.
-        if platform.system() == 'Linux':
+        if platform.system() == 'Linux' and configure_host:
             if os.path.exists(SYSTEM_UPDOWN_SCRIPT):
                 updown_script = SYSTEM_UPDOWN_SCRIPT
             else:
@@ -462,88 +757,149 @@ class Tunnel:
             ovpn_args.append(('--up', updown_script))
             ovpn_args.append(('--down', updown_script))
 
-        ovpn_command = list(itertools.chain(*ovpn_args))
+        if not configure_host:
+            ovpn_args.append(('--route-noexec',))
+
+        return list(itertools.chain(*ovpn_args))
+
+    def _on_management_event(self, event):
+        if isinstance(event, openvpn_management.HoldEvent):
+            self.management.send('hold release')
+        elif isinstance(event, (openvpn_management.StateEvent,
+                                openvpn_management.DisconnectedEvent)):
+            self.wakeup.wake()
+        elif isinstance(event, openvpn_management.ByteCountEvent):
+            self._on_bytecount(event.rx, event.tx)
+
+    def _on_bytecount(self, rx, tx):
+        now = util.monotonic()
+        self.traffic.add(rx, tx, now)
+        # Coalesce, listeners get at most the configured number of updates
+        # per second
+        try:
+            max_rate = float(
+                self.settings.get('throughput_updates_per_second'))
+        except ValueError:
+            max_rate = 1.0
+        if max_rate <= 0:
+            return
+        if now - self.time_throughput_update >= 1 / max_rate:
+            self.time_throughput_update = now
+            self.update_throughput(self.traffic.stats())
+
+    def throughput(self):
+        """Return the current traffic totals and rates of the tunnel."""
+        return self.traffic.stats()
+
+    def _wait_for_openvpn(self, events, timeout):
+        """Follow management events until OpenVPN is connected.
+
+        Args:
+            events: A Queue receiving the events from the management client,
+                    and None if the connect is cancelled.
+            timeout: Seconds to wait before stopping OpenVPN.
+
+        Returns:
+            ConState.connected when OpenVPN reports that the initialization
+            sequence completed, ConState.disconnected if it exits first.
+
+        Raises:
+            cancel.Cancelled: If the connect is cancelled.
+        """
+        look_for_filtering = False
+        end = util.monotonic() + timeout
+        while True:
+            try:
+                event = events.get(timeout=max(0, end - util.monotonic()))
+            except Queue.Empty:
+                self.log.error('Connect timeout expired, disconnecting')
+                self._disconnect()
+                break
 
-        self.openvpn_proc = proc.open(ovpn_command, stream_target=None)
-        self.openvpn_monitor = threading.Thread(target=self._monitor_openvpn)
-        self.openvpn_monitor.start()
+            if event is None:
+                self.log.debug('Aborting connection due to user request')
+                raise cancel.Cancelled()
 
-        finished_event_in = threading.Event()
-        finished_event_out = threading.Event()
-        threading.Thread(target=self._connectTimeout,
-                         kwargs={'finished_in': finished_event_in,
-                                 'finished_out': finished_event_out,
-                                 'timeout': self.connectTimeout}).start()
-        ovpnlog = open(ovpn_log, 'r')
-        lookForFiltering = False
-        line = unicode(ovpnlog.readline(), errors='replace')
-        while self._is_alive() or line != '':
-            sys.stdout.write(line)
-            if 'Initialization Sequence Completed' in line and \
-                    'With Errors' not in line:
-                self.log.debug('Initialization Sequence Completed')
-                result = ConState.connected
-                break
-            if 'There are no TAP-Windows adapters on this system' in line:
+            if isinstance(event, openvpn_management.DisconnectedEvent):
+                if not self._is_alive():
+                    break
+                continue
+
+            if isinstance(event, openvpn_management.StateEvent):
+                if event.state in ('WAIT', 'AUTH'):
+                    self.connect_timing.mark('tls_start')
+                if event.state == 'CONNECTED' and event.status == 'SUCCESS':
+                    self.connect_timing.mark('init_completed')
+                    self.log.debug('Initialization Sequence Completed')
+                    return ConState.connected
+                if event.state == 'EXITING':
+                    self.log.debug('OpenVPN exiting: %s', event.status)
+                    break
+                continue
+
+            if isinstance(event, (openvpn_management.LogEvent,
+                                  openvpn_management.FatalEvent)):
+                message = event.message
+            else:
+                continue
+
+            if 'There are no TAP-Windows adapters on this system' in message:
                 raise TAPMissingError()
             if ('All TAP-Windows adapters on this '
-                    'system are currently in use') in line:
+                    'system are currently in use') in message:
                 # Sometimes this message is shown instead of 'There
                 # are no TAP-Win32 adapters ...'
                 routing_info = proc.run_assert_ok(['netstat', '-r', '-n'])
                 if 'TAP-Windows Adapter' not in routing_info:
                     raise TAPMissingError()
             # Detect deep packet inspection OpenVPN filtering
-            if lookForFiltering and line != '':
-                lookForFiltering = False
-                if 'Connection reset' in line or \
-                        'MANAGEMENT: Client connected from' in line:
-                    # Try twice before going back to normal
-                    self.dpiOpenvpnFiltering = 2
-                    self.log.info('Deep packet inspection OpenVPN '
-                                  'filtering detected')
-            if ' link remote: ' in line or 'TLS: Initial packet from ' in line:
-                lookForFiltering = True
-            if line == '':
-                time.sleep(0.05)
-            line = unicode(ovpnlog.readline(), errors='replace')
-
-        # Tell timeout thread to abort
-        finished_event_in.set()
-        # Wait for timeout thread to finish execution
-        finished_event_out.wait()
-        # Check if the timeout thread aborted the connection
-        if self.server is None:
-            result = ConState.disconnected
-
-        self.log.debug('Done waiting for OpenVPN')
-        if result != ConState.connected:
-            self.log.debug('Not connected')
-            self.maybeBlockedByFirewall = not self.maybeBlockedByFirewall
-        else:
-            self.maybeBlockedByFirewall = False
-        ovpnlog.close()
-        return result
-
-    def _get_openvpn_version(self):
-        stdout = proc.run([bins.openvpn, '--version'])[1]
-        version_string = stdout.split(' ')[1]
-
-        return map(int, version_string.split('.'))
-
-    def _monitor_openvpn(self):
+            if look_for_filtering:
+                look_for_filtering = False
+                if 'Connection reset' in message:
+                    self._dpi_filtering_detected()
+            if (' link remote: ' in message or
+                    'TLS: Initial packet from ' in message):
+                look_for_filtering = True
+
+        # Nothing at all was heard after the first packet until OpenVPN was
+        # stopped by the connect timeout. Also a sign of filtering.
+        if (look_for_filtering and
+                self.desiredConState == ConState.connected):
+            self._dpi_filtering_detected()
+        return ConState.disconnected
+
+    def _dpi_filtering_detected(self):
+        # Try twice before going back to normal
+        self.dpiOpenvpnFiltering = 2
+        self.log.info('Deep packet inspection OpenVPN filtering detected')
+
+    def _monitor_openvpn(self, openvpn_proc):
         self.log.debug('Monitoring OpenVPN in separate thread')
-        self.openvpn_proc.communicate()
+        openvpn_proc.communicate()
         self.log.info('OpenVPN process has died')
-        self.openvpn_proc = None
-        # TODO(linus) Probably inform the state machine or something here.
+        if self.openvpn_proc is openvpn_proc:
+            self.openvpn_proc = None
+            self.management.detach()
+            self.wakeup.wake()
 
     def _connect(self):
         self._lock_settings()
         self.logged_first_next_hop = False
+        self.connect_timing = timing.ConnectTiming()
+        with self.master_refresh_lock:
+            self.master_refresh = None  # Fetched for the previous tunnel
         result = ConState.disconnected
+        token = cancel.CancelToken()
+        self.connect_cancel = token
+        if self.desiredConState != ConState.connected:
+            token.cancel()  # Asked to stop before the token was set
         try:
             result = self.__connect__()
+        except cancel.Cancelled:
+            self.log.info('Connect cancelled, cleaning up')
+            self._abandon_master(None)
+            self._disconnect()
+            result = ConState.disconnected
         except mullvadclient.UnrecoverableError, e:
             self.update_error(e)
             self.log.error('Unrecoverable: %s', e)
@@ -553,18 +909,48 @@ class Tunnel:
             self.log.error('Connection failed: %s, %s', e,
                            unicode(traceback.format_exc(), errors='replace'))
             result = ConState.disconnected
-        try:
-            self.openvpnManagement.close()
-        except Exception:
-            pass
-
+        finally:
+            self.connect_cancel = None
+            token.close()
         if result == ConState.connected:
-            self.openvpnManagement = OpenVPNManagement()
             if platform.system() == 'Windows':
                 self._attempt_to_set_lowest_metric()
 
+        self._report_connect_timing(result)
         return result
 
+    def _report_connect_timing(self, result):
+        outcome = ConState.names.get(result, result)
+        self.connect_outcomes[outcome] += 1
+        record = self.connect_timing.record(outcome)
+        self.log.info('Connect timing: %s', json.dumps(record))
+        self.connect_histograms.add(record)
+        self.update_timing(record)
+
+    def metrics(self):
+        """Return a snapshot of the counters exported by metrics.py. Only
+        copies what is in memory, so it is cheap to call at any time."""
+        server = self.server
+        if server is not None:
+            server = dict(name=server.name, address=server.address,
+                          protocol=server.protocol, port=server.port)
+        prober = self.health_prober
+        return {
+            'state': ConState.names.get(self.conState),
+            'server': server,
+            'connect_outcomes': dict(self.connect_outcomes),
+            'reconnects': self.reconnects,
+            'connect_phases': self.connect_histograms.stats(),
+            'traffic': self.traffic.stats(),
+            'periodic_tasks': self.scheduler.stats(),
+            'health': prober.stats.stats() if prober is not None else None,
+        }
+
+    def connect_timing_stats(self):
+        """Return duration statistics for each connect phase over the last
+        connect attempts, see timing.PhaseHistograms.stats()."""
+        return self.connect_histograms.stats()
+
     def _removeBlockAndGateway(self):
         self.log.debug('Removing blocking routes ...')
         self.route_manager.delete_default_gateway()
@@ -577,17 +963,15 @@ class Tunnel:
         self.route_manager.route_del('128.0.0.0', '192.0.0.0', 'reject')
         self.route_manager.route_del('192.0.0.0', '192.0.0.0', 'reject')
 
-    def __connect__(self):
-        if not self.settings.has_option('id'):
-            raise mullvadclient.UnrecoverableError('No account id set')
-        result = ConState.disconnected
-
-        self.firewall = None
+    def _init_firewall(self):
         try:
-            self.firewall = firewall.get_firewall()
+            self.firewall = firewall.get_firewall(
+                self.instance.firewall_chain)
         except firewall.FirewallError as e:
             self.log.error('Firewall error: %s', e)
 
+    def _check_firewall(self):
+        """Refuse settings that rely on a firewall there is none of."""
         block_local_network = self.settings.getboolean('block_local_network')
         if block_local_network and not self.firewall:
             raise mullvadclient.UnrecoverableError(
@@ -610,6 +994,55 @@ class Tunnel:
                 'or enable "Tunnel IPv6" and reconnect.'
             )
 
+    def _add_blocking_routes(self):
+        """Block the default gateway to prevent leaks around the tunnel
+        in case we are reconnecting after an error. OpenVPN needs to
+        look at the default route so we must wait until it has
+        connected before deleting it."""
+        if not self.settings.getboolean('delete_default_route'):
+            return
+        self.route_manager.route_add('0.0.0.0', '192.0.0.0', 'reject')
+        self.route_manager.route_add('64.0.0.0', '192.0.0.0', 'reject')
+        self.route_manager.route_add('128.0.0.0', '192.0.0.0', 'reject')
+        self.route_manager.route_add('192.0.0.0', '192.0.0.0', 'reject')
+        self.route_manager.restore_default_gateway()
+
+        # Add blocking routes for IPv6
+        # Since IPv6 traffic will be routed through the tunnel using four
+        # destination blocks pushed from the OpenVPN server, the two
+        # destination blocks added here can remain throughout the Mullvad
+        # session thus removing the need to store the default gateway while
+        # still blocking internet on connection failure
+        self.log.debug('Blocking IPv6')
+        self.route_manager.block_ipv6()
+
+    def _remove_blocking_routes(self):
+        """Undo _add_blocking_routes, leaving the default gateway."""
+        if not self.settings.getboolean('delete_default_route'):
+            return
+        self.route_manager.route_del('0.0.0.0', '192.0.0.0', 'reject')
+        self.route_manager.route_del('64.0.0.0', '192.0.0.0', 'reject')
+        self.route_manager.route_del('128.0.0.0', '192.0.0.0', 'reject')
+        self.route_manager.route_del('192.0.0.0', '192.0.0.0', 'reject')
+        self.route_manager.unblock_ipv6()
+
+    def _abandon_master(self, master):
+        """Close a master connection that will not be used."""
+        if master is not None:
+            try:
+                master.quit()
+            except socket.error as e:
+                self.log.debug('Closing master connection failed: %s', e)
+        if self.current_master_address is not None:
+            if self.settings.getboolean('delete_default_route'):
+                self.route_manager.route_del(self.current_master_address)
+            self.current_master_address = None
+
+    def __connect__(self):
+        if not self.settings.has_option('id'):
+            raise mullvadclient.UnrecoverableError('No account id set')
+        result = ConState.disconnected
+
         # Check for Windows admin privileges
         if platform.system() == 'Windows':
             if ctypes.windll.shell32.IsUserAnAdmin() == 0:
@@ -618,36 +1051,43 @@ class Tunnel:
 
         # Set connect timeout
         self.connectTimeout = self.settings.getint('timeout')
+        block_local_network = self.settings.getboolean('block_local_network')
 
-        # Kill old openvpn instances
-        self._kill_openvpn()
+        # Reconnect to the same server as before if the tunnel just dropped,
+        # the master is asked in the background once connected
+        fast_reconnect = self._get_fast_reconnect()
+        self.last_connection = None
+        customerId = self.settings.getint('id')
+        if fast_reconnect is not None:
+            self.log.info('Reconnecting without contacting the master')
 
+        # The steps before the master exchange, run concurrently where they
+        # do not depend on each other. Firewall setup, which is slow on
+        # Linux, runs while the master is contacted.
+        self.firewall = None
+        graph = taskgraph.TaskGraph()
+        t = self.connect_timing
+        graph.add('firewall', t.timed('firewall_init', self._init_firewall))
+        graph.add('check_firewall', self._check_firewall, deps=['firewall'])
+        # Kill old openvpn instances
+        graph.add('kill_openvpn', self._kill_openvpn)
         # Make sure the DNS server configuration can be restored later
-        self.dnsconfig.save()
-
-        # Block the default gateway to prevent leaks around the tunnel
-        # in case we are reconnecting after an error. OpenVPN needs to
-        # look at the default route so we must wait until it has
-        # connected before deleting it.
-        if self.settings.getboolean('delete_default_route'):
-            self.route_manager.route_add('0.0.0.0', '192.0.0.0', 'reject')
-            self.route_manager.route_add('64.0.0.0', '192.0.0.0', 'reject')
-            self.route_manager.route_add('128.0.0.0', '192.0.0.0', 'reject')
-            self.route_manager.route_add('192.0.0.0', '192.0.0.0', 'reject')
-            self.route_manager.restore_default_gateway()
-
-            # Add blocking routes for IPv6
-            # Since IPv6 traffic will be routed through the tunnel using four
-            # destination blocks pushed from the OpenVPN server, the two
-            # destination blocks added here can remain throughout the Mullvad
-            # session thus removing the need to store the default gateway while
-            # still blocking internet on connection failure
-            self.log.debug('Blocking IPv6')
-            self.route_manager.block_ipv6()
-
-        # Connect to the master
-        master = self._connectMaster()
-        customerId = self.settings.getint('id')
+        if not self.instance.isolated:
+            graph.add('dns_save', self.dnsconfig.save, deps=['kill_openvpn'])
+        graph.add('block_routes',
+                  t.timed('route_blocking', self._add_blocking_routes),
+                  deps=['kill_openvpn'],
+                  rollback=lambda __: self._remove_blocking_routes())
+        # Look up what is known about the network we are on
+        graph.add('network_profile', self._load_network_profile,
+                  deps=['block_routes'])
+        if fast_reconnect is None:
+            # Connect to the master
+            graph.add('master', t.timed('master_race', self._connectMaster),
+                      deps=['network_profile'],
+                      rollback=self._abandon_master)
+        master = graph.run(self.connect_cancel).get('master')
+        self.connect_cancel.check()
 
         if master is None and not self._has_client_credentials():
             message = 'Unable to fetch account credentials.'
@@ -656,6 +1096,7 @@ class Tunnel:
 
         # Get a certificate
         if master is not None:
+            t.begin('cert_refresh')
             try:
                 self._refresh_master_cert(master)
                 self._refresh_own_cert(master)
@@ -667,24 +1108,29 @@ class Tunnel:
                 with open(client_cert, 'r') as crt_f:
                     crt_f.read()
                 self.log.debug('Got a certificate')
+            t.end('cert_refresh')
 
         # Check subscription expiry time
         if master is not None:
+            t.begin('subscription_check')
             try:
                 self._timeLeft = master.getSubscriptionTimeLeft(customerId)
             except socket.error, e:
                 self._masterFailure('getSubscriptionTimeLeft', str(e))
                 master = None
             else:
+                self.subscription_expiry = time.time() + self._timeLeft
                 if self._timeLeft <= 0:
                     master.quit()
                     if self.settings.getboolean('delete_default_route'):
                         self._removeBlockAndGateway()
                     raise SubscriptionExpiredError()
                 self.log.debug('Time left: %d', self._timeLeft)
+            t.end('subscription_check')
 
         # Check connection count
         if master is not None:
+            t.begin('connections_check')
             try:
                 count, maxAllowed = master.connectionCount(customerId)
             except socket.error, e:
@@ -698,16 +1144,20 @@ class Tunnel:
                         self._removeBlockAndGateway()
                     raise ConnectError(
                         'Too many connections: %d' % (count + 1))
+            t.end('connections_check')
 
         # Get a DNS server
         DNSserver = '10.8.0.1'
 
         # Get backed up DNS just in case, if there
         # is one, and we've asked for avoiding DNS leaks
-        if os.path.exists(self.harddns_backup_file):
+        if fast_reconnect is not None:
+            DNSserver = fast_reconnect['dns']
+        elif os.path.exists(self.harddns_backup_file):
             DNSserver = self._getHardDNSBackup()
 
         if master is not None:
+            t.begin('dns_fetch')
             try:
                 DNSserver = master.getDNSserver()
             except mullvadclient.MullvadClientError, e:
@@ -715,9 +1165,11 @@ class Tunnel:
             except socket.error, e:
                 self._masterFailure('getDNSserver', str(e))
                 master = None
+            t.end('dns_fetch')
 
         # Find a server to connect to
         if master is not None:
+            t.begin('server_list')
             try:
                 serverList = master.getVPNServers()
                 master.quit()
@@ -726,17 +1178,24 @@ class Tunnel:
                 master = None
             else:
                 self._setBackupServers(serverList)
+            t.end('server_list')
 
+        master_address = self.current_master_address
         if self.current_master_address is not None:
             if self.settings.getboolean('delete_default_route'):
                 self.route_manager.route_del(self.current_master_address)
             self.current_master_address = None
 
-        matches = [s for s in self._get_servers() if self._is_match(s)]
-        if matches:
-            self.server = self._select_server(matches)
+        t.begin('server_selection')
+        if fast_reconnect is not None:
+            self.server = fast_reconnect['server']
         else:
-            self.server = self._custom_server()
+            matches = [s for s in self._get_servers() if self._is_match(s)]
+            if matches:
+                self.server = self._select_server(matches)
+            else:
+                self.server = self._custom_server()
+        t.end('server_selection')
 
         if self.server:
             self.update_server(self.server)
@@ -749,7 +1208,13 @@ class Tunnel:
         obfsproxySetting = self.settings.get('obfsproxy')
         assert obfsproxySetting in ('auto', 'yes', 'no')
         useObfsproxy = (obfsproxySetting == 'yes') or \
-            (obfsproxySetting == 'auto' and self.dpiOpenvpnFiltering)
+            (obfsproxySetting == 'auto' and self.dpiOpenvpnFiltering) or \
+            (obfsproxySetting == 'auto' and self._profile_uses_obfsproxy())
+        if fast_reconnect is not None:
+            useObfsproxy = fast_reconnect['obfsproxy']
+            selected_protocol = fast_reconnect['protocol']
+        else:
+            selected_protocol = self.server.protocol
         if useObfsproxy:
             self.server.protocol = 'tcp'  # obfsproxy requires TCP
 
@@ -769,10 +1234,33 @@ class Tunnel:
                 self.firewall.block_local_network()
 
         # Bring up the VPN
+        self.connect_cancel.check()
         result = self._connectOpenVPN(self.server.address, self.server.port,
                                       self.server.protocol, self.server.cipher,
                                       useObfsproxy)
 
+        if result == ConState.connected and self.policy_routes is not None:
+            self._add_policy_routes()
+
+        if result == ConState.connected:
+            self._remember_network_profile(selected_protocol,
+                                           self.server.port,
+                                           useObfsproxy, master_address)
+            self._fill_key_pool()
+            self.last_connection = {
+                'server': self.server,
+                'protocol': selected_protocol,
+                'obfsproxy': useObfsproxy,
+                'dns': DNSserver,
+                'settings': self._get_fast_reconnect_settings(),
+            }
+            if fast_reconnect is not None:
+                self._refresh_master_data_in_background()
+        elif self.network_profile is not None:
+            self.log.info('Remembered transport failed, forgetting it')
+            self.network_profiles.forget(self.network_fingerprint)
+            self.network_profile = None
+
         if result == ConState.connected:
             if platform.system() == 'Darwin' and self.firewall:
                 # Unblock utun ifaces that did not exist during first block.
@@ -810,9 +1298,136 @@ class Tunnel:
                 self.desiredConState == ConState.connected:
             self._removeBlockAndGateway()
 
+        if result == ConState.connected:
+            self._start_health_prober()
+        if result == ConState.connected and not useObfsproxy:
+            self._start_standby()
+
         self.log.debug('dying')
         return result
 
+    def _get_fast_reconnect_settings(self):
+        """The settings that must be unchanged to reconnect to the previous
+        server without asking the master."""
+        return [self.settings.get(option) for option in
+                ('id', 'location', 'protocol', 'server', 'port', 'cipher',
+                 'obfsproxy', 'key_algorithm')]
+
+    def _get_fast_reconnect(self):
+        """Return what the last tunnel used if it may be reconnected to
+        without contacting the master, None otherwise."""
+        window = self.settings.getint('fast_reconnect_window')
+        last = self.last_connection
+        if (window <= 0 or last is None or
+                self.time_connection_lost is None or
+                util.monotonic() - self.time_connection_lost > window):
+            return None
+        if last['settings'] != self._get_fast_reconnect_settings():
+            self.log.debug('Settings changed, no fast reconnect')
+            return None
+        if (self.subscription_expiry is None or
+                self.subscription_expiry <= time.time()):
+            return None
+        cid = self.settings.getint('id')
+        client_cert_path = self.ssl_keys.get_client_cert_path(cid)
+        if (not self._has_client_credentials() or
+                self._cert_expires_soon(client_cert_path)):
+            return None
+        return last
+
+    def _refresh_master_data_in_background(self):
+        thread = threading.Thread(target=self._refresh_master_data)
+        thread.daemon = True
+        thread.start()
+
+    def _refresh_master_data(self):
+        """Ask the master, through the tunnel that is already up, for what a
+        full connect would have. Runs beside the state machine, so nothing
+        it uses is changed here. The answers are left in
+        self.master_refresh for _apply_master_refresh()."""
+        customerId = self.settings.getint('id')
+        refresh = {'master_cert': None, 'own_cert': None, 'dns': None}
+        try:
+            master = mullvadclient.MullvadClient(
+                _MASTER_IP, self.ssl_keys, port=_MASTER_PORT, timeout=10,
+                connectTimeout=4)
+            refresh['master_cert'] = self._fetch_master_cert(master)
+            refresh['own_cert'] = self._fetch_own_cert(master)
+            refresh['time_left'] = master.getSubscriptionTimeLeft(customerId)
+            if refresh['time_left'] > 0:
+                try:
+                    refresh['dns'] = master.getDNSserver()
+                except mullvadclient.MullvadClientError as e:
+                    self.log.warning(e)
+                refresh['servers'] = master.getVPNServers()
+            master.quit()
+        except Exception as e:
+            self.log.warning('Background master refresh failed: %s', e)
+            return
+        with self.master_refresh_lock:
+            self.master_refresh = refresh
+        self.wakeup.wake()
+
+    def _apply_master_refresh(self):
+        """Take what _refresh_master_data fetched into use, if anything.
+
+        Returns:
+            False if the subscription has expired, True otherwise.
+        """
+        with self.master_refresh_lock:
+            refresh, self.master_refresh = self.master_refresh, None
+        if refresh is None:
+            return True
+        try:
+            if refresh['master_cert'] is not None:
+                util.write_atomically(self.ssl_keys.get_master_cert_path(),
+                                      refresh['master_cert'])
+            if refresh['own_cert'] is not None:
+                self._install_own_cert(*refresh['own_cert'])
+            self._timeLeft = refresh['time_left']
+            self.subscription_expiry = time.time() + self._timeLeft
+            if self._timeLeft <= 0:
+                return False
+            if refresh['dns'] is not None:
+                self._setHardDNSBackup(refresh['dns'])
+            self._setBackupServers(refresh['servers'])
+        except (IOError, OSError) as e:
+            self.log.error('Could not store master data: %s', e)
+            return True
+        self.log.debug('Refreshed master data in the background')
+        return True
+
+    def _load_network_profile(self):
+        """Look up the transport that last worked on the current network."""
+        self.network_fingerprint = None
+        self.network_profile = None
+        if not self.settings.getboolean('remember_network_transport'):
+            return
+        try:
+            self.network_fingerprint = netprofile.get_network_fingerprint(
+                self.route_manager)
+        except Exception as e:
+            self.log.warning('Unable to fingerprint network: %s', e)
+            return
+        self.network_profile = self.network_profiles.get(
+            self.network_fingerprint)
+        if self.network_profile is not None:
+            self.log.info('Known network, using %s port %s%s',
+                          self.network_profile['protocol'],
+                          self.network_profile['port'],
+                          ' with obfsproxy'
+                          if self.network_profile['obfsproxy'] else '')
+
+    def _remember_network_profile(self, protocol, port, obfsproxy, master):
+        if self.network_fingerprint is None:
+            return
+        self.network_profiles.remember(self.network_fingerprint,
+                                       protocol, port, obfsproxy, master)
+
+    def _profile_uses_obfsproxy(self):
+        return (self.network_profile is not None and
+                self.network_profile['obfsproxy'])
+
     def _attempt_to_set_lowest_metric(self):
         # Windows 10 Creators Update sends DNS queries sequentially to all
         # network interfaces. The order in which the interfaces are queried
@@ -836,8 +1451,7 @@ class Tunnel:
             self.log.debug('Failed to set metric: %s', e)
 
     def _get_tap_interface_name(self):
-        raw = self.openvpnManagement.connection_info()
-        ip = raw.split(',')[3]
+        ip = self.management.state.local_ip
         interface_uuid = self._ip_to_interface_uuid(ip)
         return self._interface_uuid_to_name(interface_uuid)
 
@@ -865,12 +1479,47 @@ class Tunnel:
     def _disconnect(self):
         self.server = None
         self.update_server(None)
+        self.traffic.reset()
+        self.update_throughput(self.traffic.stats())
+
+        self._stop_health_prober()
+        # Before _kill_openvpn, which would kill it anyway, to clean up
+        self._stop_standby()
+        for net, mask, gateway in self.failover_routes:
+            self.route_manager.route_del(net, mask, gateway)
+        self.failover_routes = []
 
         if self._is_alive():
             self._kill_openvpn()
         else:
             self.log.debug('openvpn not alive, killing not necessary')
 
+        if self.policy_routes is not None:
+            self.policy_routes.clear()
+        else:
+            self._restore_dns()
+
+        if self.firewall:
+            self.log.debug('Unblocking IPv6 in firewall')
+            self.firewall.unblock_ipv6()
+        if self.obfsproxy is not None:
+            try:
+                self.obfsproxy.stop()
+                self.obfsproxy = None
+            except Exception as e:
+                self.log.error('obfsproxy.stop(): %s', e)
+            self.children.kill(bins.obfsproxy_name)
+
+        if self.firewall:
+            if self.settings.getboolean('block_local_network'):
+                self.log.debug('Unblocking local network')
+                self.firewall.unblock_local_network()
+            if self.settings.getboolean('block_incoming_udp'):
+                self.firewall.unblock_incoming_udp()
+            self.firewall.set_allowed_ip(None)
+        self._unlock_settings()
+
+    def _restore_dns(self):
         try:
             self.dnsconfig.restore()
         except WindowsError as e:
@@ -893,73 +1542,177 @@ class Tunnel:
                 msg = unicode(e)
                 self.log.warning('dnsconfig.restore: %s: %s', e_name, msg)
 
-        if self.firewall:
-            self.log.debug('Unblocking IPv6 in firewall')
-            self.firewall.unblock_ipv6()
-        if self.obfsproxy is not None:
-            try:
-                self.obfsproxy.stop()
-                self.obfsproxy = None
-            except Exception as e:
-                self.log.error('obfsproxy.stop(): %s', e)
-
-        if self.firewall:
-            if self.settings.getboolean('block_local_network'):
-                self.log.debug('Unblocking local network')
-                self.firewall.unblock_local_network()
-            if self.settings.getboolean('block_incoming_udp'):
-                self.firewall.unblock_incoming_udp()
-            self.firewall.set_allowed_ip(None)
-        self._unlock_settings()
+    def _add_policy_routes(self):
+        """Route traffic from the tunnel address through the tunnel, in the
+        routing table of this instance. OpenVPN was told not to add any
+        routes itself."""
+        state = self.management.state
+        gateway = None
+        if state is not None and state.local_ip:
+            gateway = standby.get_tunnel_gateway(state.local_ip)
+        if gateway is None:
+            raise ConnectError('No gateway found for the tunnel')
+        self.policy_routes.set(state.local_ip, gateway)
 
     def _is_alive(self):
         return (self.openvpn_proc is not None and
                 self.openvpn_proc.poll() is None)
 
-    def _connectTimeout(self, finished_in, finished_out, timeout):
-        for i in xrange(timeout):
-            finished_in.wait(1)
-            if self.desiredConState != ConState.connected:
-                self.log.debug('Aborting connection due to user request')
-                self._disconnect()
-                break
-            elif finished_in.isSet():
-                self.log.debug('Connection established')
-                break
-        if (not finished_in.isSet()
-           and self._is_alive()
-           and self.conState != ConState.connected):
-            self.log.error('Connect timeout expired, disconnecting')
-            self._disconnect()
-        finished_out.set()
-
     def _kill_openvpn(self):
-        """Kill openvpn. Try both management interface and then all procs."""
+        """Kill openvpn. Try the management interface first, then signal
+        the OpenVPN processes this tunnel has started."""
         self.log.debug('Killing openvpn process')
+        self._stop_standby()
         self._kill_openvpn_management()
-        proc.kill_procs_by_name(bins.openvpn_name)
+        self.children.kill(bins.openvpn_name)
+
+    def _kill_orphans(self):
+        """Kill what an earlier run of the tunnel left behind.
+
+        The processes in the PID file are stopped, and the only tunnel on
+        the host also looks through every process for OpenVPN, once, for
+        those started before the PID file was written.
+        """
+        self.children.kill()
+        if not self.instance.isolated:
+            proc.kill_procs_by_name(bins.openvpn_name)
 
     def _kill_openvpn_management(self):
         """Use the management interface to try to kill openvpn."""
         wait = True
         try:
-            assert self.openvpnManagement.kill()
-            self.openvpnManagement.close()
+            assert self.management.kill()
         except Exception as e:
-            # If there is no working management connection try making a new.
             err = unicode(str(e), errors='replace')
             self.log.debug('Killing via mgmt interface failed: %s', err)
-            try:
-                ovpn = OpenVPNManagement()
-                assert ovpn.kill()
-                ovpn.close()
-            except Exception as e2:
-                err2 = unicode(str(e2), errors='replace')
-                self.log.debug('Connecting new mgmt failed: %s', err2)
-                wait = False
+            wait = False
         if wait:
             util.poll(self._is_alive, 0.45, 3)
 
+    def _start_standby(self):
+        """Connect a second OpenVPN to another matching server, to fail
+        over to should the current tunnel stop working.
+
+        The standby OpenVPN does not touch routes or DNS, the firewall
+        allows traffic to its server.
+        """
+        if not self.settings.getboolean('hot_standby') or \
+                self.standby_tunnel is not None:
+            return
+        if self.firewall and not self.firewall.supports_standby:
+            self.log.debug('Firewall can not allow a standby server')
+            return
+        candidates = [s for s in self._get_servers()
+                      if self._is_match(s) and
+                      s.address != self.server.address]
+        if not candidates:
+            self.log.info('No other matching server to keep on standby')
+            return
+        backup = self._select_server(candidates)
+        try:
+            if self.settings.getboolean('delete_default_route'):
+                self.route_manager.route_del(backup.address)
+                self.route_manager.route_add(backup.address)
+            if self.firewall:
+                self.firewall.set_standby_ip(backup.address)
+            command = self._openvpn_command(
+                backup.address, backup.port, backup.protocol, backup.cipher,
+                False, self.spare_management.port, configure_host=False)
+            self.standby_tunnel = standby.StandbyTunnel(backup,
+                                                 self.spare_management)
+            self.standby_tunnel.start(command)
+            self.children.add(self.standby_tunnel.process, bins.openvpn_name)
+        except Exception as e:
+            self.log.error('Could not start standby tunnel: %s', e)
+            self._stop_standby(backup)
+
+    def _stop_standby(self, server=None):
+        """Stop the standby OpenVPN, if any, and remove what was set up for
+        it."""
+        if self.standby_tunnel is not None:
+            standby_tunnel, self.standby_tunnel = self.standby_tunnel, None
+            standby_tunnel.stop()
+            server = standby_tunnel.server
+        if server is None:
+            return
+        if self.firewall:
+            self.firewall.set_standby_ip(None)
+        if self.settings.getboolean('delete_default_route'):
+            self.route_manager.route_del(server.address)
+
+    def _failover(self):
+        """Move traffic to the standby tunnel, if it is connected.
+
+        The standby OpenVPN was started with --route-noexec, so the routes
+        OpenVPN would have added for redirect-gateway def1 are added here,
+        through the gateway of its tunnel interface.
+
+        Returns:
+            True if the standby tunnel is now the active one.
+        """
+        if self.standby_tunnel is None or \
+                not self.standby_tunnel.is_ready():
+            return False
+        gateway = self.standby_tunnel.gateway()
+        if gateway is None:
+            self.log.warning('No gateway found for the standby tunnel')
+            return False
+        old_server = self.server
+        old_proc = self.openvpn_proc
+        new_server = self.standby_tunnel.server
+        self.log.warning('Tunnel lost, failing over to %s', new_server.name)
+        t0 = util.monotonic()
+
+        # Stop only the old OpenVPN, _kill_openvpn would kill the standby
+        # as well. Its monitor thread must be done before the swap below.
+        try:
+            self.management.kill()
+        except Exception as e:
+            self.log.debug('Killing via mgmt interface failed: %s', e)
+        if old_proc is not None:
+            util.poll(lambda: old_proc.poll() is None, 0.1, 3)
+            if old_proc.poll() is None:
+                old_proc.terminate()
+            self.openvpn_monitor.join()
+        self.management.detach()
+
+        new_proc, new_management = self.standby_tunnel.release()
+        self.standby_tunnel = None
+        self.management.remove_listener(self._on_management_event)
+        new_management.add_listener(self._on_management_event)
+        self.management, self.spare_management = (new_management,
+                                                  self.management)
+        self.openvpn_proc = new_proc
+        self.openvpn_monitor = threading.Thread(
+            target=self._monitor_openvpn, args=(new_proc,))
+        self.openvpn_monitor.start()
+
+        for net in ('0.0.0.0', '128.0.0.0'):
+            self.route_manager.route_add(net, '128.0.0.0', gateway)
+            self.failover_routes.append((net, '128.0.0.0', gateway))
+        if self.firewall:
+            self.firewall.set_allowed_ip(new_server.address)
+            self.firewall.set_standby_ip(None)
+        if old_server is not None and \
+                self.settings.getboolean('delete_default_route'):
+            self.route_manager.route_del(old_server.address)
+        if self.settings.getboolean('stop_dns_leaks') and \
+                self.last_connection is not None:
+            # The down script of the old OpenVPN may have restored DNS
+            self.dnsconfig.set([self.last_connection['dns']])
+
+        self.server = new_server
+        if self.last_connection is not None:
+            self.last_connection['server'] = new_server
+            self.last_connection['protocol'] = new_server.protocol
+        self.update_server(new_server)
+        self.traffic.reset()
+        self.update_throughput(self.traffic.stats())
+        self.log.info('Failed over in %.3f s', util.monotonic() - t0)
+        self._start_health_prober()  # Not to judge it by the old tunnel
+        self._start_standby()
+        return True
+
     def timeLeft(self):
         return self._timeLeft
 
@@ -976,18 +1729,76 @@ class Tunnel:
 
     def _verify_cert_data(self, cert_data, ca_path):
         """Verify a given certificate against ca file.
+
+        Successful verifications are cached until either file changes or the
+        certificate is about to expire.
         """
+        with open(ca_path) as f:
+            ca_data = f.read()
+        cache = self.ssl_keys.verification_cache
+        if cache.is_verified('verify', cert_data, ca_data):
+            return True
         __, stdout, __ = proc.run([bins.openssl, 'verify', '-CAfile',
-                                  ca_path], stdin=cert_data)
-        return 'stdin: OK' in stdout
+                                  ca_path], stdin=cert_data,
+                                 cancel=self.connect_cancel)
+        ok = 'stdin: OK' in stdout
+        if ok:
+            cache.set_verified('verify',
+                               ssl_keys.get_cert_not_after(cert_data),
+                               cert_data, ca_data)
+        return ok
 
     def _verify_cert_key_match(self, cert_path, key_path):
         """Compare the public part of a given certificate and private key."""
-        __, cert_modulus, __ = proc.run(
-            [bins.openssl, 'x509', '-in', cert_path, '-modulus', '-noout'])
-        __, key_modulus, __ = proc.run(
-            [bins.openssl, 'rsa', '-in', key_path, '-modulus', '-noout'])
-        return cert_modulus == key_modulus
+        with open(cert_path) as f:
+            cert_data = f.read()
+        with open(key_path) as f:
+            key_data = f.read()
+        cache = self.ssl_keys.verification_cache
+        if cache.is_verified('key_match', cert_data, key_data):
+            return True
+        # Works for every key algorithm, unlike comparing -modulus
+        __, cert_pubkey, __ = proc.run(
+            [bins.openssl, 'x509', '-in', cert_path, '-pubkey', '-noout'],
+            cancel=self.connect_cancel)
+        __, key_pubkey, __ = proc.run(
+            [bins.openssl, 'pkey', '-in', key_path, '-pubout'],
+            cancel=self.connect_cancel)
+        match = cert_pubkey.strip() != '' and \
+            cert_pubkey.strip() == key_pubkey.strip()
+        if match:
+            cache.set_verified('key_match',
+                               ssl_keys.get_cert_not_after(cert_data),
+                               cert_data, key_data)
+        return match
+
+    def _cert_key_algorithm(self, cert_path):
+        with open(cert_path) as f:
+            return ssl_keys.get_cert_key_algorithm(f.read())
+
+    def _uses_other_key_algorithm(self, cert_path, algorithm):
+        """Return True if the certificate is for a key of another
+        algorithm than algorithm. One whose algorithm can not be told is
+        kept, rather than replaced on every connect."""
+        used = self._cert_key_algorithm(cert_path)
+        if used is None:
+            self.log.warning('Unknown key algorithm in %s, keeping it',
+                             cert_path)
+            return False
+        return used != algorithm
+
+    def _get_key_algorithm(self):
+        algorithm = self.settings.get('key_algorithm')
+        if algorithm not in ssl_keys.KEY_ALGORITHMS:
+            self.log.warning('Unknown key_algorithm %s, using rsa', algorithm)
+            return 'rsa'
+        return algorithm
+
+    def _cert_expires_soon(self, cert_path):
+        with open(cert_path) as f:
+            not_after = ssl_keys.get_cert_not_after(f.read())
+        return (not_after is not None and
+                not_after - time.time() < ssl_keys.CERT_RENEW_MARGIN)
 
     def _has_client_credentials(self):
         cid = self.settings.getint('id')
@@ -998,21 +1809,80 @@ class Tunnel:
         return has_key and has_cert
 
     def _refresh_master_cert(self, master):
+        master_cert = self._fetch_master_cert(master)
+        if master_cert is None:
+            return
+        try:
+            util.write_atomically(self.ssl_keys.get_master_cert_path(),
+                                  master_cert)
+        except (IOError, OSError), e:
+            self.log.error(
+                'Could not write master.mullvad.net certificate: %s', e)
+
+    def _fetch_master_cert(self, master):
+        """Return the master certificate if it is valid and differs from
+        the stored one, None otherwise."""
         master_cert = master.getCertificate()
         ca_cert_path = self.ssl_keys.get_ca_cert_path()
-        if self._verify_cert_data(master_cert, ca_cert_path):
-            master_cert_path = self.ssl_keys.get_master_cert_path()
-            try:
-                with open(master_cert_path, 'w') as master_cert_f:
-                    master_cert_f.write(master_cert)
-            except IOError, e:
-                self.log.error(
-                    'Could not write master.mullvad.net certificate: %s', e)
-        else:
+        if not self._verify_cert_data(master_cert, ca_cert_path):
             self.log.error('Master certificate verification failed')
+            return None
+        master_cert_path = self.ssl_keys.get_master_cert_path()
+        if util.file_content(master_cert_path) == master_cert:
+            return None
+        return master_cert
+
+    def _fetch_own_cert(self, master):
+        """Like _refresh_own_cert, but leaves the client's key and
+        certificate alone. The new ones are written next to them.
+
+        Returns:
+            None if the certificate is fine, otherwise the paths of the new
+            key and signing request and the new certificate, for
+            _install_own_cert().
+        """
+        cid = self.settings.getint('id')
+        if not self._own_cert_needs_renewal(cid, self._get_key_algorithm()):
+            return None
+        key_path = self.ssl_keys.get_client_key_path(cid) + '.new'
+        csr_path = self.ssl_keys.get_client_signing_request_path(cid) + '.new'
+        self._generate_key(cid, self._get_key_algorithm(), key_path,
+                           csr_path)
+        with open(csr_path, 'r') as csr_f:
+            client_cert = master.signCertificate(csr_f.read())
+        return key_path, csr_path, client_cert
+
+    def _install_own_cert(self, key_path, csr_path, client_cert):
+        """Make a key, signing request and certificate from
+        _fetch_own_cert() the client's."""
+        cid = self.settings.getint('id')
+        util.replace_file(csr_path,
+                          self.ssl_keys.get_client_signing_request_path(cid))
+        util.replace_file(key_path, self.ssl_keys.get_client_key_path(cid))
+        util.write_atomically(self.ssl_keys.get_client_cert_path(cid),
+                              client_cert)
 
     def _refresh_own_cert(self, master):
         cid = self.settings.getint('id')
+        client_key_path = self.ssl_keys.get_client_key_path(cid)
+        client_cert_path = self.ssl_keys.get_client_cert_path(cid)
+        algorithm = self._get_key_algorithm()
+        if self._own_cert_needs_renewal(cid, algorithm):
+            # Sign a pre-generated key pair if there is one, otherwise
+            # generate one now
+            client_csr_path = \
+                self.ssl_keys.get_client_signing_request_path(cid)
+            if self.ssl_keys.take_pooled_key(cid, algorithm):
+                self.log.debug('Using pre-generated %s key', algorithm)
+            else:
+                self._generate_key(cid, algorithm, client_key_path,
+                                   client_csr_path, self.connect_cancel)
+            with open(client_csr_path, 'r') as csr_f:
+                client_csr = csr_f.read()
+            client_cert = master.signCertificate(client_csr)
+            util.write_atomically(client_cert_path, client_cert)
+
+    def _own_cert_needs_renewal(self, cid, algorithm):
         client_key_path = self.ssl_keys.get_client_key_path(cid)
         client_cert_path = self.ssl_keys.get_client_cert_path(cid)
         master_cert_path = self.ssl_keys.get_master_cert_path()
@@ -1027,43 +1897,70 @@ class Tunnel:
             self.log.info('%s from heartbleed bug era, recreating',
                           client_cert_path)
             need_new = True
+        elif self._cert_expires_soon(client_cert_path):
+            self.log.info('%s expires soon, recreating', client_cert_path)
+            need_new = True
+        elif self._uses_other_key_algorithm(client_cert_path, algorithm):
+            self.log.info('%s does not use a %s key, recreating',
+                          client_cert_path, algorithm)
+            need_new = True
         elif not self._verify_cert_key_match(client_cert_path,
                                              client_key_path):
             self.log.info('%s and %s do not match, recreating',
                           client_key_path,
                           client_cert_path)
             need_new = True
+        return need_new
 
-        if need_new:
-            # Generate and sign a key pair
-            __, client_csr_path = self._generate_key(cid)
-            with open(client_csr_path, 'r') as csr_f:
-                client_csr = csr_f.read()
-            client_cert = master.signCertificate(client_csr)
-            with open(client_cert_path, 'w') as crt_f:
-                crt_f.write(client_cert)
-
-    def _generate_key(self, cid):
-        """Create a new private key and a certificate signing request
-        file. Returns a tuple of (key_path, signing_request_path)"""
-        key = self.ssl_keys.get_client_key_path(cid)
-        csr = self.ssl_keys.get_client_signing_request_path(cid)
+    def _generate_key(self, cid, algorithm, key, csr, cancel=None):
+        """Create a new private key of the given algorithm and a
+        certificate signing request file, unless cancelled."""
         command = ([bins.openssl] +
-                   ('req -text -batch -days 3650 -nodes -new -newkey '
-                   'rsa:2048 -subj /CN=Mullvad%d' % cid).split() +
+                   ('req -text -batch -days 3650 -nodes -new '
+                    '-subj /CN=Mullvad%d' % cid).split() +
+                   ssl_keys.get_newkey_options(algorithm) +
                    ['-keyout', key, '-out', csr, '-config', 'openssl.cnf'])
-        proc.run_assert_ok(command)
-        return (key, csr)
+        proc.run_assert_ok(command, cancel=cancel)
+
+    def _fill_key_pool(self):
+        """Generate the next client key in the background, unless one is
+        already waiting, so renewing the certificate only needs the
+        round trip to the master."""
+        cid = self.settings.getint('id')
+        algorithm = self._get_key_algorithm()
+        if self.ssl_keys.has_pooled_key(cid, algorithm) or \
+                (self.key_pool_thread is not None and
+                 self.key_pool_thread.is_alive()):
+            return
+        self.key_pool_thread = threading.Thread(
+            target=self._pregenerate_key, args=(cid, algorithm))
+        self.key_pool_thread.daemon = True
+        self.key_pool_thread.start()
+
+    def _pregenerate_key(self, cid, algorithm):
+        key = self.ssl_keys.get_pooled_key_path(cid, algorithm) + '.tmp'
+        csr = self.ssl_keys.get_pooled_signing_request_path(
+            cid, algorithm) + '.tmp'
+        try:
+            # openssl keeps the mode of an existing file, so the key is
+            # never readable by others, not even before add_pooled_key
+            os.close(os.open(key, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                             0o600))
+            self._generate_key(cid, algorithm, key, csr)
+            self.ssl_keys.add_pooled_key(cid, algorithm, key, csr)
+            self.log.debug('Pre-generated the next %s client key', algorithm)
+        except Exception as e:
+            self.log.error('Could not pre-generate client key: %s', e)
+            for path in (key, csr):
+                if os.path.exists(path):
+                    os.remove(path)
 
     def _setBackupServers(self, serverList):
-        f = open(self.backup_server_file, 'w')
-        for s in serverList:
-            f.write(str(s) + '\n')
-        f.close()
+        util.write_atomically(self.backup_server_file,
+                              ''.join(str(s) + '\n' for s in serverList))
 
     def _setHardDNSBackup(self, DNSserver):
-        with open(self.harddns_backup_file, 'w') as f:
-            f.write(DNSserver + '\n')
+        util.write_atomically(self.harddns_backup_file, DNSserver + '\n')
 
     def _getHardDNSBackup(self):
         with open(self.harddns_backup_file, 'r') as f:
@@ -1093,11 +1990,23 @@ class Tunnel:
         if protocol == 'any' and self.maybeBlockedByFirewall:
             protocol = 'tcp'
 
+        # Go straight for the transport that last worked on this network
+        profile = self.network_profile
+        if profile is not None and profile['protocol'] != 'obfs2':
+            if self.settings.get('protocol') == 'any':
+                protocol = profile['protocol']
+            if port == 'any' and protocol == profile['protocol']:
+                port = profile['port']
+
         useObfsproxy = ((obfsproxy == 'yes') or
                         (obfsproxy == 'auto' and self.dpiOpenvpnFiltering))
         if useObfsproxy:
             self.dpiOpenvpnFiltering -= 1
             protocol = 'obfs2'
+        elif obfsproxy == 'auto' and self._profile_uses_obfsproxy():
+            protocol = 'obfs2'
+            if port == 'any' and profile['protocol'] == 'obfs2':
+                port = profile['port']
 
         if port != 'any':
             port = int(port)
@@ -1209,9 +2118,35 @@ class Tunnel:
             except Exception:
                 pass
 
-    def nextHop(self):
+    def add_throughput_listener(self, listener):
+        self.throughput_listeners.append(listener)
+
+    def remove_throughput_listener(self, listener):
+        self.throughput_listeners.remove(listener)
+
+    def update_throughput(self, stats):
+        for l in self.throughput_listeners:
+            try:
+                l(stats)
+            except Exception:
+                pass
+
+    def add_timing_listener(self, listener):
+        self.timing_listeners.append(listener)
+
+    def remove_timing_listener(self, listener):
+        self.timing_listeners.remove(listener)
+
+    def update_timing(self, record):
+        for l in self.timing_listeners:
+            try:
+                l(record)
+            except Exception:
+                pass
+
+    def nextHop(self, source=None):
         """Return the IP address of the next hop gotten from a one-hop
-        traceroute."""
+        traceroute, sent from the source address if given."""
         dest = '193.0.14.129'  # Doesn't really matter, we'll never get there
         port = 65501  # Only used to identify the reply
         load = 'Meaningless dummy data.'
@@ -1224,6 +2159,8 @@ class Tunnel:
                 s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, 2)
             s.settimeout(2)
             s.setsockopt(socket.SOL_IP, socket.IP_TTL, 1)
+            if source is not None:
+                s.bind((source, 0))
             s.sendto(load, (dest, port))
             s.close()
 
@@ -1283,6 +2220,9 @@ class Tunnel:
     def _lock_settings(self):
         self.log.debug('Locking settings')
         self.settings = self.rw_settings.get_read_only_clone()
+        if self.instance.isolated:
+            for option, value in _HOST_WIDE_SETTINGS.items():
+                self.settings.override(option, value)
 
     def _unlock_settings(self):
         self.log.debug('Unlocking settings')
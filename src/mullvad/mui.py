@@ -2107,7 +2107,11 @@ def _create_tunnel(settings):
     if platform.system() == 'Linux':
         pipe_dir, pipes = _create_unix_pipes()
         atexit.register(_release_unix_pipes, pipes)
-        tunnel = tunnelcontroller.TunnelController(pipe_dir)
+        trace_path = None
+        if settings.getboolean('trace_requests'):
+            trace_path = os.path.join(paths.get_log_dir(),
+                                      'requests.trace.jsonl')
+        tunnel = tunnelcontroller.TunnelController(pipe_dir, trace_path)
     else:
         tunnel = mtunnel.Tunnel(settings)
     return tunnel
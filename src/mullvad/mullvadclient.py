@@ -36,15 +36,16 @@ class UnrecoverableError(MullvadClientError):
 class MullvadClient:
     def __init__(self, server, keys=None,
                  port=netcom.defaultPort, family=socket.AF_INET,
-                 timeout=10, connectTimeout=None):
+                 timeout=10, connectTimeout=None, cancel=None):
         self.log = logger.create_logger(self.__class__.__name__)
         if keys is None:
             keys = ssl_keys.SSLKeys()
         self.ssl_keys = keys
         if connectTimeout is None:
             connectTimeout = timeout
+        self.cancel = cancel  # Aborts every call when cancelled
         self.master = netcom.Client(
-            server, port, family, timeout, connectTimeout)
+            server, port, family, timeout, connectTimeout, cancel)
 
     def _verify(self, signature):
         sig_fd, sig_path = tempfile.mkstemp()
@@ -54,8 +55,10 @@ class MullvadClient:
             pubkey = key_f.read()
         command = [bins.openssl, 'rsautl', '-verify',
                    '-certin', '-in', sig_path]
-        (exitcode, stdout, _) = proc.run(command, pubkey)
-        os.remove(sig_path)
+        try:
+            (exitcode, stdout, _) = proc.run(command, pubkey, self.cancel)
+        finally:
+            os.remove(sig_path)
         return stdout if exitcode == 0 else None
 
     def _command(self, name, *data):
@@ -7,18 +7,24 @@ from __future__ import division
 from __future__ import print_function
 # from __future__ import unicode_literals
 
+import errno
+import os
 import socket
 import sys
 
 defaultPort = 51678
 
+_WSAEWOULDBLOCK = 10035  # connect_ex() in progress on Windows
+
 sys.setrecursionlimit(10000)
 
 
-def _getBytes(length, sock):
+def _getBytes(length, sock, cancel=None, timeout=None):
     """Read an exact number of bytes from a socket."""
     data = ''
     while len(data) < length:
+        if cancel is not None:
+            cancel.wait_for_socket(sock, timeout)
         newData = sock.recv(length - len(data))
         if len(newData) == 0:
             raise socket.error, 'Remote end closed.'
@@ -28,28 +34,63 @@ def _getBytes(length, sock):
 
 class Client:
 
+    """Connection to a Server.
+
+    With a cancel.CancelToken as cancel, connecting and waiting for replies
+    stop as soon as the token is cancelled, raising cancel.Cancelled and
+    closing the socket.
+    """
+
     def __init__(self, server, port=defaultPort, family=socket.AF_INET,
-                 timeout=60, connectTimeout=None):
+                 timeout=60, connectTimeout=None, cancel=None):
         if connectTimeout is None:
             connectTimeout = timeout
+        self.timeout = timeout
+        self.cancel = cancel
         self.socket = socket.socket(family, socket.SOCK_STREAM)
-        self.socket.settimeout(connectTimeout)
-        self.socket.connect((server, port))
+        if cancel is None:
+            self.socket.settimeout(connectTimeout)
+            self.socket.connect((server, port))
+        else:
+            try:
+                self._connect((server, port), connectTimeout)
+            except Exception:
+                self.socket.close()
+                raise
         self.socket.settimeout(timeout)
 
+    def _connect(self, address, timeout):
+        self.socket.setblocking(False)
+        error = self.socket.connect_ex(address)
+        if error in (errno.EINPROGRESS, errno.EWOULDBLOCK,
+                     _WSAEWOULDBLOCK):
+            self.cancel.wait_for_socket(self.socket, timeout, write=True)
+            error = self.socket.getsockopt(socket.SOL_SOCKET,
+                                           socket.SO_ERROR)
+        if error != 0:
+            raise socket.error(error, os.strerror(error))
+
     def send(self, blob):
+        try:
+            return self._send(blob)
+        except Exception:
+            if self.cancel is not None and self.cancel.cancelled:
+                self.socket.close()
+            raise
+
+    def _send(self, blob):
         self.socket.sendall('%08X' % len(blob))  # Size of the object
         self.socket.sendall(blob)
 
         # Wait for a reply
-        hexSize = _getBytes(8, self.socket)
+        hexSize = _getBytes(8, self.socket, self.cancel, self.timeout)
         assert len(hexSize) > 0
         try:
             size = int(hexSize, 16)
         except ValueError:
             return None
 
-        blob = _getBytes(size, self.socket)
+        blob = _getBytes(size, self.socket, self.cancel, self.timeout)
         return blob
 
     def close(self):
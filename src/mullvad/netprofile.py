@@ -0,0 +1,185 @@
+#!/usr/bin/env python2
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import os
+import platform
+import re
+import threading
+import time
+
+import netifaces
+
+from mullvad import logger
+from mullvad import paths
+from mullvad import proc
+from mullvad import util
+
+"""Remember which transport works on which network."""
+
+_PROFILES_FILE = 'netprofiles.json'
+_MAX_PROFILES = 64
+
+_LINUX_ARP_TABLE = '/proc/net/arp'
+_INCOMPLETE_MAC = '00:00:00:00:00:00'  # In the table while resolving
+_MAC_REGEX = re.compile(r'(([0-9a-fA-F]{1,2}[:-]){5}[0-9a-fA-F]{1,2})')
+
+
+def get_default_gateway(route_manager=None):
+    """Return the IPv4 address of the current default gateway.
+
+    The live routing table is asked first. If no default route exists, which
+    is the case when the tunnel has deleted it, the gateway remembered by the
+    route manager is used instead.
+    """
+    gateway = netifaces.gateways().get('default', {}).get(netifaces.AF_INET)
+    if gateway is not None:
+        return gateway[0]
+    if route_manager is not None:
+        return route_manager.get_default_gateway()
+    return None
+
+
+def get_gateway_mac(gateway):
+    """Return the link layer address of the given gateway, None if unknown."""
+    if platform.system() == 'Linux':
+        try:
+            with open(_LINUX_ARP_TABLE, 'r') as f:
+                return parse_arp_table(f.read(), gateway)
+        except IOError:
+            return None
+
+    if platform.system() == 'Windows':
+        command = ['arp', '-a', gateway]
+    else:
+        command = ['arp', '-n', gateway]
+    try:
+        __, stdout, __ = proc.run(command)
+    except OSError:
+        return None
+    return parse_arp_output(stdout)
+
+
+def parse_arp_table(table, gateway):
+    """Return the link layer address of gateway in the contents of
+    /proc/net/arp, None if it is not there or not resolved yet."""
+    for line in table.splitlines()[1:]:
+        columns = line.split()
+        if len(columns) >= 4 and columns[0] == gateway:
+            mac = columns[3].lower()
+            return mac if mac != _INCOMPLETE_MAC else None
+    return None
+
+
+def parse_arp_output(output):
+    """Return the first link layer address in the output of the arp
+    command, None if there is none."""
+    match = _MAC_REGEX.search(output)
+    if match is None:
+        return None
+    return match.group(1).replace('-', ':').lower()
+
+
+def get_network_fingerprint(route_manager=None):
+    """Create an opaque identifier for the network the host is attached to.
+
+    The fingerprint is derived from the address and link layer address of
+    the default gateway. Neither is stored in clear text.
+
+    Returns:
+        A hex string, or None if no default gateway could be found.
+    """
+    gateway = get_default_gateway(route_manager)
+    if gateway is None:
+        return None
+    mac = get_gateway_mac(gateway) or ''
+    digest = hashlib.sha256('{}|{}'.format(gateway, mac).encode('utf-8'))
+    return digest.hexdigest()[:32]
+
+
+class NetworkProfiles(object):
+    """On disk cache of the transport that last worked on each network.
+
+    Every profile is a dict with the keys 'protocol', 'port', 'obfsproxy'
+    and 'master', describing the server protocol and port that was used,
+    whether obfsproxy was needed and which address the master was reached
+    through.
+    """
+    def __init__(self, conf_dir=None):
+        self.log = logger.create_logger(self.__class__.__name__)
+        if conf_dir is None:
+            conf_dir = paths.get_config_dir()
+        self.path = os.path.join(conf_dir, _PROFILES_FILE)
+        self.lock = threading.Lock()  # Guards profiles and the file
+        self.profiles = self._load()
+
+    def get(self, fingerprint):
+        """Return the profile for a network fingerprint, None if unknown."""
+        if fingerprint is None:
+            return None
+        with self.lock:
+            profile = self.profiles.get(fingerprint)
+        if profile is None:
+            return None
+        return dict(profile)
+
+    def remember(self, fingerprint, protocol, port, obfsproxy, master=None):
+        """Store the transport that successfully connected on a network.
+
+        If master is None the previously remembered master address, if any,
+        is kept.
+        """
+        if fingerprint is None:
+            return
+        with self.lock:
+            old = self.profiles.get(fingerprint, {})
+            if master is None:
+                master = old.get('master')
+            self.profiles[fingerprint] = {
+                'protocol': protocol,
+                'port': port,
+                'obfsproxy': bool(obfsproxy),
+                'master': master,
+                'last_used': int(time.time()),
+            }
+            self._prune()
+            self._save()
+
+    def forget(self, fingerprint):
+        """Remove the profile for a network fingerprint if there is one."""
+        with self.lock:
+            if self.profiles.pop(fingerprint, None) is not None:
+                self._save()
+
+    def _prune(self):
+        """Drop the least recently used profiles above _MAX_PROFILES."""
+        if len(self.profiles) <= _MAX_PROFILES:
+            return
+        by_age = sorted(self.profiles.items(),
+                        key=lambda (__, p): p.get('last_used', 0))
+        for fingerprint, __ in by_age[:len(self.profiles) - _MAX_PROFILES]:
+            del self.profiles[fingerprint]
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                profiles = json.load(f)
+        except (IOError, ValueError) as e:
+            self.log.warning('Ignoring unreadable %s: %s', self.path, e)
+            return {}
+        if not isinstance(profiles, dict):
+            return {}
+        return profiles
+
+    def _save(self):
+        try:
+            util.write_atomically(self.path, json.dumps(self.profiles))
+        except (IOError, OSError) as e:
+            self.log.error('Could not write %s: %s', self.path, e)
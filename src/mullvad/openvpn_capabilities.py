@@ -0,0 +1,113 @@
+#!/usr/bin/env python2
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import distutils.spawn
+import json
+import os
+import re
+import threading
+
+from mullvad import logger
+from mullvad import paths
+from mullvad import proc
+from mullvad import util
+
+"""Find out, once per OpenVPN binary, what it supports."""
+
+_CACHE_FILE = 'openvpn_capabilities.json'
+
+_VERSION_REGEX = re.compile(r'OpenVPN (\d+)\.(\d+)(?:\.(\d+))?')
+_OPTION_REGEX = re.compile(r'^\s*(--[a-zA-Z0-9-]+)', re.MULTILINE)
+
+
+class Capabilities(object):
+    def __init__(self, version, options):
+        self.version = tuple(version)  # e.g. (2, 4, 2)
+        self.options = frozenset(options)  # e.g. '--pull-filter'
+
+    def supports(self, option):
+        return option in self.options
+
+    def at_least(self, *version):
+        return self.version >= version
+
+
+class OpenVPNCapabilities(object):
+    """Probe OpenVPN binaries and cache the results on disk.
+
+    A binary is identified by its resolved path, modification time and
+    size, so replacing or upgrading it causes a new probe.
+    """
+    def __init__(self, conf_dir=None):
+        self.log = logger.create_logger(self.__class__.__name__)
+        if conf_dir is None:
+            conf_dir = paths.get_config_dir()
+        self.path = os.path.join(conf_dir, _CACHE_FILE)
+        self.lock = threading.Lock()
+        self.cache = self._load()
+
+    def get(self, binary):
+        """Return the Capabilities of the given OpenVPN binary.
+
+        Probing runs 'openvpn --version' and 'openvpn --help', but only the
+        first time a binary is seen.
+        """
+        path = distutils.spawn.find_executable(binary) or binary
+        path = os.path.realpath(path)
+        try:
+            stat = os.stat(path)
+            key = '{}:{}:{}'.format(path, int(stat.st_mtime), stat.st_size)
+        except OSError:
+            key = path  # Let the probe report the actual problem
+
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is None:
+                entry = self._probe(binary)
+                # Only one entry per path is interesting
+                for old_key in [k for k in self.cache
+                                if k.rsplit(':', 2)[0] == path]:
+                    del self.cache[old_key]
+                self.cache[key] = entry
+                self._save()
+        return Capabilities(entry['version'], entry['options'])
+
+    def _probe(self, binary):
+        __, stdout, __ = proc.run([binary, '--version'])
+        match = _VERSION_REGEX.search(stdout)
+        if match is None:
+            raise RuntimeError(
+                'Unable to parse OpenVPN version: {}'.format(stdout))
+        version = [int(part or 0) for part in match.groups()]
+
+        # --help exits with a non zero code, but still lists the options
+        __, stdout, __ = proc.run([binary, '--help'])
+        options = sorted(set(_OPTION_REGEX.findall(stdout)))
+
+        self.log.info('Probed %s: version %s, %d options',
+                      binary, '.'.join(map(str, version)), len(options))
+        return {'version': version, 'options': options}
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                cache = json.load(f)
+        except (IOError, ValueError), e:
+            self.log.warning('Ignoring unreadable %s: %s', self.path, e)
+            return {}
+        if not isinstance(cache, dict):
+            return {}
+        return cache
+
+    def _save(self):
+        # Renamed into place, other tunnels may read it at the same time
+        try:
+            util.write_atomically(self.path, json.dumps(self.cache))
+        except (IOError, OSError), e:
+            self.log.error('Could not write %s: %s', self.path, e)
@@ -0,0 +1,383 @@
+#!/usr/bin/env python2
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import collections
+import socket
+import threading
+import time
+
+from mullvad import logger
+
+"""Client for the OpenVPN management interface.
+
+The client keeps one connection to the interface open in a reader thread,
+parses real-time notifications into event objects and hands them to
+listeners. Command replies are matched with their commands in the order
+they were sent, which is the order OpenVPN answers them in.
+"""
+
+DEFAULT_ADDR = '127.0.0.1'
+DEFAULT_PORT = 7505
+
+_CONNECT_TIMEOUT = 2
+_COMMAND_TIMEOUT = 5
+_RETRY_INTERVAL_MIN = 0.05
+_RETRY_INTERVAL_MAX = 1.0
+
+
+class ManagementEvent(object):
+    """Base class for everything the client passes to its listeners."""
+    pass
+
+
+class StateEvent(ManagementEvent):
+    """>STATE: and the reply to the 'state' command.
+
+    Example payload: 1496048022,CONNECTED,SUCCESS,10.8.0.2,185.65.132.1
+    """
+    def __init__(self, payload):
+        fields = payload.split(',')
+        fields += [''] * (5 - len(fields))
+        self.time = int(fields[0]) if fields[0].isdigit() else 0
+        self.state = fields[1]
+        self.status = fields[2]
+        self.local_ip = fields[3]
+        self.remote_ip = fields[4]
+
+    def __str__(self):
+        return '{},{}'.format(self.state, self.status)
+
+
+class ByteCountEvent(ManagementEvent):
+    """>BYTECOUNT:<bytes in>,<bytes out>"""
+    def __init__(self, payload):
+        rx, tx = payload.split(',')[:2]
+        self.rx = int(rx)
+        self.tx = int(tx)
+
+
+class LogEvent(ManagementEvent):
+    """>LOG:<time>,<flags>,<message>"""
+    def __init__(self, payload):
+        fields = payload.split(',', 2)
+        fields = [''] * (3 - len(fields)) + fields
+        self.time = int(fields[0]) if fields[0].isdigit() else 0
+        self.flags = fields[1]
+        self.message = fields[2]
+
+
+class HoldEvent(ManagementEvent):
+    """>HOLD:, OpenVPN waits for 'hold release'."""
+    def __init__(self, payload):
+        self.message = payload
+
+
+class FatalEvent(ManagementEvent):
+    """>FATAL:, OpenVPN is about to exit."""
+    def __init__(self, payload):
+        self.message = payload
+
+
+class Notification(ManagementEvent):
+    """Any other real-time notification, e.g. >INFO: or >PASSWORD:."""
+    def __init__(self, name, payload):
+        self.name = name
+        self.payload = payload
+
+
+class ConnectedEvent(ManagementEvent):
+    """The client (re)connected to the management interface."""
+    pass
+
+
+class DisconnectedEvent(ManagementEvent):
+    """The connection to the management interface was lost or closed."""
+    pass
+
+
+_NOTIFICATIONS = {
+    'STATE': StateEvent,
+    'BYTECOUNT': ByteCountEvent,
+    'LOG': LogEvent,
+    'HOLD': HoldEvent,
+    'FATAL': FatalEvent,
+}
+
+
+def parse_notification(line):
+    """Turn a line starting with '>' into a ManagementEvent."""
+    name, __, payload = line[1:].partition(':')
+    event_class = _NOTIFICATIONS.get(name)
+    if event_class is None:
+        return Notification(name, payload)
+    try:
+        return event_class(payload)
+    except ValueError:
+        return Notification(name, payload)
+
+
+class _Request(object):
+    def __init__(self, command, multiline, callback):
+        self.command = command
+        self.multiline = multiline
+        self.callback = callback
+        self.lines = []
+        self.error = None
+        self.done = threading.Event()
+
+    def finish(self, error=None):
+        self.error = error
+        self.done.set()
+        if self.callback is not None:
+            self.callback(self)
+
+
+class ManagementClient(object):
+    """Long-lived connection to the management interface of one OpenVPN.
+
+    The client does nothing until attach() is called. From then on it
+    connects, and reconnects whenever the connection is lost, until detach()
+    is called. The commands given to subscribe() are sent again after
+    every reconnect.
+    """
+    def __init__(self, address=DEFAULT_ADDR, port=DEFAULT_PORT):
+        self.log = logger.create_logger(self.__class__.__name__)
+        self.address = address
+        self.port = port
+        self.state = None  # Latest StateEvent
+        self.listeners = []
+        self.subscriptions = []
+        self.lock = threading.Lock()  # Serializes sending and self.pending
+        self.pending = collections.deque()
+        self.sock = None
+        self.attached = threading.Event()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def subscribe(self, command):
+        """Send a command now, if connected, and after every reconnect."""
+        if command not in self.subscriptions:
+            self.subscriptions.append(command)
+        if self.is_connected():
+            self.send(command)
+
+    def attach(self):
+        """Start connecting to the management interface."""
+        self.attached.set()
+
+    def detach(self):
+        """Close the connection and stop reconnecting."""
+        with self.lock:
+            was_attached = self.attached.isSet()
+            # Once closed, the reader thread must stay woken to exit
+            if not self.closed:
+                self.attached.clear()
+        self._close()
+        if was_attached:
+            self._update(DisconnectedEvent())
+
+    def is_connected(self):
+        return self.sock is not None
+
+    def send(self, command, multiline=False, callback=None):
+        """Send a command without waiting for the reply.
+
+        Args:
+            command: The management command to send.
+            multiline: True for commands answering with lines terminated by
+                       END, False for a single SUCCESS: or ERROR: line.
+            callback: Called from the reader thread with the finished
+                      request. request.lines holds the reply and
+                      request.error is set if the connection was lost.
+
+        Returns:
+            The request object.
+
+        Raises:
+            socket.error: If not connected.
+        """
+        request = _Request(command, multiline, callback)
+        with self.lock:
+            sock = self.sock
+            if sock is None:
+                raise socket.error('Not connected to OpenVPN management')
+            self.pending.append(request)
+            try:
+                sock.sendall((command + '\n').encode('utf-8'))
+            except socket.error as e:
+                self.pending.remove(request)
+                raise e
+        return request
+
+    def command(self, command, multiline=False, timeout=_COMMAND_TIMEOUT):
+        """Send a command and wait for the reply.
+
+        Must not be called from a listener since listeners run on the reader
+        thread that receives the reply.
+
+        Returns:
+            The lines of the reply.
+
+        Raises:
+            socket.error: If not connected, if the connection is lost or if
+                          no reply arrives within the timeout.
+        """
+        assert threading.current_thread() is not self.thread
+        request = self.send(command, multiline)
+        if not request.done.wait(timeout):
+            raise socket.timeout('No reply to {}'.format(command))
+        if request.error is not None:
+            raise request.error
+        return request.lines
+
+    def query_state(self, timeout=_COMMAND_TIMEOUT):
+        """Ask OpenVPN for its current state instead of waiting for it to
+        report a change.
+
+        Returns:
+            The StateEvent, also kept as self.state.
+
+        Raises:
+            socket.error: As command().
+        """
+        lines = self.command('state', multiline=True, timeout=timeout)
+        if lines:
+            self.state = StateEvent(lines[-1])
+        return self.state
+
+    def kill(self):
+        """Ask OpenVPN to exit. Returns True if it accepted."""
+        return self.command('signal SIGINT')[0].startswith('SUCCESS:')
+
+    def close(self):
+        """Stop the client for good, and its reader thread."""
+        with self.lock:
+            self.closed = True
+        self.detach()
+        self.listeners = []
+        self.attached.set()  # Wakes the reader thread, to see it is closed
+        if threading.current_thread() is not self.thread:
+            self.thread.join()
+
+    def _run(self):
+        retry_interval = _RETRY_INTERVAL_MIN
+        while True:
+            self.attached.wait()
+            if self.closed:
+                return
+            try:
+                sock = socket.create_connection(
+                    (self.address, self.port), _CONNECT_TIMEOUT)
+            except socket.error:
+                time.sleep(retry_interval)
+                retry_interval = min(retry_interval * 2, _RETRY_INTERVAL_MAX)
+                continue
+            retry_interval = _RETRY_INTERVAL_MIN
+            sock.settimeout(None)
+            with self.lock:
+                if self.closed or not self.attached.isSet():
+                    sock.close()
+                    continue
+                self.sock = sock
+            self.log.debug('Connected to OpenVPN management at %s:%d',
+                           self.address, self.port)
+            self._read(sock)
+
+    def _read(self, sock):
+        stream = sock.makefile('rb')
+        subscribed = False
+        try:
+            for raw_line in iter(stream.readline, b''):
+                line = raw_line.rstrip(b'\r\n').decode('utf-8', 'replace')
+                if line.startswith('>'):
+                    self._notification(line)
+                    if not subscribed and line.startswith('>INFO:'):
+                        # The greeting, the interface is ready for commands
+                        subscribed = True
+                        self._on_connected()
+                else:
+                    self._reply_line(line)
+        except socket.error as e:
+            self.log.debug('Management connection error: %s', e)
+        finally:
+            stream.close()
+            self._close(sock)
+            self._fail_pending()
+            if self.attached.isSet() and not self.closed:
+                self._update(DisconnectedEvent())
+
+    def _on_connected(self):
+        try:
+            for command in self.subscriptions:
+                self.send(command)
+            self.send('state', multiline=True, callback=self._state_reply)
+        except socket.error:
+            return
+        self._update(ConnectedEvent())
+
+    def _state_reply(self, request):
+        if request.error is None and request.lines:
+            self.state = StateEvent(request.lines[-1])
+
+    def _notification(self, line):
+        event = parse_notification(line)
+        if isinstance(event, StateEvent):
+            self.state = event
+        self._update(event)
+
+    def _reply_line(self, line):
+        with self.lock:
+            if not self.pending:
+                self.log.debug('Unexpected management reply: %s', line)
+                return
+            request = self.pending[0]
+            failed = (request.multiline and not request.lines and
+                      line.startswith('ERROR:'))
+            if request.multiline and line != 'END' and not failed:
+                request.lines.append(line)
+                return
+            if not request.multiline or failed:
+                request.lines.append(line)
+            self.pending.popleft()
+        request.finish()
+
+    def _fail_pending(self):
+        with self.lock:
+            pending = list(self.pending)
+            self.pending.clear()
+        for request in pending:
+            request.finish(socket.error('Management connection closed'))
+
+    def _close(self, sock=None):
+        with self.lock:
+            if sock is None:
+                sock = self.sock
+            if sock is self.sock:
+                self.sock = None
+                self.state = None
+        if sock is None:
+            return
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        sock.close()
+
+    def _update(self, event):
+        for l in list(self.listeners):
+            try:
+                l(event)
+            except Exception as e:
+                self.log.error('Management listener failed: %s', e)
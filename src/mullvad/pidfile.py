@@ -0,0 +1,138 @@
+#!/usr/bin/env python2
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import os
+import platform
+import threading
+
+import psutil
+
+from mullvad import logger
+from mullvad import util
+
+"""Keep track of the processes a tunnel has started."""
+
+
+class PidFile(object):
+    """Remembers started processes in a file, to stop them without looking
+    through every process on the system.
+
+    The file outlives the tunnel, so what a crashed run left behind is
+    stopped by the next one. Each process is stored with its start time,
+    and is only signalled while that still matches, a pid reused by an
+    unrelated process is left alone.
+    """
+    def __init__(self, path):
+        self.log = logger.create_logger(self.__class__.__name__)
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = self._load()  # pid -> {'name': ..., 'started': ...}
+
+    def add(self, popen, name):
+        """Remember a started process.
+
+        Args:
+            popen: The subprocess.Popen handle of the process.
+            name: What to call it, kill() can be limited to a name.
+        """
+        try:
+            started = psutil.Process(popen.pid).create_time()
+        except psutil.Error:
+            return  # Already gone
+        with self.lock:
+            self._prune()
+            self.entries[unicode(popen.pid)] = {'name': name,
+                                                'started': started}
+            self._save()
+
+    def pids(self, name=None):
+        with self.lock:
+            return sorted(int(pid) for pid, entry in self.entries.items()
+                          if name is None or entry.get('name') == name)
+
+    def kill(self, name=None, timeout=3):
+        """Stop the remembered processes, and forget them.
+
+        Sends SIGTERM/TerminateProcess first, and SIGKILL to what is left
+        after timeout seconds unless on Windows, like
+        ProcManager.kill_procs_by_name.
+
+        Args:
+            name: Only stop the processes added with this name.
+            timeout: The timeout (seconds) to wait after SIGTERM and SIGKILL.
+        """
+        with self.lock:
+            selected = [(pid, entry) for pid, entry in self.entries.items()
+                        if name is None or entry.get('name') == name]
+            for pid, __ in selected:
+                del self.entries[pid]
+            if selected:
+                self._save()
+        procs = [p for p in (self._process(int(pid), entry)
+                             for pid, entry in selected)
+                 if p is not None]
+        if not procs:
+            return
+
+        self.log.info('Terminating %s', [p.pid for p in procs])
+        for p in procs:
+            self._signal(p, p.terminate)
+        __, procs = psutil.wait_procs(procs, timeout)
+
+        if procs and platform.system() != 'Windows':
+            self.log.warning('Still alive, killing %s', [p.pid for p in procs])
+            for p in procs:
+                self._signal(p, p.kill)
+            __, procs = psutil.wait_procs(procs, timeout)
+
+        if procs:
+            self.log.error('Failed to kill %s', [p.pid for p in procs])
+
+    def _process(self, pid, entry):
+        """Return the psutil Process for an entry, None if it has exited or
+        the pid now belongs to another process."""
+        try:
+            p = psutil.Process(pid)
+            if p.create_time() != entry.get('started'):
+                return None
+            return p
+        except psutil.Error:
+            return None
+
+    def _signal(self, p, send):
+        try:
+            send()
+        except psutil.NoSuchProcess:
+            pass
+        except psutil.Error as e:
+            self.log.error('Could not signal %s: %s', p.pid, e)
+
+    def _prune(self):
+        """Forget the processes that have exited."""
+        for pid, entry in self.entries.items():
+            if self._process(int(pid), entry) is None:
+                del self.entries[pid]
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                entries = json.load(f)
+        except (IOError, ValueError) as e:
+            self.log.warning('Ignoring unreadable %s: %s', self.path, e)
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return entries
+
+    def _save(self):
+        try:
+            util.write_atomically(self.path, json.dumps(self.entries))
+        except (IOError, OSError) as e:
+            self.log.error('Could not write %s: %s', self.path, e)
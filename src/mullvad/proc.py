@@ -5,14 +5,20 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import collections
+import errno
+import io
 import locale
 import os
 import platform
 import re
 import subprocess
+import sys
+import threading
 
 import psutil
 
+from mullvad import executor
 from mullvad import logger
 
 """Module for executing system commands through subprocess"""
@@ -20,6 +26,13 @@ from mullvad import logger
 _proc_instance = None
 _proc_manager_instance = None
 
+# Quick commands that may be run by the helper of use_executor()
+_EXECUTOR_PROGRAMS = frozenset(['route', 'ip', 'iptables', 'ip6tables',
+                                'netstat', 'pfctl', 'networksetup'])
+
+_PROC_DIR = '/proc'
+_COMM_MAX = 15  # Longer names are cut in /proc/<pid>/comm
+
 # Create a keyword argument to Popen that will hide ugly black
 # console windows on Windows (instead of setting shell=True) or
 # an empty one that will do nothing on other platforms.
@@ -37,22 +50,34 @@ def open(args, stream_target=subprocess.PIPE):
     return _get_proc().open(args, stream_target)
 
 
-def run(args, stdin=None):
-    return _get_proc().run(args, stdin)
+def run(args, stdin=None, cancel=None):
+    return _get_proc().run(args, stdin, cancel)
 
 
 def run_get_exit(args, stdin=None):
     return _get_proc().run_get_exit(args, stdin)
 
 
-def run_assert_ok(args, stdin=None):
-    return _get_proc().run_assert_ok(args, stdin)
+def run_assert_ok(args, stdin=None, cancel=None):
+    return _get_proc().run_assert_ok(args, stdin, cancel)
 
 
 def try_run(args, stdin=None):
     return _get_proc().try_run(args, stdin)
 
 
+def use_executor():
+    """Run route, firewall and other quick commands through a long-lived
+    helper process instead of forking this one for each of them."""
+    return _get_proc().use_executor()
+
+
+def get_fork_counts():
+    """Return a dict from program name to the number of times it has been
+    started by this process."""
+    return _get_proc().get_fork_counts()
+
+
 def kill_procs_by_name(name, timeout=3):
     return _get_proc_manager().kill_procs_by_name(name, timeout)
 
@@ -119,6 +144,9 @@ class Proc(object):
         self.log = logger.create_logger(self.__class__.__name__)
         self.encode_encoding = self._get_encode_encoding()
         self.decode_encoding = self._get_decode_encoding()
+        self.fork_counts = collections.Counter()
+        self.fork_counts_lock = threading.Lock()
+        self.executor = None  # executor.Executor if use_executor() was called
         self.log.debug('Encoding with %s, decoding with %s',
                        self.encode_encoding, self.decode_encoding)
 
@@ -138,14 +166,17 @@ class Proc(object):
         assert len(args) > 0, 'No command given'
         self.log.debug('Executing: %s', format_args(args))
         exec_args = [self._encode(arg) for arg in args]
+        self._count_fork(args)
         close_fds = platform.system() == 'Windows' and stream_target is None
         try:
-            return subprocess.Popen(exec_args,
-                                    stdin=stream_target,
-                                    stdout=stream_target,
-                                    stderr=stream_target,
-                                    close_fds=close_fds,
-                                    **hide_window)
+            # Not while a command helper is started, its pipes would leak
+            with executor.spawn_lock:
+                return subprocess.Popen(exec_args,
+                                        stdin=stream_target,
+                                        stdout=stream_target,
+                                        stderr=stream_target,
+                                        close_fds=close_fds,
+                                        **hide_window)
         except Exception as e:
             if not e.args:
                 arg0 = ''
@@ -155,12 +186,25 @@ class Proc(object):
             e.args = (msg,) + e.args[1:]
             raise
 
-    def run(self, args, stdin=None):
+    def use_executor(self):
+        if platform.system() == 'Windows' or getattr(sys, 'frozen', False):
+            self.log.debug('No command helper on this platform')
+            return
+        if self.executor is None:
+            self.executor = executor.Executor()
+
+    def get_fork_counts(self):
+        with self.fork_counts_lock:
+            return dict(self.fork_counts)
+
+    def run(self, args, stdin=None, cancel=None):
         """Executes a command and return exit code, stdout & stderr.
 
         Args:
             args: a list of arguments, the first one being the program to run.
             stdin: a string that will be passed to stdin of the program.
+            cancel: an optional cancel.CancelToken, killing the program when
+                    cancelled.
 
         Returns:
             A tuple with three values. The first one is the exit code, the
@@ -169,20 +213,75 @@ class Proc(object):
 
         Raises:
             Same exceptions as subprocess.Popen. Also encode/decode can raise
+            cancel.Cancelled: If the token was cancelled.
         """
-        proc = self.open(args)
-        (out, err) = proc.communicate(stdin)
+        if cancel is None:
+            result = self._run_in_executor(args, stdin)
+            if result is not None:
+                return result
+            proc = self.open(args)
+            (out, err) = proc.communicate(stdin)
+        else:
+            cancel.check()
+            proc = self.open(args)
+            cancel.add_callback(proc.kill)
+            try:
+                (out, err) = proc.communicate(stdin)
+            finally:
+                cancel.remove_callback(proc.kill)
+            cancel.check()
         out = self._decode(out)
         err = self._decode(err)
         return (proc.returncode, out, err)
 
+    def _run_in_executor(self, args, stdin):
+        """Run a command through the helper, if there is one and the
+        command is one it runs.
+
+        Returns:
+            The same as run(), None if the command was not run in the
+            helper. If the helper fails it is not used again.
+
+        Raises:
+            OSError: If the command could not be started, or if the helper
+                     failed after being given the command, which may have
+                     run. Callers handle it like a failed Popen.
+        """
+        helper = self.executor
+        if helper is None or \
+                os.path.basename(args[0]) not in _EXECUTOR_PROGRAMS or \
+                not (stdin is None or isinstance(stdin, bytes)):
+            return None
+        self.log.debug('Executing in helper: %s', format_args(args))
+        try:
+            code, out, err = helper.run(
+                [self._encode(arg) for arg in args], stdin)
+        except OSError as e:
+            msg = 'Unable to run "{}", because: {}'.format(args[0],
+                                                            e.strerror)
+            raise OSError(e.errno, msg)
+        except executor.ExecutorError as e:
+            self.log.warning('%s, starting commands directly', e)
+            self.executor = None
+            if e.sent:
+                # Running it again could apply it twice
+                msg = 'Unable to run "{}", because: {}'.format(args[0], e)
+                raise OSError(errno.EIO, msg)
+            return None
+        self._count_fork(args)
+        return (code, self._decode(out), self._decode(err))
+
+    def _count_fork(self, args):
+        with self.fork_counts_lock:
+            self.fork_counts[os.path.basename(args[0])] += 1
+
     def run_get_exit(self, args, stdin=None):
         """Simple wrapper for cmd.run to execute and return exit code only.
         """
         code, __, __ = self.run(args, stdin)
         return code
 
-    def run_assert_ok(self, args, stdin=None):
+    def run_assert_ok(self, args, stdin=None, cancel=None):
         """Wrapper for cmd.run that checks return code.
 
         uses cmd.run internally and raises error if exit code is not zero.
@@ -191,7 +290,7 @@ class Proc(object):
             RuntimeError: When exit code of command is not zero.
             Same exceptions as cmd.run.
         """
-        (code, stdout, stderr) = self.run(args, stdin)
+        (code, stdout, stderr) = self.run(args, stdin, cancel)
         if code != 0:
             msg = u'"{}" exited with code {}\nstderr: {}\n\nstdout: {}'.format(
                 format_args(args), code, stderr, stdout)
@@ -277,17 +376,60 @@ class ProcManager(object):
     def get_procs_by_name(self, name, include_self=True):
         """Get a list of all processes with a given name.
 
+        On Linux the names are read from /proc, elsewhere, or if that
+        fails, every process is looked at through psutil.
+
         Args:
             name: A string to match against process names.
             include_self: if False the current process will not be included
                           even if it matches name.
 
         """
+        procs = None
+        if platform.system() == 'Linux':
+            procs = self._get_procs_by_comm(name)
+        if procs is None:
+            procs = self._get_procs_by_psutil(name)
+        if not include_self:
+            procs = [p for p in procs if p.pid != os.getpid()]
+        return procs
+
+    def _get_procs_by_psutil(self, name):
+        return [p for p in psutil.process_iter() if get_proc_name(p) == name]
+
+    def _get_procs_by_comm(self, name):
+        """Find processes by reading /proc/<pid>/comm, without building a
+        psutil Process for those that do not match.
+
+        comm holds the first _COMM_MAX bytes of the name, so a name that
+        long or longer is only a candidate, confirmed through psutil.
+
+        Returns:
+            A list of psutil Processes, None if /proc can not be read.
+        """
+        wanted = name.encode(sys.getfilesystemencoding() or 'utf-8')
+        truncated = len(wanted) >= _COMM_MAX
+        wanted = wanted[:_COMM_MAX] + b'\n'
+        try:
+            entries = os.listdir(_PROC_DIR)
+        except OSError as e:
+            self.log.debug('Can not list %s: %s', _PROC_DIR, e)
+            return None
         procs = []
-        for p in psutil.process_iter():
-            if (get_proc_name(p) == name and
-               (os.getpid() != p.pid or include_self)):
-                procs.append(p)
+        for entry in entries:
+            if not entry.isdigit():
+                continue
+            try:
+                with io.open(os.path.join(_PROC_DIR, entry, 'comm'),
+                             'rb') as f:
+                    if f.read() != wanted:
+                        continue
+                p = psutil.Process(int(entry))
+                if truncated and get_proc_name(p) != name:
+                    continue
+            except (IOError, OSError, psutil.Error):
+                continue  # Exited while looking
+            procs.append(p)
         return procs
 
     def kill_procs_by_name(self, name, timeout=3):
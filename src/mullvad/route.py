@@ -379,6 +379,40 @@ class RouteManager:
             proc.run_assert_ok(command)
 
 
+class PolicyRoutes(object):
+    """A default route in a routing table of its own, used for traffic from
+    one source address only. Lets several tunnels route side by side
+    without touching the main routing table. Linux only."""
+    def __init__(self, table):
+        self.log = logger.create_logger(self.__class__.__name__)
+        self.table = str(table)
+        self.source = None
+
+    def set(self, source, gateway):
+        """Route traffic from source through gateway."""
+        self._flush()
+        proc.run_assert_ok(['ip', 'route', 'replace', 'default',
+                            'via', gateway, 'table', self.table])
+        proc.run_assert_ok(['ip', 'rule', 'add', 'from', source,
+                            'lookup', self.table])
+        self.source = source
+        self.log.debug('Routing %s via %s in table %s', source, gateway,
+                       self.table)
+
+    def clear(self):
+        """Remove the routes and rules added by set(), if any."""
+        if self.source is not None:
+            self._flush()
+            self.source = None
+
+    def _flush(self):
+        # Also removes what a crashed earlier run left behind
+        proc.run(['ip', 'route', 'flush', 'table', self.table])
+        while proc.run_get_exit(['ip', 'rule', 'del',
+                                 'lookup', self.table]) == 0:
+            pass
+
+
 def _find_default_gateway_mac(routing_table):
     for line in routing_table.split('\n'):
         columns = line.split()
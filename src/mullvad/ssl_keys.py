@@ -5,17 +5,48 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import base64
+import binascii
+import calendar
+import hashlib
+import json
 import os
+import re
 import shutil
+import threading
+import time
 
 from mullvad import logger
 from mullvad import paths
+from mullvad import util
 
 # Controls both <installdir>/ssl and <confdir>/ssl
 _SSL_KEY_DIR = 'ssl'
 
 _CA_CERT = 'ca.crt'
 _MASTER_CERT = 'master.mullvad.net.crt'
+_VERIFICATION_CACHE = 'verified.json'
+
+# Certificates this close to expiry are verified again and renewed
+CERT_RENEW_MARGIN = 14 * 24 * 3600
+
+# Algorithms a client key can be generated with. 'ec' means ECDSA using
+# the P-256 curve.
+KEY_ALGORITHMS = ('rsa', 'ec', 'ed25519')
+
+# DER encoded OIDs of the public key algorithms in KEY_ALGORITHMS
+_KEY_ALGORITHM_OIDS = {
+    b'\x2a\x86\x48\x86\xf7\x0d\x01\x01\x01': 'rsa',  # rsaEncryption
+    b'\x2a\x86\x48\xce\x3d\x02\x01': 'ec',  # id-ecPublicKey
+    b'\x2b\x65\x70': 'ed25519',  # id-Ed25519
+}
+
+# Indexes into the TBSCertificate fields after the version
+_VALIDITY = 3
+_SUBJECT_PUBLIC_KEY_INFO = 5
+
+_PEM_CERT_REGEX = re.compile(
+    r'-----BEGIN CERTIFICATE-----(.+?)-----END CERTIFICATE-----', re.DOTALL)
 
 
 class SSLKeys:
@@ -25,6 +56,9 @@ class SSLKeys:
             conf_dir = paths.get_config_dir()
         self.ssl_dir = os.path.join(conf_dir, _SSL_KEY_DIR)
         paths.create_dir(self.ssl_dir)
+        self.verification_cache = VerificationCache(
+            os.path.join(self.ssl_dir, _VERIFICATION_CACHE))
+        self.pool_lock = threading.Lock()
 
     def get_client_cert_path(self, customerId):
         """Client cert file path."""
@@ -38,6 +72,59 @@ class SSLKeys:
         """Client key file path."""
         return os.path.join(self.ssl_dir, '%d.key' % customerId)
 
+    def get_pooled_key_path(self, customerId, algorithm):
+        """Pre-generated client key, waiting to be taken into use."""
+        return os.path.join(self.ssl_dir,
+                            '%d.next.%s.key' % (customerId, algorithm))
+
+    def get_pooled_signing_request_path(self, customerId, algorithm):
+        """Signing request belonging to the pre-generated client key."""
+        return os.path.join(self.ssl_dir,
+                            '%d.next.%s.csr' % (customerId, algorithm))
+
+    def has_pooled_key(self, customerId, algorithm):
+        return (os.path.exists(
+                    self.get_pooled_key_path(customerId, algorithm)) and
+                os.path.exists(
+                    self.get_pooled_signing_request_path(customerId,
+                                                         algorithm)))
+
+    def take_pooled_key(self, customerId, algorithm):
+        """Make the pre-generated key and signing request the client's.
+
+        Returns:
+            True if there was a pre-generated pair, False otherwise.
+        """
+        with self.pool_lock:
+            if not self.has_pooled_key(customerId, algorithm):
+                return False
+            try:
+                util.replace_file(
+                    self.get_pooled_signing_request_path(customerId,
+                                                         algorithm),
+                    self.get_client_signing_request_path(customerId))
+                util.replace_file(
+                    self.get_pooled_key_path(customerId, algorithm),
+                    self.get_client_key_path(customerId))
+            except OSError as e:
+                self.log.error('Could not use pre-generated key: %s', e)
+                return False
+        return True
+
+    def add_pooled_key(self, customerId, algorithm, key_path, csr_path):
+        """Move a freshly generated key and signing request into the pool.
+
+        The key is made readable by the owner only before it is moved.
+        """
+        os.chmod(key_path, 0o600)
+        with self.pool_lock:
+            util.replace_file(csr_path,
+                              self.get_pooled_signing_request_path(
+                                  customerId, algorithm))
+            util.replace_file(key_path,
+                              self.get_pooled_key_path(customerId,
+                                                       algorithm))
+
     def get_ca_cert_path(self):
         """Returns the absolute path to the CA cert. Will be located
         in the users config dir, copied from installation if not existing"""
@@ -57,3 +144,165 @@ class SSLKeys:
             self.log.info("Installing ssl certificate: %s -> %s", src, path)
             shutil.copyfile(src, path)
         return path
+
+
+def get_newkey_options(algorithm):
+    """Return the 'openssl req' options creating a key of the given
+    algorithm, one of KEY_ALGORITHMS."""
+    if algorithm == 'rsa':
+        return ['-newkey', 'rsa:2048']
+    elif algorithm == 'ec':
+        return ['-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:P-256']
+    elif algorithm == 'ed25519':
+        return ['-newkey', 'ed25519']
+    raise ValueError('Unknown key algorithm: {}'.format(algorithm))
+
+
+class VerificationCache(object):
+    """Remember successful certificate checks.
+
+    A check is identified by its name and the content of every file taking
+    part in it, e.g. a certificate and the CA it was verified against.
+    Changing any of the files therefore invalidates the result. Results for
+    certificates close to their expiry are not used.
+    """
+    def __init__(self, path):
+        self.log = logger.create_logger(self.__class__.__name__)
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = self._load()
+
+    def is_verified(self, check, *contents):
+        entry = self.entries.get(self._key(check, contents))
+        if entry is None:
+            return False
+        not_after = entry.get('not_after')
+        return not_after is None or \
+            not_after - time.time() > CERT_RENEW_MARGIN
+
+    def set_verified(self, check, not_after, *contents):
+        """Store a successful check.
+
+        Args:
+            check: Name of the check, e.g. 'verify'.
+            not_after: Expiry time of the checked certificate as seconds
+                       since the epoch, None if unknown.
+            contents: The content of the files that took part in the check.
+        """
+        with self.lock:
+            self.entries[self._key(check, contents)] = {
+                'not_after': not_after,
+                'checked': int(time.time()),
+            }
+            self._prune()
+            self._save()
+
+    def _key(self, check, contents):
+        digest = hashlib.sha256()
+        for content in contents:
+            digest.update(hashlib.sha256(content).digest())
+        return '{}:{}'.format(check, digest.hexdigest())
+
+    def _prune(self):
+        """Drop expired entries, they can never be used again."""
+        now = time.time()
+        for key, entry in self.entries.items():
+            not_after = entry.get('not_after')
+            if not_after is not None and not_after < now:
+                del self.entries[key]
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                entries = json.load(f)
+        except (IOError, ValueError) as e:
+            self.log.warning('Ignoring unreadable %s: %s', self.path, e)
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return entries
+
+    def _save(self):
+        try:
+            util.write_atomically(self.path, json.dumps(self.entries))
+        except (IOError, OSError) as e:
+            self.log.error('Could not write %s: %s', self.path, e)
+
+
+def get_cert_not_after(cert_data):
+    """Return the expiry time of a PEM certificate in seconds since the
+    epoch, or None if it can not be parsed.
+
+    Only the DER elements of the certificate body are parsed, which avoids
+    running openssl for it.
+    """
+    try:
+        der, fields = _tbs_certificate_fields(cert_data)
+        __, start, __ = fields[_VALIDITY]
+        __, __, pos = _der_element(der, start)  # notBefore
+        tag, start, end = _der_element(der, pos)  # notAfter
+        return _der_time(tag, der[start:end])
+    except (IndexError, ValueError, TypeError, binascii.Error):
+        return None
+
+
+def get_cert_key_algorithm(cert_data):
+    """Return the KEY_ALGORITHMS name of the public key in a PEM
+    certificate, or None if unknown or if it can not be parsed."""
+    try:
+        der, fields = _tbs_certificate_fields(cert_data)
+        __, start, __ = fields[_SUBJECT_PUBLIC_KEY_INFO]
+        __, start, __ = _der_element(der, start)  # AlgorithmIdentifier
+        tag, start, end = _der_element(der, start)  # algorithm
+        if tag != 0x06:  # OBJECT IDENTIFIER
+            return None
+        return _KEY_ALGORITHM_OIDS.get(der[start:end])
+    except (IndexError, ValueError, TypeError, binascii.Error):
+        return None
+
+
+def _tbs_certificate_fields(cert_data):
+    """Return the DER of a PEM certificate and a list of (tag, content
+    start, content end) for the fields of its TBSCertificate, starting
+    with serialNumber."""
+    match = _PEM_CERT_REGEX.search(cert_data)
+    if match is None:
+        raise ValueError('No PEM certificate found')
+    der = base64.b64decode(''.join(match.group(1).split()))
+    __, start, __ = _der_element(der, 0)  # Certificate
+    __, pos, end = _der_element(der, start)  # TBSCertificate
+    fields = []
+    while pos < end:
+        field = _der_element(der, pos)
+        pos = field[2]
+        fields.append(field)
+    if fields and fields[0][0] == 0xa0:
+        # Explicit version, absent in v1 certificates
+        fields.pop(0)
+    return der, fields
+
+
+def _der_element(der, pos):
+    """Return (tag, content start, content end) of the DER element at pos."""
+    tag = ord(der[pos])
+    length = ord(der[pos + 1])
+    pos += 2
+    if length & 0x80:
+        num_bytes = length & 0x7f
+        length = int(binascii.hexlify(der[pos:pos + num_bytes]), 16)
+        pos += num_bytes
+    if pos + length > len(der):
+        raise ValueError('Truncated DER element')
+    return tag, pos, pos + length
+
+
+def _der_time(tag, value):
+    if tag == 0x17:  # UTCTime, YYMMDDHHMMSSZ
+        year = int(value[:2])
+        # RFC 5280: 50-99 means 19xx, 00-49 means 20xx
+        value = ('19' if year >= 50 else '20') + value
+    elif tag != 0x18:  # GeneralizedTime, YYYYMMDDHHMMSSZ
+        raise ValueError('Not a DER time: {}'.format(tag))
+    return calendar.timegm(time.strptime(value[:14], '%Y%m%d%H%M%S'))
@@ -0,0 +1,128 @@
+#!/usr/bin/env python2
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import socket
+
+import ipaddr
+import netifaces
+
+from mullvad import logger
+from mullvad import openvpn_management
+from mullvad import proc
+from mullvad import util
+
+"""A second OpenVPN, connected but unused, to fail over to."""
+
+_STOP_TIMEOUT = 3
+
+
+def get_tunnel_gateway(local_ip):
+    """Return the address to route through for the tunnel interface that
+    has local_ip, None if there is no such interface.
+
+    Point-to-point interfaces know their peer. For other interfaces the
+    first address of the subnet is used, which is where OpenVPN puts the
+    server with 'topology subnet'.
+    """
+    for interface in netifaces.interfaces():
+        for address in netifaces.ifaddresses(interface).get(
+                netifaces.AF_INET, []):
+            if address.get('addr') != local_ip:
+                continue
+            if address.get('peer'):
+                return address['peer']
+            if address.get('netmask'):
+                network = ipaddr.IPv4Network(
+                    '{}/{}'.format(local_ip, address['netmask']))
+                return str(network.network + 1)
+    return None
+
+
+class StandbyTunnel(object):
+    """An OpenVPN process connected to a backup server without any routes.
+
+    The process is started with --management-hold and released as soon as
+    the management client connects, like the primary one. Once ready the
+    caller can take over the process and its management client with
+    release().
+    """
+    def __init__(self, server, management):
+        """
+        Args:
+            server: ServerInfo of the backup server.
+            management: A ManagementClient for the management port the
+                        standby OpenVPN is started with.
+        """
+        self.log = logger.create_logger(self.__class__.__name__)
+        self.server = server
+        self.management = management
+        self.management.add_listener(self._on_management_event)
+        self.process = None
+
+    def start(self, command):
+        self.log.info('Starting standby tunnel to %s', self.server.address)
+        self.process = proc.open(command, stream_target=None)
+        self.management.attach()
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def is_ready(self):
+        """True if the standby OpenVPN is connected to its server."""
+        if not self.is_alive():
+            return False
+        state = self.management.state
+        return state is not None and state.state == 'CONNECTED'
+
+    def wait_until_ready(self, timeout):
+        util.poll(lambda: self.is_alive() and not self.is_ready(), 0.1,
+                  timeout)
+        return self.is_ready()
+
+    def gateway(self):
+        """Return the address to route through to use the standby tunnel."""
+        state = self.management.state
+        if state is None or not state.local_ip:
+            return None
+        return get_tunnel_gateway(state.local_ip)
+
+    def release(self):
+        """Hand over the OpenVPN process and its management client.
+
+        Returns:
+            A tuple of (process, management client). The standby is empty
+            afterwards.
+        """
+        self.management.remove_listener(self._on_management_event)
+        process, management = self.process, self.management
+        self.process = None
+        self.management = None
+        return process, management
+
+    def stop(self):
+        """Stop the standby OpenVPN and leave the management client
+        detached. The standby is empty afterwards."""
+        if self.management is None:
+            return
+        self.management.remove_listener(self._on_management_event)
+        if self.is_alive():
+            try:
+                self.management.command('signal SIGINT',
+                                        timeout=_STOP_TIMEOUT)
+            except socket.error as e:
+                self.log.debug('Stopping standby via management failed: %s',
+                               e)
+            util.poll(self.is_alive, 0.1, _STOP_TIMEOUT)
+            if self.is_alive():
+                self.process.terminate()
+        self.management.detach()
+        self.process = None
+        self.management = None
+
+    def _on_management_event(self, event):
+        if isinstance(event, openvpn_management.HoldEvent):
+            self.management.send('hold release')
@@ -0,0 +1,120 @@
+#!/usr/bin/env python2
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import collections
+import sys
+import threading
+
+from mullvad import logger
+
+"""Run a few dependent steps concurrently on a bounded number of threads."""
+
+_Task = collections.namedtuple('_Task', 'name func deps rollback')
+
+
+class TaskGraph(object):
+    """A set of named tasks and the tasks each of them depends on.
+
+    A task starts once all its dependencies have finished, on one of at
+    most max_workers threads. If a task raises, no further tasks are
+    started, the running ones are cancelled and waited for and the
+    rollbacks of every finished task are run, in the reverse order the
+    tasks finished in, before the exception is raised again by run().
+    """
+    def __init__(self, max_workers=3):
+        self.log = logger.create_logger(self.__class__.__name__)
+        self.max_workers = max_workers
+        self.tasks = collections.OrderedDict()
+
+    def add(self, name, func, deps=(), rollback=None):
+        """Add a task.
+
+        Args:
+            name: Unique name of the task.
+            func: Called without arguments. The return value is stored as
+                  the result of the task.
+            deps: Names of tasks that must finish before this one starts.
+                  They must already have been added.
+            rollback: If given, called with the result of the task to undo
+                      it if another task fails.
+        """
+        assert name not in self.tasks, name
+        for dep in deps:
+            assert dep in self.tasks, dep
+        self.tasks[name] = _Task(name, func, tuple(deps), rollback)
+
+    def run(self, cancel=None):
+        """Run all tasks and return a dict with the result of each.
+
+        Args:
+            cancel: If given, the CancelToken the tasks stop on, which is
+                    cancelled as soon as a task fails.
+        """
+        results = {}
+        finished = []  # Names in the order the tasks finished in
+        running = set()
+        failure = []  # exc_info of the first failure
+        cond = threading.Condition()
+
+        def work(task):
+            try:
+                result = task.func()
+            except Exception:
+                with cond:
+                    first = not failure
+                    if first:
+                        failure.append(sys.exc_info())
+                # Still counted as running, for run() not to return before
+                # the others are told to stop
+                if first and cancel is not None:
+                    self.log.debug('%s failed, cancelling the others',
+                                   task.name)
+                    cancel.cancel()
+                with cond:
+                    running.discard(task.name)
+                    cond.notify()
+                return
+            with cond:
+                results[task.name] = result
+                finished.append(task.name)
+                running.discard(task.name)
+                cond.notify()
+
+        pending = list(self.tasks.values())
+        with cond:
+            while True:
+                if not failure:
+                    for task in list(pending):
+                        if len(running) >= self.max_workers:
+                            break
+                        if all(dep in results for dep in task.deps):
+                            pending.remove(task)
+                            running.add(task.name)
+                            thread = threading.Thread(target=work,
+                                                      args=(task,))
+                            thread.daemon = True
+                            thread.start()
+                if not running and (failure or not pending):
+                    break
+                cond.wait()
+
+        if failure:
+            self._rollback(finished, results)
+            exc_type, exc_value, exc_tb = failure[0]
+            raise exc_type, exc_value, exc_tb
+        return results
+
+    def _rollback(self, finished, results):
+        for name in reversed(finished):
+            task = self.tasks[name]
+            if task.rollback is None:
+                continue
+            self.log.debug('Rolling back %s', name)
+            try:
+                task.rollback(results[name])
+            except Exception as e:
+                self.log.error('Rollback of %s failed: %s', name, e)
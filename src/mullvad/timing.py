@@ -0,0 +1,143 @@
+#!/usr/bin/env python2
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import collections
+import contextlib
+import threading
+
+from mullvad import util
+
+"""Measure where the time goes while connecting."""
+
+_HISTOGRAM_SIZE = 100  # Connects kept per phase
+
+
+class ConnectTiming(object):
+    """Monotonic timestamps of the phases of one connect attempt.
+
+    Phases are timed with begin() and end(), or phase(), or marked as the
+    moment something happened with mark(). All may be used from several
+    threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = util.monotonic()
+        self.started = {}  # name -> start of phases not yet ended
+        self.phases = collections.OrderedDict()  # name -> (start, end)
+
+    def begin(self, name):
+        with self.lock:
+            self.started[name] = util.monotonic()
+
+    def end(self, name):
+        now = util.monotonic()
+        with self.lock:
+            start = self.started.pop(name, None)
+            if start is not None:
+                self.phases[name] = (start, now)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end(name)
+
+    def timed(self, name, func):
+        """Return a function calling func inside phase(name)."""
+        def wrapper(*args, **kwargs):
+            with self.phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def mark(self, name):
+        """Record that name happened now, unless it already has."""
+        now = util.monotonic()
+        with self.lock:
+            if name not in self.phases:
+                self.phases[name] = (now, now)
+
+    def record(self, result):
+        """Return the timing as a dict suitable for logging as JSON.
+
+        Offsets and durations are given in seconds, offsets are relative to
+        the start of the connect attempt. Phases that never ended, e.g.
+        because of an error, have the duration None.
+        """
+        with self.lock:
+            phases = [(name, start, end)
+                      for name, (start, end) in self.phases.items()]
+            phases += [(name, start, None)
+                       for name, start in self.started.items()]
+        phases.sort(key=lambda (name, start, end): start)
+        return {
+            'result': result,
+            'total': round(util.monotonic() - self.start, 4),
+            'phases': collections.OrderedDict(
+                (name, {'offset': round(start - self.start, 4),
+                        'duration': (None if end is None
+                                     else round(end - start, 4))})
+                for name, start, end in phases),
+        }
+
+
+class PhaseHistograms(object):
+    """Rolling distributions of how long each phase took, over the last
+    size connect attempts that went through it.
+
+    The number of samples and their sum are also kept since the start,
+    these only grow, as counters should.
+    """
+    def __init__(self, size=_HISTOGRAM_SIZE):
+        self.lock = threading.Lock()
+        self.size = size
+        self.samples = {}  # name -> deque of durations
+        self.totals = {}  # name -> [count, sum] of every duration
+
+    def add(self, record):
+        """Add a record returned by ConnectTiming.record()."""
+        with self.lock:
+            durations = dict((name, phase['duration'])
+                             for name, phase in record['phases'].items()
+                             if phase['duration'] is not None)
+            durations['total'] = record['total']
+            for name, duration in durations.items():
+                samples = self.samples.setdefault(
+                    name, collections.deque(maxlen=self.size))
+                samples.append(duration)
+                totals = self.totals.setdefault(name, [0, 0.0])
+                totals[0] += 1
+                totals[1] += duration
+
+    def stats(self):
+        """Return a dict from phase name to a dict with count, min, mean,
+        median, p90 and max of its duration in seconds over the window, and
+        total_count and total_sum since the start."""
+        with self.lock:
+            samples = dict((name, sorted(durations))
+                           for name, durations in self.samples.items())
+            totals = dict((name, list(total))
+                          for name, total in self.totals.items())
+        stats = {}
+        for name, durations in samples.items():
+            stats[name] = _summarize(durations)
+            stats[name]['total_count'], stats[name]['total_sum'] = \
+                totals[name]
+        return stats
+
+
+def _summarize(durations):
+    count = len(durations)
+    return {
+        'count': count,
+        'min': durations[0],
+        'mean': sum(durations) / count,
+        'median': durations[(count - 1) // 2],
+        'p90': durations[min(count - 1, int(count * 0.9))],
+        'max': durations[-1],
+    }
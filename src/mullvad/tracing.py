@@ -0,0 +1,161 @@
+#!/usr/bin/env python2
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import collections
+import json
+import threading
+import time
+
+from mullvad import logger
+
+"""Trace calls from TunnelController to TunnelProcess and analyze them.
+
+Every call is split into four spans, all measured with util.monotonic(),
+which is comparable between processes on the same host:
+
+    enqueue   waiting for TunnelController.call_lock
+    dispatch  writing the request until TunnelProcess has read it
+    execute   running the Tunnel method in TunnelProcess
+    reply     writing the reply until TunnelController has read it
+
+Each span is written as one JSON line with the keys id, method, span,
+start and duration, start being relative to the start of the call.
+"""
+
+SPANS = ('enqueue', 'dispatch', 'execute', 'reply')
+
+
+class RequestTracer(object):
+    """Writes span records to a JSON-lines file."""
+    def __init__(self, path):
+        self.log = logger.create_logger(self.__class__.__name__)
+        self.path = path
+        self.lock = threading.Lock()
+
+    def trace(self, request_id, method, timestamps):
+        """Write the spans of one call.
+
+        Args:
+            request_id: The id carried in the request and reply messages.
+            method: Name of the Tunnel method called.
+            timestamps: Monotonic times with the keys called, locked, received,
+                        executed and replied, the last three as reported by
+                        TunnelProcess, and the wall clock time wall.
+        """
+        start = timestamps['called']
+        bounds = [timestamps[k] for k in
+                  ('called', 'locked', 'received', 'executed', 'replied')]
+        lines = []
+        for span, begin, end in zip(SPANS, bounds, bounds[1:]):
+            lines.append(json.dumps({
+                'id': request_id,
+                'method': method,
+                'span': span,
+                'time': timestamps['wall'],
+                'start': round(begin - start, 6),
+                'duration': round(end - begin, 6),
+            }))
+        try:
+            with self.lock:
+                with open(self.path, 'a') as f:
+                    f.write('\n'.join(lines) + '\n')
+        except IOError as e:
+            self.log.error('Could not write %s: %s', self.path, e)
+
+
+def load(path):
+    """Return the calls in a trace file as a dict from request id to a dict
+    with the method and the duration of each span."""
+    calls = collections.OrderedDict()
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # A line cut short by a crash
+            call = calls.setdefault(
+                (record['time'], record['id']),
+                {'id': record['id'], 'method': record['method'],
+                 'time': record['time'], 'spans': {}})
+            call['spans'][record['span']] = record['duration']
+    return calls.values()
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+
+def analyze(calls, longest=10):
+    """Summarize calls returned by load().
+
+    Returns:
+        A tuple of a dict from method name to latency statistics in
+        seconds, and a list of the calls that waited longest on call_lock.
+    """
+    by_method = collections.defaultdict(lambda: collections.defaultdict(list))
+    for call in calls:
+        spans = call['spans']
+        if any(span not in spans for span in SPANS):
+            continue
+        durations = by_method[call['method']]
+        for span in SPANS:
+            durations[span].append(spans[span])
+        durations['total'].append(sum(spans.values()))
+
+    stats = {}
+    for method, durations in by_method.items():
+        stats[method] = {}
+        for span, values in durations.items():
+            values.sort()
+            stats[method][span] = {
+                'count': len(values),
+                'p50': percentile(values, 0.5),
+                'p90': percentile(values, 0.9),
+                'p99': percentile(values, 0.99),
+                'max': values[-1],
+            }
+
+    waits = sorted((c for c in calls if 'enqueue' in c['spans']),
+                   key=lambda c: c['spans']['enqueue'], reverse=True)
+    return stats, waits[:longest]
+
+
+def format_report(stats, waits):
+    lines = ['{:<28} {:>6} {:>9} {:>9} {:>9} {:>9}'.format(
+        'method (ms)', 'calls', 'p50', 'p90', 'p99', 'max')]
+    for method in sorted(stats, key=lambda m: -stats[m]['total']['p90']):
+        for span in ('total',) + SPANS:
+            s = stats[method][span]
+            name = method if span == 'total' else '  ' + span
+            lines.append('{:<28} {:>6} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}'
+                         .format(name, s['count'], s['p50'] * 1000,
+                                 s['p90'] * 1000, s['p99'] * 1000,
+                                 s['max'] * 1000))
+    lines.append('')
+    lines.append('Longest waits on call_lock:')
+    for call in waits:
+        lines.append('  {:>9.2f} ms  {} #{} at {}'.format(
+            call['spans']['enqueue'] * 1000, call['method'], call['id'],
+            time.strftime('%Y-%m-%d %H:%M:%S',
+                          time.localtime(call['time']))))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Report latencies from a request trace file.')
+    parser.add_argument('trace', help='JSON-lines trace file')
+    parser.add_argument('--longest', type=int, default=10,
+                        help='Number of longest call_lock waits to list')
+    args = parser.parse_args()
+    stats, waits = analyze(load(args.trace), args.longest)
+    print(format_report(stats, waits))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python2
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import collections
+
+from mullvad import util
+
+_DEFAULT_WINDOW = 5  # Seconds
+
+
+class TrafficMeter(object):
+    """Turn the running byte counts reported by OpenVPN into traffic totals
+    and rates averaged over a rolling window."""
+
+    def __init__(self, window=_DEFAULT_WINDOW):
+        self.window = window
+        self.samples = collections.deque()  # (time, rx, tx)
+
+    def reset(self):
+        self.samples.clear()
+
+    def add(self, rx, tx, now=None):
+        """Add a sample of the total number of bytes received and sent."""
+        if now is None:
+            now = util.monotonic()
+        if self.samples and (rx < self.samples[-1][1] or
+                             tx < self.samples[-1][2]):
+            # The counters restarted, e.g. a new OpenVPN process
+            self.samples.clear()
+        self.samples.append((now, rx, tx))
+        # Keep the oldest sample that covers the whole window
+        while (len(self.samples) > 2 and
+               now - self.samples[1][0] >= self.window):
+            self.samples.popleft()
+
+    def stats(self):
+        """Return a dict with rx_total and tx_total in bytes and rx_rate and
+        tx_rate in bytes per second."""
+        if not self.samples:
+            return dict(rx_total=0, tx_total=0, rx_rate=0.0, tx_rate=0.0)
+        first_time, first_rx, first_tx = self.samples[0]
+        last_time, last_rx, last_tx = self.samples[-1]
+        elapsed = last_time - first_time
+        if elapsed > 0:
+            rx_rate = (last_rx - first_rx) / elapsed
+            tx_rate = (last_tx - first_tx) / elapsed
+        else:
+            rx_rate = tx_rate = 0.0
+        return dict(rx_total=last_rx, tx_total=last_tx,
+                    rx_rate=rx_rate, tx_rate=tx_rate)
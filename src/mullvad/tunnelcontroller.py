@@ -7,14 +7,18 @@ from __future__ import unicode_literals
 
 import json
 import os
+import itertools
 import pickle
 import threading
+import time
 
 from mullvad import logger
 from mullvad import mtunnel
 from mullvad import netstring
 from mullvad import paths
 from mullvad import proc
+from mullvad import tracing
+from mullvad import util
 
 
 REQUEST_PIPE = 'request_pipe'
@@ -23,14 +27,27 @@ UPDATE_PIPE = 'update_pipe'
 
 
 class TunnelController(threading.Thread):
-    def __init__(self, pipe_dir):
+    def __init__(self, pipe_dir, trace_path=None):
+        """Start the tunnel process and the thread receiving its updates.
+
+        Args:
+            pipe_dir: Directory with the request, reply and update pipes.
+            trace_path: If given, the spans of every call are appended to
+                        this JSON-lines file, see the tracing module.
+        """
         super(TunnelController, self).__init__()
         self.log = logger.create_logger(self.__class__.__name__)
         self.call_lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+        self.tracer = None
+        if trace_path is not None:
+            self.tracer = tracing.RequestTracer(trace_path)
         self.running = True
         self.connection_listeners = []
         self.server_listeners = []
         self.error_listeners = []
+        self.throughput_listeners = []
+        self.timing_listeners = []
         self.tp = proc.open(
             ['pkexec', 'mtunnel',
              '--logdir', paths.get_log_dir(),
@@ -56,17 +73,38 @@ class TunnelController(threading.Thread):
         self.update_pipe.close()
 
     def call(self, name, *args, **kwargs):
+        called = util.monotonic()
+        wall = time.time()
         self.call_lock.acquire()
-        self.send_request(name, *args, **kwargs)
-        method, returned_name, result = self.receive_response()
+        locked = util.monotonic()
+        request_id = next(self.request_ids)
+        self.send_request(name, *args, _meta={'id': request_id,
+                                              'sent': locked}, **kwargs)
+        response = self.receive_response()
+        replied = util.monotonic()
+        method, returned_name, result = response[:3]
         if returned_name == 'destroy' and result is True:
             self.running = False
         self.call_lock.release()
+        if self.tracer is not None and len(response) > 3:
+            meta = response[3]
+            if meta.get('id') == request_id:
+                self.tracer.trace(request_id, name, {
+                    'wall': wall,
+                    'called': called,
+                    'locked': locked,
+                    'received': meta['received'],
+                    'executed': meta['executed'],
+                    'replied': replied,
+                })
         return result
 
     def send_request(self, name, *args, **kwargs):
+        """Write a request. The keyword argument _meta, if given, is sent
+        along with the request instead of being passed to the method."""
+        meta = kwargs.pop('_meta', {})
         self.log.debug('{}, {}, {}'.format(name, args, kwargs))
-        message = json.dumps(('request', name, args, kwargs))
+        message = json.dumps(('request', name, args, kwargs, meta))
         netstring.write_string(message, self.request_pipe)
         self.request_pipe.flush()
 
@@ -119,3 +157,23 @@ class TunnelController(threading.Thread):
     def update_error(self, error):
         for l in self.error_listeners:
             l(error)
+
+    def add_throughput_listener(self, listener):
+        self.throughput_listeners.append(listener)
+
+    def remove_throughput_listener(self, listener):
+        self.throughput_listeners.remove(listener)
+
+    def update_throughput(self, stats):
+        for l in self.throughput_listeners:
+            l(stats)
+
+    def add_timing_listener(self, listener):
+        self.timing_listeners.append(listener)
+
+    def remove_timing_listener(self, listener):
+        self.timing_listeners.remove(listener)
+
+    def update_timing(self, record):
+        for l in self.timing_listeners:
+            l(record)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python2
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import collections
+import os
+import platform
+import re
+import threading
+
+from mullvad import config
+from mullvad import logger
+from mullvad import mtunnel
+
+"""Run several tunnels side by side, e.g. for several accounts or servers
+on a gateway host."""
+
+_MAX_TUNNELS = 50
+_NAME_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+class TunnelManager(object):
+    """Creates, controls and reports on a set of isolated Tunnels.
+
+    Each tunnel has a name and a directory of its own under base_dir for its
+    settings, keys and server lists. It is given a TunnelInstance, so it
+    uses its own management ports, routing table and firewall chain, and is
+    routed only for traffic from its tunnel address. Settings that change
+    the whole host, like stop_dns_leaks, are ignored for these tunnels.
+    """
+    def __init__(self, base_dir):
+        if platform.system() != 'Linux':
+            raise OSError('Several tunnels are only supported on Linux')
+        self.log = logger.create_logger(self.__class__.__name__)
+        self.base_dir = base_dir
+        self.lock = threading.Lock()
+        self.tunnels = collections.OrderedDict()  # name -> Tunnel
+
+    def add(self, name, settings=None):
+        """Create a tunnel, disconnected.
+
+        Args:
+            name: Unique name of the tunnel, letters, digits, - and _ only.
+            settings: Optional dict of options to write to the settings of
+                      the tunnel, e.g. the account id and location.
+
+        Returns:
+            The new Tunnel.
+        """
+        if not _NAME_PATTERN.match(name):
+            raise ValueError('Invalid tunnel name: {}'.format(name))
+        with self.lock:
+            if name in self.tunnels:
+                raise ValueError('Tunnel {} already exists'.format(name))
+            used = set(t.instance.index for t in self.tunnels.values())
+            free = [i for i in range(1, _MAX_TUNNELS + 1) if i not in used]
+            if not free:
+                raise ValueError('At most {} tunnels'.format(_MAX_TUNNELS))
+            state_dir = os.path.join(self.base_dir, name)
+            if not os.path.isdir(state_dir):
+                os.makedirs(state_dir)
+            tunnel_settings = config.Settings(state_dir)
+            for option, value in (settings or {}).items():
+                tunnel_settings.set(option, value)
+            instance = mtunnel.TunnelInstance(free[0], state_dir)
+            tunnel = mtunnel.Tunnel(tunnel_settings, state_dir, instance)
+            self.tunnels[name] = tunnel
+        self.log.info('Added tunnel %s as instance %d', name, instance.index)
+        return tunnel
+
+    def remove(self, name):
+        """Disconnect a tunnel and stop its state machine. Its directory is
+        kept, so adding it again reuses its keys."""
+        with self.lock:
+            tunnel = self.tunnels.pop(name)
+        tunnel.shutDown()
+        tunnel.destroy()
+        self.log.info('Removed tunnel %s', name)
+
+    def get(self, name):
+        with self.lock:
+            return self.tunnels[name]
+
+    def names(self):
+        with self.lock:
+            return list(self.tunnels)
+
+    def connect(self, name):
+        self.get(name).connect()
+
+    def disconnect(self, name):
+        self.get(name).disconnect()
+
+    def connect_all(self):
+        for name in self.names():
+            self.connect(name)
+
+    def disconnect_all(self):
+        for name in self.names():
+            self.disconnect(name)
+
+    def shutdown(self):
+        """Remove every tunnel. The tunnels disconnect concurrently."""
+        with self.lock:
+            tunnels = self.tunnels.values()
+            self.tunnels.clear()
+        for tunnel in tunnels:
+            tunnel.shutDown()
+        for tunnel in tunnels:
+            tunnel.destroy()
+
+    def status(self):
+        """Return the state of every tunnel and the totals over all of them.
+
+        Returns:
+            A dict with 'tunnels', a dict from name to a dict with index,
+            state, desired_state, server and traffic of that tunnel, 'states',
+            the number of tunnels in each state, and 'traffic', the summed
+            traffic.
+        """
+        with self.lock:
+            tunnels = self.tunnels.items()
+        per_tunnel = collections.OrderedDict()
+        states = collections.Counter()
+        total = collections.Counter()
+        for name, tunnel in tunnels:
+            snapshot = tunnel.metrics()
+            per_tunnel[name] = {
+                'index': tunnel.instance.index,
+                'state': snapshot['state'],
+                'desired_state': mtunnel.ConState.names.get(
+                    tunnel.desiredConnectionState()),
+                'server': snapshot['server'],
+                'traffic': snapshot['traffic'],
+            }
+            states[snapshot['state']] += 1
+            total.update(snapshot['traffic'])
+        return {
+            'tunnels': per_tunnel,
+            'states': dict(states),
+            'traffic': dict(total),
+        }
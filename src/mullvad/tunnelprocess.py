@@ -9,14 +9,18 @@ import argparse
 import json
 import os
 import pickle
+import socket
 import sys
+import threading
 
 from mullvad import config
 from mullvad import exceptioncatcher
 from mullvad import logger
+from mullvad import metrics
 from mullvad import mtunnel
 from mullvad import netstring
 from mullvad import proc
+from mullvad import util
 
 
 REQUEST_PIPE = 'request_pipe'
@@ -42,9 +46,23 @@ class TunnelProcess(object):
         self.tunnel.add_connection_listener(self.update_connection)
         self.tunnel.add_server_listener(self.update_server)
         self.tunnel.add_error_listener(self.update_error)
+        self.tunnel.add_throughput_listener(self.update_throughput)
+        self.tunnel.add_timing_listener(self.update_timing)
         self.request_pipe = open(os.path.join(pipe_dir, REQUEST_PIPE), 'r')
         self.reply_pipe = open(os.path.join(pipe_dir, REPLY_PIPE), 'w')
         self.update_pipe = open(os.path.join(pipe_dir, UPDATE_PIPE), 'w')
+        # Updates are sent from several tunnel threads
+        self.update_lock = threading.Lock()
+        self.metrics_exporter = None
+        metrics_port = settings.getint('metrics_port')
+        if metrics_port > 0:
+            try:
+                self.metrics_exporter = metrics.MetricsExporter(
+                    self.tunnel, metrics_port)
+                self.metrics_exporter.start()
+            except socket.error as e:
+                self.log.error('Unable to serve metrics on port %d: %s',
+                               metrics_port, e)
 
     def update_connection(self, state):
         self.send_update('update_connection', state)
@@ -55,34 +73,46 @@ class TunnelProcess(object):
     def update_error(self, error):
         self.send_update('update_error', error)
 
+    def update_throughput(self, stats):
+        self.send_update('update_throughput', stats)
+
+    def update_timing(self, record):
+        self.send_update('update_timing', record)
+
     def run(self):
         done = False
         while not done:
-            meth, name, args, kwargs = self.receive_request()
+            request = self.receive_request()
+            received = util.monotonic()
+            meth, name, args, kwargs = request[:4]
+            # Requests carry an id and timestamps from TunnelController
+            meta = request[4] if len(request) > 4 else {}
             try:
                 method = getattr(self.tunnel, name)
                 result = method(*args, **kwargs)
             except Exception as e:
-                self.send_reply(name, TunnelProcessError(e))
-            else:
-                self.send_reply(name, result)
+                result = TunnelProcessError(e)
+            reply_meta = {'id': meta.get('id'), 'received': received,
+                          'executed': util.monotonic()}
+            self.send_reply(name, result, reply_meta)
             if name == 'destroy' and result is True:
                 done = True
         self.request_pipe.close()
         self.reply_pipe.close()
         self.update_pipe.close()
 
-    def send_reply(self, name, result):
+    def send_reply(self, name, result, meta=None):
         self.log.debug('{}, {}'.format(name, result))
-        message = pickle.dumps(('reply', name, result))
+        message = pickle.dumps(('reply', name, result, meta or {}))
         netstring.write_string(message, self.reply_pipe)
         self.reply_pipe.flush()
 
     def send_update(self, name, *args, **kwargs):
         self.log.debug('{}, {}, {}'.format(name, args, kwargs))
         message = pickle.dumps(('update', name, args, kwargs))
-        netstring.write_string(message, self.update_pipe)
-        self.update_pipe.flush()
+        with self.update_lock:
+            netstring.write_string(message, self.update_pipe)
+            self.update_pipe.flush()
 
     def receive_request(self):
         message = netstring.read_string(self.request_pipe)
@@ -113,6 +143,8 @@ def main_args(args):
 
     setup_file_paths()
     settings = config.Settings(directory=args.confdir)  # Using default if None
+    if settings.getboolean('command_executor'):
+        proc.use_executor()
     tp = TunnelProcess(pipe_dir, settings, args.confdir)
     tp.run()
 
@@ -5,8 +5,16 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import collections
+import ctypes
+import ctypes.util
+import errno
 import os
 import platform
+import random
+import select
+import tempfile
+import threading
 import time
 
 from mullvad import proc
@@ -25,6 +33,32 @@ def file_content(path):
         return t
 
 
+def write_atomically(path, content):
+    """Write content to path through a temporary file renamed over it.
+
+    Readers see either the old or the new content, never a part of it, and
+    of several writers at once the last one wins.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                    prefix=os.path.basename(path) + '.',
+                                    suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        replace_file(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def replace_file(src, dst):
+    """os.rename that also overwrites dst on Windows."""
+    if os.name == 'nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
 def poll(cond, interval, timeout):
     """Run a given function at a given interval until a timeout is reached.
 
@@ -39,6 +73,323 @@ def poll(cond, interval, timeout):
         time.sleep(interval)
 
 
+def _create_monotonic():
+    """Create a function reading a clock that never jumps or goes backwards.
+
+    Falls back to time.time if no such clock can be found.
+    """
+    try:
+        if platform.system() == 'Windows':
+            get_tick_count = ctypes.windll.kernel32.GetTickCount64
+            get_tick_count.restype = ctypes.c_ulonglong
+            return lambda: get_tick_count() / 1000.0
+
+        if platform.system() == 'Darwin':
+            class TimebaseInfo(ctypes.Structure):
+                _fields_ = [('numer', ctypes.c_uint32),
+                            ('denom', ctypes.c_uint32)]
+
+            libc = ctypes.CDLL(ctypes.util.find_library('c'))
+            absolute_time = libc.mach_absolute_time
+            absolute_time.restype = ctypes.c_uint64
+            timebase = TimebaseInfo()
+            libc.mach_timebase_info(ctypes.byref(timebase))
+            factor = timebase.numer / timebase.denom / 1e9
+            return lambda: absolute_time() * factor
+
+        class Timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long),
+                        ('tv_nsec', ctypes.c_long)]
+
+        library = (ctypes.util.find_library('rt') or
+                   ctypes.util.find_library('c'))
+        clock_gettime = ctypes.CDLL(library, use_errno=True).clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+        clock_monotonic = 1
+
+        def monotonic():
+            t = Timespec()
+            if clock_gettime(clock_monotonic, ctypes.byref(t)) != 0:
+                raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+            return t.tv_sec + t.tv_nsec / 1e9
+        monotonic()
+        return monotonic
+    except (AttributeError, OSError, TypeError):
+        return time.time
+
+monotonic = _create_monotonic()
+
+
+def _create_awake_clock():
+    """Create a function reading a monotonic clock that stands still while
+    the host is suspended.
+
+    This is util.monotonic except on Windows, where GetTickCount64 keeps
+    counting during sleep.
+    """
+    if platform.system() != 'Windows':
+        return monotonic
+    try:
+        query = ctypes.windll.kernel32.QueryUnbiasedInterruptTime
+        value = ctypes.c_ulonglong()
+
+        def awake_clock():
+            query(ctypes.byref(value))
+            return value.value / 1e7  # In units of 100 ns
+        awake_clock()
+        return awake_clock
+    except (AttributeError, OSError):
+        return monotonic
+
+awake_clock = _create_awake_clock()
+
+
+class Wakeup(object):
+    """Lets a thread sleep until another thread wakes it, or a timeout
+    passes.
+
+    threading.Event.wait() with a timeout polls in Python 2. Here the
+    sleeping thread is blocked in select() on a pipe instead, using no CPU
+    however long it sleeps. Windows can not select() on pipes and falls back
+    to an Event.
+    """
+    def __init__(self):
+        # Keeps wake() off a closed pipe, and from being lost between the
+        # wait and clear of the Event
+        self.lock = threading.Lock()
+        self.event = None
+        self.read_fd = self.write_fd = None
+        if platform.system() == 'Windows':
+            self.event = threading.Event()
+            return
+        import fcntl
+        self.read_fd, self.write_fd = os.pipe()
+        for fd in (self.read_fd, self.write_fd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def wake(self):
+        with self.lock:
+            if self.event is not None:
+                self.event.set()
+                return
+            if self.write_fd is None:
+                return  # Closed, nobody sleeps any more
+            try:
+                os.write(self.write_fd, b'.')
+            except OSError as e:
+                if e.errno != errno.EAGAIN:  # Full, already woken
+                    raise
+
+    def close(self):
+        """Release the pipe. Must not be called while a thread sleeps,
+        later wakeups are ignored."""
+        with self.lock:
+            for fd in (self.read_fd, self.write_fd):
+                if fd is not None:
+                    os.close(fd)
+            self.read_fd = self.write_fd = None
+
+    def wait(self, timeout=None):
+        """Sleep until woken or until timeout seconds have passed, forever
+        if timeout is None. Wakeups while not sleeping are remembered.
+
+        Returns:
+            True if woken.
+        """
+        if self.event is not None:
+            self.event.wait(timeout)
+            with self.lock:
+                woken = self.event.is_set()
+                self.event.clear()
+            return woken
+        try:
+            ready, __, __ = select.select([self.read_fd], [], [], timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return False
+        if ready:
+            self._drain()
+        return bool(ready)
+
+    def _drain(self):
+        try:
+            while os.read(self.read_fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+
+class _PeriodicTask(object):
+    def __init__(self, name, function, interval, delay, jitter,
+                 max_interval):
+        self.name = name
+        self.function = function
+        self.interval = interval
+        self.delay = interval if delay is None else delay
+        self.jitter = jitter
+        self.max_interval = max_interval
+        self.nominal = None  # Deadline without jitter
+        self.deadline = None
+        self.failures = 0  # In a row, for the backoff
+        self.stats = {'runs': 0, 'failures': 0, 'missed': 0,
+                      'last_late': 0.0, 'max_late': 0.0}
+
+
+class PeriodicScheduler(object):
+    """Runs named tasks at regular intervals of the monotonic clock.
+
+    Nothing runs on its own. The owner calls run_due() whenever it wakes up
+    and sleeps at most time_to_next() seconds in between, so it never has to
+    poll. As the clock is monotonic, setting the system clock neither delays
+    nor hurries any task.
+
+    A task returning False has failed. If the task has a max_interval, it
+    is then retried with the interval doubled for each failure in a row, up
+    to max_interval. A task started more than late_margin seconds after its
+    deadline counts as missed, and is rescheduled from now rather than run
+    again to catch up.
+    """
+    def __init__(self, late_margin=1.0, clock=monotonic):
+        self.late_margin = late_margin
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.tasks = collections.OrderedDict()  # name -> _PeriodicTask
+
+    def add(self, name, function, interval, delay=None, jitter=0.0,
+            max_interval=None):
+        """Schedule function to be run every interval seconds.
+
+        Args:
+            name: Unique name of the task, used in stats().
+            function: Called without arguments, False if it failed.
+            interval: Seconds between the runs.
+            delay: Seconds until the first run, one interval by default.
+            jitter: Every deadline is moved by a random part of the interval
+                    up to this fraction, so tasks started together spread
+                    out.
+            max_interval: Back off on failures up to this many seconds
+                          between runs. No backoff if None.
+        """
+        task = _PeriodicTask(name, function, interval, delay, jitter,
+                             max_interval)
+        with self.lock:
+            if name in self.tasks:
+                raise ValueError('Task {} already exists'.format(name))
+            self._start(task, self.clock())
+            self.tasks[name] = task
+
+    def set_interval(self, name, interval):
+        """Change the interval of a task, from its next run on."""
+        with self.lock:
+            self.tasks[name].interval = interval
+
+    def reset(self):
+        """Schedule every task as if it had just been added."""
+        with self.lock:
+            now = self.clock()
+            for task in self.tasks.values():
+                self._start(task, now)
+
+    def time_to_next(self):
+        """Return the seconds until the next task is due, None if there
+        are no tasks."""
+        with self.lock:
+            if not self.tasks:
+                return None
+            deadline = min(t.deadline for t in self.tasks.values())
+        return max(0.0, deadline - self.clock())
+
+    def run_due(self):
+        """Run every task whose deadline has passed, in the order they
+        were added.
+
+        Returns:
+            A dict from the name of each task run to what it returned.
+        """
+        with self.lock:
+            now = self.clock()
+            due = [t for t in self.tasks.values() if t.deadline <= now]
+        results = {}
+        for task in due:
+            late = self.clock() - task.deadline
+            try:
+                results[task.name] = task.function()
+            finally:
+                with self.lock:
+                    self._finish(task, late, results.get(task.name))
+        return results
+
+    def stats(self):
+        """Return a dict from task name to a dict with the number of runs,
+        failures and missed deadlines, and the last and largest number of
+        seconds a run started late."""
+        with self.lock:
+            return dict((name, dict(task.stats))
+                        for name, task in self.tasks.items())
+
+    def _start(self, task, now):
+        task.failures = 0
+        task.nominal = now + task.delay
+        task.deadline = self._jittered(task, task.nominal)
+
+    def _finish(self, task, late, result):
+        stats = task.stats
+        stats['runs'] += 1
+        stats['last_late'] = round(late, 4)
+        stats['max_late'] = max(stats['max_late'], stats['last_late'])
+        if late > self.late_margin:
+            stats['missed'] += 1
+        if result is False:
+            stats['failures'] += 1
+            task.failures += 1
+        else:
+            task.failures = 0
+        interval = task.interval
+        if task.failures and task.max_interval is not None:
+            interval = min(interval * 2 ** task.failures, task.max_interval)
+        now = self.clock()
+        task.nominal += interval
+        if task.nominal <= now:
+            task.nominal = now + interval
+        task.deadline = self._jittered(task, task.nominal)
+
+    def _jittered(self, task, deadline):
+        return deadline + task.interval * random.uniform(-task.jitter,
+                                                         task.jitter)
+
+
+class ResumeDetector(object):
+    """Tells whether the host has been suspended since the last check.
+
+    While suspended, awake_clock() stands still but the wall clock does not.
+    When the wall clock has moved more than threshold seconds further than
+    awake_clock() between two checks, the host has most likely slept. A
+    wall clock that is set forward looks the same and is reported as well.
+    """
+    def __init__(self, threshold=10, clock=awake_clock,
+                 wall_clock=time.time):
+        self.threshold = threshold
+        self.clock = clock
+        self.wall_clock = wall_clock
+        self.reset()
+
+    def reset(self):
+        """Forget any suspend before now."""
+        self.last = (self.clock(), self.wall_clock())
+
+    def check(self):
+        """Return about how many seconds the host was suspended since the
+        last check or reset, 0 if it was not."""
+        last_awake, last_wall = self.last
+        self.reset()
+        awake, wall = self.last
+        suspended = (wall - last_wall) - (awake - last_awake)
+        return suspended if suspended > self.threshold else 0
+
+
 def get_platform():
     value = unicode(platform.platform())
     if platform.system() == 'Darwin':
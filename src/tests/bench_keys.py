@@ -0,0 +1,138 @@
+#!/usr/bin/env python2
+"""Compare client key algorithms.
+
+For every algorithm in ssl_keys.KEY_ALGORITHMS this measures how long
+generating a client key and signing request takes, the way the tunnel does
+it, and how long a local TLS handshake with a client certificate takes.
+All certificates are signed by a throw-away test CA.
+
+Run from the src directory:
+
+    python2 -m tests.bench_keys [rounds]
+"""
+
+from __future__ import print_function
+
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from mullvad import ssl_keys
+
+_OPENSSL_CNF = os.path.join(os.path.dirname(ssl_keys.__file__),
+                            'openssl.cnf')
+
+
+def openssl(*args):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(('openssl',) + args, stdout=devnull,
+                              stderr=subprocess.STDOUT)
+
+
+def generate_key(algorithm, key, csr, cn):
+    """The same command as Tunnel._generate_key."""
+    openssl(*(['req', '-text', '-batch', '-days', '3650', '-nodes', '-new',
+               '-subj', '/CN=' + cn] +
+              ssl_keys.get_newkey_options(algorithm) +
+              ['-keyout', key, '-out', csr, '-config', _OPENSSL_CNF]))
+
+
+def sign(csr, ca_key, ca_cert, cert):
+    openssl('x509', '-req', '-in', csr, '-CA', ca_cert, '-CAkey', ca_key,
+            '-CAcreateserial', '-days', '1', '-out', cert)
+
+
+def create_ca(directory):
+    ca_key = os.path.join(directory, 'ca.key')
+    ca_cert = os.path.join(directory, 'ca.crt')
+    openssl('req', '-x509', '-nodes', '-subj', '/CN=Test CA', '-days', '1',
+            '-newkey', 'rsa:2048', '-keyout', ca_key, '-out', ca_cert)
+    return ca_key, ca_cert
+
+
+def bench_keygen(algorithm, directory, rounds):
+    key = os.path.join(directory, 'bench.key')
+    csr = os.path.join(directory, 'bench.csr')
+    start = time.time()
+    for __ in range(rounds):
+        generate_key(algorithm, key, csr, 'Mullvad1')
+    return (time.time() - start) / rounds
+
+
+def create_pair(algorithm, directory, name, ca_key, ca_cert):
+    key = os.path.join(directory, name + '.key')
+    csr = os.path.join(directory, name + '.csr')
+    cert = os.path.join(directory, name + '.crt')
+    generate_key(algorithm, key, csr, name)
+    sign(csr, ca_key, ca_cert, cert)
+    return key, cert
+
+
+def bench_handshake(algorithm, directory, rounds, ca_key, ca_cert):
+    server_key, server_cert = create_pair(algorithm, directory, 'server',
+                                          ca_key, ca_cert)
+    client_key, client_cert = create_pair(algorithm, directory, 'client',
+                                          ca_key, ca_cert)
+
+    server_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    server_context.load_cert_chain(server_cert, server_key)
+    server_context.load_verify_locations(ca_cert)
+    server_context.verify_mode = ssl.CERT_REQUIRED
+    client_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    client_context.load_cert_chain(client_cert, client_key)
+    client_context.load_verify_locations(ca_cert)
+    client_context.verify_mode = ssl.CERT_REQUIRED
+
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    port = listener.getsockname()[1]
+
+    def serve():
+        for __ in range(rounds):
+            conn, __ = listener.accept()
+            tls = server_context.wrap_socket(conn, server_side=True)
+            tls.recv(1)
+            tls.close()
+
+    server = threading.Thread(target=serve)
+    server.daemon = True
+    server.start()
+
+    start = time.time()
+    for __ in range(rounds):
+        tls = client_context.wrap_socket(
+            socket.create_connection(('127.0.0.1', port)))
+        tls.sendall(b'x')  # Completes the handshake on both sides
+        tls.close()
+    elapsed = time.time() - start
+    server.join()
+    listener.close()
+    return elapsed / rounds
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    directory = tempfile.mkdtemp()
+    try:
+        ca_key, ca_cert = create_ca(directory)
+        print('{:<10} {:>12} {:>14}'.format('algorithm', 'keygen (ms)',
+                                             'handshake (ms)'))
+        for algorithm in ssl_keys.KEY_ALGORITHMS:
+            keygen = bench_keygen(algorithm, directory, rounds)
+            handshake = bench_handshake(algorithm, directory, rounds,
+                                        ca_key, ca_cert)
+            print('{:<10} {:>12.1f} {:>14.1f}'.format(
+                algorithm, keygen * 1000, handshake * 1000))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python2
+"""Compare the ways of finding processes by name.
+
+Times ProcManager.get_procs_by_name with the /proc/<pid>/comm scan used on
+Linux against the psutil scan used elsewhere. Idle processes can be
+started first, to see how the two grow with the number of processes.
+
+Run from the src directory:
+
+    python2 -m tests.bench_procs [rounds] [extra processes]
+"""
+
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+import time
+
+from mullvad import proc
+
+
+def bench(function, rounds):
+    start = time.time()
+    for __ in range(rounds):
+        function()
+    return (time.time() - start) / rounds
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    extra = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    manager = proc.ProcManager()
+    with open(os.devnull, 'w') as devnull:
+        children = [subprocess.Popen(['sleep', '600'], stdout=devnull)
+                    for __ in range(extra)]
+    try:
+        print('{} processes'.format(len(os.listdir('/proc'))))
+        print('{:<20} {:>10} {:>10}'.format('name', 'comm (ms)',
+                                            'psutil (ms)'))
+        for name in ('openvpn', 'sleep', 'a-process-name-over-15'):
+            comm = bench(lambda: manager._get_procs_by_comm(name), rounds)
+            psutil = bench(lambda: manager._get_procs_by_psutil(name),
+                           rounds)
+            print('{:<20} {:>10.1f} {:>10.1f}'.format(
+                name[:20], comm * 1000, psutil * 1000))
+    finally:
+        for child in children:
+            child.kill()
+            child.wait()
+
+
+if __name__ == '__main__':
+    main()
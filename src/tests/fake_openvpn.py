@@ -0,0 +1,51 @@
+#!/usr/bin/env python2
+"""Stands in for OpenVPN in tests.
+
+Only --management and --ifconfig are understood. It listens on the given
+address and behaves like OpenVPN started with --management-hold: once the
+hold is released it reports being connected, with the local address of
+--ifconfig if given, and it exits on 'signal SIGINT'. With --stall it never
+gets past WAIT instead, like an OpenVPN that the server does not answer.
+"""
+
+import socket
+import sys
+
+_LOCAL_IP = b'10.9.0.2'
+
+
+def main(args):
+    index = args.index('--management')
+    address, port = args[index + 1], int(args[index + 2])
+    local_ip = _LOCAL_IP
+    if '--ifconfig' in args:
+        local_ip = args[args.index('--ifconfig') + 1]
+    stall = '--stall' in args
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((address, port))
+    listener.listen(1)
+    conn, __ = listener.accept()
+    conn.sendall(b'>INFO:OpenVPN Management Interface Version 1\r\n'
+                 b'>HOLD:Waiting for hold release\r\n')
+    state = b'0,WAIT,,,'
+    for line in iter(conn.makefile('rb').readline, b''):
+        command = line.strip()
+        if command == b'state':
+            conn.sendall(state + b'\r\nEND\r\n')
+            continue
+        conn.sendall(b'SUCCESS: ' + command + b'\r\n')
+        if command == b'hold release' and stall:
+            conn.sendall(b'>STATE:1,WAIT,,,\r\n')
+        elif command == b'hold release':
+            for name in (b'WAIT', b'AUTH'):
+                conn.sendall(b'>STATE:1,' + name + b',,,\r\n')
+            state = b'2,CONNECTED,SUCCESS,' + local_ip + b',1.2.3.4'
+            conn.sendall(b'>STATE:' + state + b'\r\n')
+        elif command == b'signal SIGINT':
+            break
+    conn.close()
+    listener.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,68 @@
+import unittest
+
+from mullvad import backoff
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeSettings(object):
+    def __init__(self, **values):
+        self.values = values
+
+    def getint(self, option):
+        return int(self.values[option])
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.policy = backoff.RetryPolicy(1, 60, clock=self.clock)
+
+    def test_backs_off_up_to_cap(self):
+        self.assertIsNone(self.policy.time_to_next_attempt())
+        delays = [self.policy.failed() for __ in range(30)]
+        self.assertTrue(all(1 <= d <= 60 for d in delays))
+        for previous, delay in zip(delays, delays[1:]):
+            self.assertLessEqual(delay, previous * 3)
+        self.assertAlmostEqual(self.policy.time_to_next_attempt(),
+                               delays[-1])
+        self.policy.succeeded()
+        self.assertIsNone(self.policy.time_to_next_attempt())
+
+    def test_spread_out(self):
+        delays = set()
+        for __ in range(10):
+            policy = backoff.RetryPolicy(1, 60, clock=self.clock)
+            policy.failed()
+            delays.add(policy.failed())
+        self.assertGreater(len(delays), 1)
+
+    def test_fixed_delay(self):
+        policy = backoff.RetryPolicy(5, 5, clock=self.clock)
+        self.assertEqual([policy.failed() for __ in range(3)], [5, 5, 5])
+
+    def test_network_changed(self):
+        for __ in range(5):
+            self.policy.failed()
+        self.clock.now += 0.5
+        self.policy.network_changed()
+        self.assertEqual(self.policy.time_to_next_attempt(), 0)
+        self.assertLessEqual(self.policy.failed(), 3)
+
+    def test_configure(self):
+        self.policy.configure(FakeSettings(reconnect_delay_min='5',
+                                           reconnect_delay_max='2'))
+        self.assertEqual((self.policy.base, self.policy.cap), (5, 5))
+        self.policy.configure(FakeSettings(reconnect_delay_min='5',
+                                           reconnect_delay_max='soon'))
+        self.assertEqual((self.policy.base, self.policy.cap), (1, 60))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import socket
+import threading
+import unittest
+
+from mullvad import cancel
+from mullvad import netcom
+from mullvad import proc
+from mullvad import util
+
+_MAX_ABORT_LATENCY = 0.1
+
+
+class TestCancelToken(unittest.TestCase):
+    def setUp(self):
+        self.token = cancel.CancelToken()
+        self.cancelled_at = None
+
+    def tearDown(self):
+        self.token.close()
+
+    def cancel_later(self, delay=0.05):
+        def run():
+            self.cancelled_at = util.monotonic()
+            self.token.cancel()
+        timer = threading.Timer(delay, run)
+        timer.start()
+        return timer
+
+    def assertAbortedInTime(self):
+        latency = util.monotonic() - self.cancelled_at
+        self.assertLess(latency, _MAX_ABORT_LATENCY)
+
+    def test_callbacks(self):
+        called = []
+        with cancel.registered(self.token, lambda: called.append(1)):
+            pass
+        self.token.cancel()
+        self.assertEqual(called, [])
+        self.assertRaises(cancel.Cancelled, self.token.check)
+        self.token.add_callback(lambda: called.append(2))
+        self.assertEqual(called, [2])
+
+    def test_run_kills_child(self):
+        timer = self.cancel_later()
+        self.assertRaises(cancel.Cancelled, proc.run, ['sleep', '10'],
+                          cancel=self.token)
+        self.assertAbortedInTime()
+        timer.join()
+
+    def test_abort_waiting_for_reply(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        try:
+            client = netcom.Client('127.0.0.1', listener.getsockname()[1],
+                                   timeout=10, cancel=self.token)
+            timer = self.cancel_later()
+            self.assertRaises(cancel.Cancelled, client.send, 'version')
+            self.assertAbortedInTime()
+            timer.join()
+        finally:
+            listener.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
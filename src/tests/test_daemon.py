@@ -0,0 +1,161 @@
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from mullvad import daemon
+from mullvad import mtunnel
+from mullvad import netstring
+from mullvad import traffic
+
+
+class FakeTunnel(object):
+    """Just the parts of Tunnel the daemon uses."""
+    def __init__(self):
+        self.state = mtunnel.ConState.disconnected
+        self.desired = mtunnel.ConState.disconnected
+        self.subscription_expiry = None
+        self.traffic = traffic.TrafficMeter()
+        self.connection_listeners = []
+        self.destroyed = False
+
+    def add_connection_listener(self, listener):
+        self.connection_listeners.append(listener)
+
+    def add_server_listener(self, listener):
+        pass
+
+    def add_error_listener(self, listener):
+        pass
+
+    def add_throughput_listener(self, listener):
+        pass
+
+    def add_timing_listener(self, listener):
+        pass
+
+    def connect(self):
+        self.desired = mtunnel.ConState.connected
+        self.state = mtunnel.ConState.connected
+        for listener in self.connection_listeners:
+            listener(self.state)
+
+    def shutDown(self):
+        self.desired = mtunnel.ConState.off
+
+    def destroy(self):
+        self.destroyed = True
+
+    def connectionState(self):
+        return self.state
+
+    def desiredConnectionState(self):
+        return self.desired
+
+    def serverInfo(self):
+        return None
+
+
+class Client(object):
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(5)
+        self.sock.connect(path)
+        self.rfile = self.sock.makefile('rb')
+        self.wfile = self.sock.makefile('wb')
+        self.next_id = 1
+
+    def send(self, method, *args):
+        request_id = self.next_id
+        self.next_id += 1
+        netstring.write_string(json.dumps(
+            {'id': request_id, 'method': method, 'args': list(args)}),
+            self.wfile)
+        self.wfile.flush()
+        return request_id
+
+    def receive(self):
+        return json.loads(netstring.read_string(self.rfile))
+
+    def call(self, method, *args):
+        request_id = self.send(method, *args)
+        reply = self.receive()
+        assert reply['id'] == request_id, reply
+        return reply
+
+    def close(self):
+        self.sock.close()
+
+
+class TestTunnelDaemon(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'control.sock')
+        self.tunnel = FakeTunnel()
+        self.daemon = daemon.TunnelDaemon(self.tunnel, self.path)
+        self.thread = threading.Thread(target=self.daemon.serve)
+        self.thread.start()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.daemon.shutdown()
+        self.thread.join()
+        shutil.rmtree(self.dir)
+
+    def client(self):
+        client = Client(self.path)
+        self.clients.append(client)
+        return client
+
+    def test_socket_permissions(self):
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o660)
+
+    def test_second_daemon_refused(self):
+        with self.assertRaises(daemon.AlreadyRunningError):
+            daemon.TunnelDaemon(FakeTunnel(), self.path)
+        reply = self.client().call('status')
+        self.assertEqual(reply['result']['state'], 'disconnected')
+
+    def test_stale_socket_replaced(self):
+        path = os.path.join(self.dir, 'stale.sock')
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(path)
+        stale.close()  # Never listened, as after a crash
+        self.assertFalse(daemon.is_running(path))
+        other = daemon.TunnelDaemon(FakeTunnel(), path)
+        self.assertTrue(daemon.is_running(path))
+        other.server.server_close()
+
+    def test_status(self):
+        reply = self.client().call('status')
+        self.assertEqual(reply['result']['state'], 'disconnected')
+        self.assertIsNone(reply['result']['time_left'])
+
+    def test_unknown_method(self):
+        reply = self.client().call('destroy')
+        self.assertIn('Unknown method', reply['error'])
+
+    def test_events_reach_every_subscriber(self):
+        watchers = [self.client(), self.client()]
+        for watcher in watchers:
+            self.assertEqual(watcher.call('subscribe', ['connection'])
+                             ['result'], ['connection'])
+        self.assertIsNone(self.client().call('connect')['result'])
+        for watcher in watchers:
+            self.assertEqual(watcher.receive(),
+                             {'event': 'connection', 'data': 'connected'})
+
+    def test_shutdown(self):
+        self.client().call('shutdown')
+        self.thread.join(5)
+        self.assertTrue(self.tunnel.destroyed)
+        self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import threading
+import time
+import unittest
+
+from mullvad import executor
+from mullvad import proc
+
+
+class FailingExecutor(object):
+    def run(self, args, stdin=None):
+        raise executor.ExecutorError('Helper died', True)
+
+
+class TestExecutor(unittest.TestCase):
+    def setUp(self):
+        self.executor = executor.Executor()
+
+    def tearDown(self):
+        self.executor.close()
+
+    def test_batch(self):
+        results = self.executor.run_batch([
+            (['sh', '-c', 'echo out; echo err >&2; exit 3'], None),
+            (['cat'], b'\xff\x00 bytes'),
+            (['/nonexistent/program'], None)])
+        self.assertEqual(results[0], (3, b'out\n', b'err\n'))
+        self.assertEqual(results[1], (0, b'\xff\x00 bytes', b''))
+        self.assertIsInstance(results[2], OSError)
+        self.assertRaises(OSError, self.executor.run, ['/nonexistent'])
+
+    def kill_idle_helper(self):
+        self.executor.run(['true'])
+        helper = self.executor.idle[0]
+        helper.kill()
+        helper.wait()
+
+    def test_helper_dies(self):
+        self.kill_idle_helper()
+        for __ in range(2):
+            with self.assertRaises(executor.ExecutorError) as context:
+                self.executor.run(['true'])
+            self.assertFalse(context.exception.sent)
+
+    def test_helper_dies_during_command(self):
+        with self.assertRaises(executor.ExecutorError) as context:
+            self.executor.run(['sh', '-c', 'kill -9 $PPID; sleep 1'])
+        self.assertTrue(context.exception.sent)
+
+    def test_batches_run_at_the_same_time(self):
+        threads = [threading.Thread(target=self.executor.run,
+                                    args=(['sleep', '0.5'],))
+                   for __ in range(2)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLess(time.time() - start, 0.9)
+
+    def test_proc_falls_back(self):
+        p = proc.Proc()
+        p.executor = self.executor
+        self.kill_idle_helper()
+        p.run(['ip', '-V'])
+        self.assertIsNone(p.executor)
+        self.assertEqual(p.get_fork_counts(), {'ip': 1})
+
+    def test_proc_does_not_run_sent_command_again(self):
+        p = proc.Proc()
+        p.executor = FailingExecutor()
+        self.assertRaises(OSError, p.run, ['ip', '-V'])
+        self.assertIsNone(p.executor)
+        self.assertEqual(p.get_fork_counts(), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+
+from mullvad import firewall
+
+
+class FakeProc(object):
+    """Records the iptables commands instead of running them. Deleting a
+    rule fails, as if there were none left."""
+    def __init__(self):
+        self.commands = []
+
+    def run(self, args, stdin=None, cancel=None):
+        self.commands.append(args)
+        return 0, '', ''
+
+    def run_get_exit(self, args, stdin=None):
+        self.commands.append(args)
+        return 1 if '-D' in args else 0
+
+    def run_assert_ok(self, args, stdin=None, cancel=None):
+        self.commands.append(args)
+        return ''
+
+
+class IPv6Firewall(firewall.LinuxFirewall):
+    def _has_ipv6(self):
+        return True
+
+
+class TestLinuxFirewall(unittest.TestCase):
+    def setUp(self):
+        self.proc = firewall.proc
+        firewall.proc = FakeProc()
+
+    def tearDown(self):
+        firewall.proc = self.proc
+
+    def _ipv6_rejects(self):
+        return [args for args in firewall.proc.commands
+                if args[0] == 'ip6tables' and 'REJECT' in args and
+                '-D' not in args]
+
+    def test_block_ipv6(self):
+        fw = IPv6Firewall()
+        fw.block_ipv6()
+        self.assertEqual(len(self._ipv6_rejects()), 1)
+        self.assertIn(firewall.LinuxFirewall.CHAIN_NAME,
+                      self._ipv6_rejects()[0])
+
+    def test_isolated_chain_does_not_block_ipv6(self):
+        fw = IPv6Firewall('MULLVAD-1')
+        fw.block_ipv6()
+        self.assertEqual(self._ipv6_rejects(), [])
+        # Its chain is still jumped to for both address families
+        self.assertIn(['ip6tables', '-w', '-I', 'OUTPUT', '-j', 'MULLVAD-1'],
+                      firewall.proc.commands)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import socket
+import struct
+import unittest
+
+from mullvad import health
+
+
+def time_exceeded(port, quoted_payload):
+    ip_header = b'\x45' + b'\x00' * 19
+    icmp_header = struct.pack(b'!BBH4x', 11, 0, 0)
+    probe_ip_header = (b'\x45' + b'\x00' * 15 +
+                       socket.inet_aton('193.0.14.129'))
+    udp_header = struct.pack(b'!HHHH', 40000, port, 8 + 21, 0)
+    return (ip_header + icmp_header + probe_ip_header + udp_header +
+            quoted_payload)
+
+
+class TestParseReply(unittest.TestCase):
+    def setUp(self):
+        self.sent = {65400: (b'mullvad-probe-12345678', 0.0)}
+
+    def test_matches_port_and_payload(self):
+        packet = time_exceeded(65400, b'mullvad-probe-12345678')
+        self.assertEqual(health.parse_reply(packet, self.sent), 65400)
+
+    def test_truncated_quote(self):
+        packet = time_exceeded(65400, b'')
+        self.assertEqual(health.parse_reply(packet, self.sent), 65400)
+
+    def test_other_probes(self):
+        self.assertIsNone(health.parse_reply(
+            time_exceeded(65401, b'mullvad-probe-12345678'), self.sent))
+        self.assertIsNone(health.parse_reply(
+            time_exceeded(65400, b'mullvad-probe-87654321'), self.sent))
+        self.assertIsNone(health.parse_reply(b'\x45', self.sent))
+
+
+class TestHealthProber(unittest.TestCase):
+    def setUp(self):
+        try:
+            self.prober = health.HealthProber('127.0.0.1')
+        except socket.error as e:
+            self.skipTest('Needs root: {}'.format(e))
+
+    def tearDown(self):
+        self.prober.close()
+
+    def test_reply_reaches_bound_socket(self):
+        self.assertEqual(self.prober.icmp.getsockname()[0], '127.0.0.1')
+        self.assertEqual(self.prober.udp.getsockname()[0], '127.0.0.1')
+        # As the first hop would answer, the kernel adds the IP header
+        sender = socket.socket(socket.AF_INET, socket.SOCK_RAW,
+                               socket.IPPROTO_ICMP)
+        sender.sendto(time_exceeded(65400, b'mullvad-probe-12345678')[20:],
+                      ('127.0.0.1', 0))
+        sender.close()
+        sent = {65400: (b'mullvad-probe-12345678', 0.0)}
+        self.prober.icmp.settimeout(5)
+        while True:
+            data, addr = self.prober.icmp.recvfrom(1024)
+            port = health.parse_reply(data, sent)
+            if port is not None:
+                break
+        self.assertEqual(port, 65400)
+        self.assertEqual(addr[0], '127.0.0.1')
+
+
+class TestProbeStats(unittest.TestCase):
+    def setUp(self):
+        self.stats = health.ProbeStats()
+
+    def test_stats(self):
+        self.stats.add_train([0.01, None, 0.03], '10.8.0.1')
+        stats = self.stats.stats()
+        self.assertEqual(stats['probes'], 3)
+        self.assertAlmostEqual(stats['loss'], 1 / 3.0, places=3)
+        self.assertAlmostEqual(stats['rtt_mean'], 0.02)
+        self.assertAlmostEqual(stats['jitter'], 0.02)
+        self.assertEqual(stats['hop'], '10.8.0.1')
+
+    def test_interval_adapts(self):
+        for __ in range(5):
+            self.stats.add_train([0.01] * 3, '10.8.0.1')
+        self.assertEqual(self.stats.interval, health.MAX_INTERVAL)
+        self.stats.add_train([0.01, None, 0.01], '10.8.0.1')
+        self.assertEqual(self.stats.interval, health.MIN_INTERVAL)
+
+    def test_degraded(self):
+        for __ in range(3):
+            self.stats.add_train([None] * 3, None)
+        self.assertFalse(self.stats.degraded())  # Never answered
+        self.stats.add_train([0.01] * 3, '10.8.0.1')
+        self.stats.add_train([0.01] * 3, '10.8.0.1')
+        self.stats.add_train([None] * 3, None)
+        self.assertFalse(self.stats.degraded())
+        self.stats.add_train([None] * 3, None)
+        self.assertTrue(self.stats.degraded())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+import urllib2
+
+from mullvad import metrics
+from mullvad import proc
+
+
+SNAPSHOT = {
+    'state': 'connected',
+    'server': {'name': 'se1', 'address': '1.2.3.4', 'protocol': 'udp',
+               'port': 1194},
+    'connect_outcomes': {'connected': 2, 'disconnected': 1},
+    'reconnects': 1,
+    'connect_phases': {
+        'master_race': {'count': 2, 'min': 0.1, 'mean': 0.15,
+                        'median': 0.1, 'p90': 0.2, 'max': 0.2,
+                        'total_count': 150, 'total_sum': 21.5},
+    },
+    'traffic': {'rx_total': 10, 'tx_total': 20, 'rx_rate': 1.5,
+                'tx_rate': 0.0},
+    'periodic_tasks': {
+        'route_check': {'runs': 4, 'failures': 0, 'missed': 1,
+                        'last_late': 0.01, 'max_late': 2.5},
+    },
+    'health': {'probes': 6, 'loss': 0.5, 'rtt_min': 0.01, 'rtt_mean': 0.02,
+               'rtt_max': 0.03, 'jitter': 0.005, 'hop': '10.8.0.1',
+               'interval': 5},
+}
+
+
+class FakeTunnel(object):
+    def metrics(self):
+        return SNAPSHOT
+
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self):
+        text = metrics.render(SNAPSHOT, {'openssl': 3})
+        lines = text.splitlines()
+        self.assertIn('mullvad_connection_state{state="connected"} 1', lines)
+        self.assertIn('mullvad_connection_state{state="off"} 0', lines)
+        self.assertIn('mullvad_connect_attempts_total{result="connected"} 2',
+                      lines)
+        self.assertIn('mullvad_connect_phase_seconds'
+                      '{phase="master_race",quantile="0.9"} 0.2', lines)
+        self.assertIn('mullvad_connect_phase_seconds_count'
+                      '{phase="master_race"} 150', lines)
+        self.assertIn('mullvad_connect_phase_seconds_sum'
+                      '{phase="master_race"} 21.5', lines)
+        self.assertIn('mullvad_subprocess_forks_total{program="openssl"} 3',
+                      lines)
+        self.assertIn('mullvad_periodic_task_missed_total'
+                      '{task="route_check"} 1', lines)
+        self.assertIn('mullvad_tunnel_probe_loss_ratio 0.5', lines)
+
+    def test_no_server(self):
+        snapshot = dict(SNAPSHOT, server=None, connect_phases={},
+                        health=None)
+        text = metrics.render(snapshot, {})
+        self.assertNotIn('mullvad_server_info{', text)
+        self.assertFalse([line for line in text.splitlines()
+                          if line.startswith('mullvad_tunnel_rtt_seconds')])
+
+    def test_serves_on_loopback(self):
+        exporter = metrics.MetricsExporter(FakeTunnel(), 0)
+        exporter.start()
+        try:
+            url = 'http://127.0.0.1:{}/metrics'.format(exporter.port)
+            text = urllib2.urlopen(url, timeout=5).read()
+        finally:
+            exporter.stop()
+        self.assertEqual(text, metrics.render(SNAPSHOT,
+                                              proc.get_fork_counts()))
+
+
+if __name__ == '__main__':
+    unittest.main()
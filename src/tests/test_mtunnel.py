@@ -0,0 +1,462 @@
+import ConfigParser
+import Queue
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import unittest
+
+from mullvad import cancel
+from mullvad import config
+from mullvad import mtunnel
+from mullvad import serverinfo
+from mullvad import standby
+from mullvad import util
+
+_FAKE_OPENVPN = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'fake_openvpn.py')
+
+# Every option the tunnel reads, the defaults are replaced by test_config
+_SETTINGS = {
+    'id': '1234',
+    'location': 'any',
+    'protocol': 'any',
+    'server': 'any',
+    'port': 'any',
+    'cipher': 'any',
+    'obfsproxy': 'no',
+    'delete_default_route': 'False',
+    'stop_dns_leaks': 'False',
+    'tunnel_ipv6': 'True',  # Not to need a firewall
+    'block_local_network': 'False',
+    'block_incoming_udp': 'False',
+    'timeout': '60',
+    'windows_block_outside_dns': 'True',
+    'send_recv_buffers': 'auto',
+    'custom_ovpn_args': '',
+    'remember_network_transport': 'False',
+    'throughput_updates_per_second': '1',
+    'key_algorithm': 'rsa',
+    'fast_reconnect_window': '300',
+    'hot_standby': 'False',
+    'reconnect_delay_min': '1',
+    'reconnect_delay_max': '60',
+}
+
+_SERVERS = [
+    serverinfo.ServerInfo('10.0.0.1 1194 udp se1.mullvad.net se aes256'),
+    serverinfo.ServerInfo('10.0.0.2 1194 udp se2.mullvad.net se aes256'),
+]
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class Settings(config.ReadOnlySettings):
+    def __init__(self):
+        parser = ConfigParser.RawConfigParser()
+        parser.add_section(config._SETTINGS_SECTION)
+        for option, value in _SETTINGS.items():
+            parser.set(config._SETTINGS_SECTION, option, value)
+        config.ReadOnlySettings.__init__(self, parser)
+
+    def get_read_only_clone(self):
+        return config.ReadOnlySettings(self.parser)
+
+
+class FakeRouteManager(object):
+    def __init__(self):
+        self.added = []
+        self.deleted = []
+
+    def route_add(self, *args):
+        self.added.append(args)
+
+    def route_del(self, *args):
+        self.deleted.append(args)
+
+
+class FakePolicyRoutes(object):
+    def __init__(self):
+        self.route = None
+
+    def set(self, source, gateway):
+        self.route = (source, gateway)
+
+    def clear(self):
+        self.route = None
+
+
+def set_up_fast_reconnect(tunnel):
+    """Leave what a tunnel that just dropped leaves, for a connect that goes
+    straight to OpenVPN without asking the master."""
+    for path in (tunnel.ssl_keys.get_client_key_path(1234),
+                 tunnel.ssl_keys.get_client_cert_path(1234)):
+        with open(path, 'w') as f:
+            f.write('Not parsed\n')
+    tunnel.last_connection = {
+        'server': _SERVERS[0],
+        'protocol': 'udp',
+        'obfsproxy': False,
+        'dns': '10.8.0.1',
+        'settings': tunnel._get_fast_reconnect_settings(),
+    }
+    tunnel.time_connection_lost = util.monotonic()
+    tunnel.subscription_expiry = time.time() + 3600
+
+
+class HostlessTunnel(mtunnel.Tunnel):
+    """A Tunnel that leaves the host alone.
+
+    It is an isolated instance on free ports, without a firewall, whose
+    routes are only recorded. OpenVPN is fake_openvpn.py, which comes up
+    with 127.0.0.1 as its tunnel address.
+    """
+    def __init__(self, state_dir):
+        instance = mtunnel.TunnelInstance(1, state_dir)
+        instance.management_port = free_port()
+        instance.standby_management_port = free_port()
+        mtunnel.Tunnel.__init__(self, Settings(), state_dir, instance)
+        self.route_manager = FakeRouteManager()
+        self.policy_routes = FakePolicyRoutes()
+        self.master_addresses = []  # (address, port) to reach the master
+        self.openvpn_args = []  # Passed on to fake_openvpn.py
+        self.master_refreshes = 0  # Asked for through the tunnel
+
+    def _init_firewall(self):
+        pass
+
+    def _ordered_master_connection_addresses(self):
+        return self.master_addresses
+
+    def _fill_key_pool(self):
+        pass
+
+    def _refresh_master_data_in_background(self):
+        self.master_refreshes += 1
+
+    def _openvpn_command(self, server, port, proto, cipher, useObfsp,
+                         management_port, configure_host=True):
+        return [sys.executable, _FAKE_OPENVPN,
+                '--management', '127.0.0.1', str(management_port),
+                '--ifconfig', '127.0.0.1', '255.0.0.0'] + self.openvpn_args
+
+
+class TestConnectOpenVPN(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.tunnel = HostlessTunnel(self.state_dir)
+
+    def tearDown(self):
+        self.tunnel.destroy()
+        shutil.rmtree(self.state_dir)
+
+    def test_openvpn_exiting_at_once(self):
+        tunnel = self.tunnel
+        tunnel._openvpn_command = lambda *args, **kwargs: [
+            sys.executable, '-c', 'import sys; sys.exit(1)']
+        server = _SERVERS[0]
+        tunnel.server = server
+        tunnel.connectTimeout = 60
+        tunnel.connect_cancel = cancel.CancelToken()
+        t0 = util.monotonic()
+        result = tunnel._connectOpenVPN(server.address, server.port,
+                                        server.protocol, server.cipher)
+        self.assertEqual(result, mtunnel.ConState.disconnected)
+        self.assertLess(util.monotonic() - t0, 3)
+
+
+class TestOwnCert(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.tunnel = HostlessTunnel(self.state_dir)
+        self.cert_path = self.tunnel.ssl_keys.get_client_cert_path(1234)
+
+    def tearDown(self):
+        self.tunnel.destroy()
+        shutil.rmtree(self.state_dir)
+
+    def test_other_key_algorithm(self):
+        self.tunnel._cert_key_algorithm = lambda cert_path: 'ec'
+        self.assertTrue(self.tunnel._uses_other_key_algorithm(
+            self.cert_path, 'rsa'))
+        self.assertFalse(self.tunnel._uses_other_key_algorithm(
+            self.cert_path, 'ec'))
+
+    def test_unknown_key_algorithm_is_kept(self):
+        with open(self.cert_path, 'w') as f:
+            f.write('Not parsed\n')
+        for algorithm in ('rsa', 'ec'):
+            self.assertFalse(self.tunnel._uses_other_key_algorithm(
+                self.cert_path, algorithm))
+
+
+class TestFailover(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.tunnel = HostlessTunnel(self.state_dir)
+        self.tunnel.settings.override('hot_standby', True)
+        self.tunnel._setBackupServers(_SERVERS)
+
+    def tearDown(self):
+        self.tunnel.destroy()
+        shutil.rmtree(self.state_dir)
+
+    def _connect(self, server):
+        """Bring up OpenVPN and its standby as a connect would, without the
+        state machine, which stays disconnected."""
+        tunnel = self.tunnel
+        tunnel.server = server
+        tunnel.connect_cancel = cancel.CancelToken()
+        result = tunnel._connectOpenVPN(server.address, server.port,
+                                        server.protocol, server.cipher)
+        tunnel.connect_cancel = None
+        self.assertEqual(result, mtunnel.ConState.connected)
+        tunnel._start_standby()
+        self.assertIsNotNone(tunnel.standby_tunnel)
+        self.assertTrue(tunnel.standby_tunnel.wait_until_ready(10))
+
+    def test_failover(self):
+        tunnel = self.tunnel
+        servers = []
+        tunnel.add_server_listener(servers.append)
+        self._connect(_SERVERS[0])
+        old_proc, old_management = tunnel.openvpn_proc, tunnel.management
+        standby_tunnel = tunnel.standby_tunnel
+        new_proc, new_management = (standby_tunnel.process,
+                                    tunnel.spare_management)
+        gateway = standby.get_tunnel_gateway('127.0.0.1')
+        self.assertIsNotNone(gateway)
+
+        self.assertTrue(tunnel._failover())
+
+        # The standby took over, and the old OpenVPN was stopped
+        self.assertIsNotNone(old_proc.poll())
+        self.assertIs(tunnel.openvpn_proc, new_proc)
+        self.assertIs(tunnel.management, new_management)
+        self.assertIs(tunnel.spare_management, old_management)
+        self.assertIn(tunnel._on_management_event, new_management.listeners)
+        self.assertNotIn(tunnel._on_management_event,
+                         old_management.listeners)
+        self.assertEqual(tunnel.server.address, _SERVERS[1].address)
+        self.assertIs(servers[-1], tunnel.server)
+
+        # Routed through the standby tunnel, for the disconnect to remove
+        routes = [('0.0.0.0', '128.0.0.0', gateway),
+                  ('128.0.0.0', '128.0.0.0', gateway)]
+        self.assertEqual(tunnel.route_manager.added, routes)
+        self.assertEqual(tunnel.failover_routes, routes)
+
+        # The next standby uses the management client that was freed
+        self.assertIsNot(tunnel.standby_tunnel, standby_tunnel)
+        self.assertEqual(tunnel.standby_tunnel.server.address,
+                         _SERVERS[0].address)
+        self.assertIs(tunnel.standby_tunnel.management, old_management)
+
+        tunnel._disconnect()
+        self.assertEqual(tunnel.route_manager.deleted, routes)
+        self.assertEqual(tunnel.failover_routes, [])
+        self.assertIsNotNone(new_proc.poll())
+
+    def test_no_failover_without_standby(self):
+        tunnel = self.tunnel
+        self._connect(_SERVERS[0])
+        tunnel._stop_standby()
+
+        self.assertFalse(tunnel._failover())
+        self.assertEqual(tunnel.route_manager.added, [])
+        self.assertIs(tunnel.server, _SERVERS[0])
+
+
+class TestDisconnectWhileConnecting(unittest.TestCase):
+    """A disconnect must not wait for a step of the connect to time out,
+    the timeouts here are far longer than what the tests allow."""
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.tunnel = HostlessTunnel(self.state_dir)
+        self.states = Queue.Queue()
+        self.tunnel.add_connection_listener(self.states.put)
+
+    def tearDown(self):
+        self.tunnel.destroy()
+        shutil.rmtree(self.state_dir)
+
+    def _wait_for_state(self, state, timeout=10):
+        end = util.monotonic() + timeout
+        while True:
+            remaining = end - util.monotonic()
+            self.assertGreater(remaining, 0, 'State not reached')
+            try:
+                if self.states.get(timeout=remaining) == state:
+                    return
+            except Queue.Empty:
+                pass
+
+    def _disconnect(self):
+        """Disconnect, and return the seconds until the state machine has
+        cleaned up after the connect."""
+        t0 = util.monotonic()
+        self.tunnel.disconnect()
+        self._wait_for_state(mtunnel.ConState.disconnected)
+        return util.monotonic() - t0
+
+    def test_blocked_master(self):
+        master = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        master.bind(('127.0.0.1', 0))
+        master.listen(1)
+        master.settimeout(10)
+        self.tunnel.master_addresses = [master.getsockname()]
+        self.tunnel.connect()
+        self._wait_for_state(mtunnel.ConState.connecting)
+        conn, __ = master.accept()
+        conn.settimeout(10)
+        # The version request, hex length first, which is never answered
+        request = b''
+        while len(request) < 8 or len(request) < 8 + int(request[:8], 16):
+            data = conn.recv(1024)
+            self.assertTrue(data)
+            request += data
+
+        self.assertLess(self._disconnect(), 3)
+        self.assertIsNone(self.tunnel.current_master_address)
+        self.assertEqual(conn.recv(1024), b'')  # Closed by the tunnel
+        conn.close()
+        master.close()
+
+    def test_stalled_openvpn(self):
+        tunnel = self.tunnel
+        tunnel.openvpn_args = ['--stall']
+        set_up_fast_reconnect(tunnel)
+        tunnel.connect()
+        util.poll(lambda: tunnel.management.state is None, 0.05, 10)
+        self.assertEqual(tunnel.management.state.state, 'WAIT')
+        openvpn_proc = tunnel.openvpn_proc
+
+        self.assertLess(self._disconnect(), 3)
+        self.assertIsNotNone(openvpn_proc.poll())
+        self.assertIsNone(tunnel.server)
+
+
+class StateMachineTestCase(unittest.TestCase):
+    """Connects through the state machine, following its states."""
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.tunnel = HostlessTunnel(self.state_dir)
+        self.states = Queue.Queue()
+        self.tunnel.add_connection_listener(self.states.put)
+
+    def tearDown(self):
+        self.tunnel.destroy()
+        shutil.rmtree(self.state_dir)
+
+    def _connect(self):
+        self.tunnel.connect()
+        while True:
+            state = self.states.get(timeout=10)
+            self.assertNotEqual(state, mtunnel.ConState.disconnected)
+            if state == mtunnel.ConState.connected:
+                return
+
+    def _disconnect(self):
+        self.tunnel.disconnect()
+        while self.states.get(timeout=10) != mtunnel.ConState.disconnected:
+            pass
+
+
+class TestConnected(StateMachineTestCase):
+    def test_checks_start_over(self):
+        tunnel = self.tunnel
+        set_up_fast_reconnect(tunnel)
+        self._connect()
+        self._disconnect()
+        set_up_fast_reconnect(tunnel)
+        run = []
+        # As after a long connect, every check is far overdue
+        for task in tunnel.scheduler.tasks.values():
+            task.function = lambda name=task.name: run.append(name)
+            task.nominal = task.deadline = 0
+        t0 = util.monotonic()
+        self._connect()
+        time.sleep(0.5)  # For the state machine to look for due checks
+        self.assertEqual(run, [])
+        for name, task in tunnel.scheduler.tasks.items():
+            self.assertGreater(task.deadline, t0, name)
+
+
+class TestFastReconnect(StateMachineTestCase):
+    def setUp(self):
+        StateMachineTestCase.setUp(self)
+        set_up_fast_reconnect(self.tunnel)
+
+    def _refreshed(self, **changes):
+        refresh = {'master_cert': None, 'own_cert': None, 'dns': None,
+                   'time_left': 3600, 'servers': _SERVERS}
+        refresh.update(changes)
+        return refresh
+
+    def test_reconnect_without_master(self):
+        tunnel = self.tunnel
+        master = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        master.bind(('127.0.0.1', 0))
+        master.listen(1)
+        tunnel.master_addresses = [master.getsockname()]
+        self._connect()
+        master.settimeout(0)
+        self.assertRaises(socket.error, master.accept)  # Never contacted
+        master.close()
+        self.assertEqual(tunnel.server.address, _SERVERS[0].address)
+        self.assertEqual(tunnel.master_refreshes, 1)
+        self.assertIsNotNone(tunnel.last_connection)
+
+    def test_no_fast_reconnect(self):
+        tunnel = self.tunnel
+        self.assertIsNotNone(tunnel._get_fast_reconnect())
+        tunnel.settings.override('protocol', 'tcp')
+        self.assertIsNone(tunnel._get_fast_reconnect())
+        tunnel.settings.override('protocol', 'any')
+        tunnel.time_connection_lost -= 301
+        self.assertIsNone(tunnel._get_fast_reconnect())
+        tunnel.time_connection_lost += 301
+        tunnel.subscription_expiry = time.time() - 1
+        self.assertIsNone(tunnel._get_fast_reconnect())
+
+    def test_refresh_applied(self):
+        tunnel = self.tunnel
+        self._connect()
+        self.assertFalse(os.path.exists(tunnel.backup_server_file))
+        with tunnel.master_refresh_lock:
+            tunnel.master_refresh = self._refreshed(dns='10.8.0.2')
+        tunnel.wakeup.wake()
+        # The servers are stored last
+        util.poll(lambda: not os.path.exists(tunnel.backup_server_file),
+                  0.05, 10)
+        self.assertIsNone(tunnel.master_refresh)
+        self.assertEqual([s.address for s in tunnel._get_servers()],
+                         [s.address for s in _SERVERS])
+        self.assertEqual(tunnel._getHardDNSBackup(), '10.8.0.2\n')
+        self.assertGreater(tunnel.subscription_expiry, time.time() + 3500)
+        self.assertEqual(tunnel.connectionState(),
+                         mtunnel.ConState.connected)
+
+    def test_expired_subscription_disconnects(self):
+        tunnel = self.tunnel
+        self._connect()
+        with tunnel.master_refresh_lock:
+            tunnel.master_refresh = self._refreshed(time_left=0)
+        tunnel.wakeup.wake()
+        self.assertEqual(self.states.get(timeout=10),
+                         mtunnel.ConState.disconnected)
+        # The next connect asks the master, which reports the expiry
+        self.assertIsNone(tunnel.last_connection)
+        self.assertIsNone(tunnel._get_fast_reconnect())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from mullvad import netprofile
+
+_ARP_TABLE = '''\
+IP address       HW type     Flags       HW address            Mask     Device
+192.168.1.1      0x1         0x2         AA:BB:CC:00:11:22     *        wlan0
+192.168.1.7      0x1         0x0         00:00:00:00:00:00     *        wlan0
+'''
+
+
+class TestGatewayMac(unittest.TestCase):
+    def test_arp_table(self):
+        self.assertEqual(
+            netprofile.parse_arp_table(_ARP_TABLE, '192.168.1.1'),
+            'aa:bb:cc:00:11:22')
+
+    def test_arp_table_incomplete_or_missing(self):
+        self.assertIsNone(
+            netprofile.parse_arp_table(_ARP_TABLE, '192.168.1.7'))
+        self.assertIsNone(
+            netprofile.parse_arp_table(_ARP_TABLE, '192.168.1.254'))
+        self.assertIsNone(netprofile.parse_arp_table('', '192.168.1.1'))
+
+    def test_arp_output_mac(self):
+        output = '? (192.168.1.1) at a:b:c:0:11:22 on en0 ifscope [ethernet]'
+        self.assertEqual(netprofile.parse_arp_output(output),
+                         'a:b:c:0:11:22')
+
+    def test_arp_output_windows(self):
+        output = ('Interface: 192.168.1.5 --- 0xb\n'
+                  '  Internet Address      Physical Address      Type\n'
+                  '  192.168.1.1           aa-bb-cc-00-11-22     dynamic\n')
+        self.assertEqual(netprofile.parse_arp_output(output),
+                         'aa:bb:cc:00:11:22')
+
+    def test_arp_output_no_entry(self):
+        self.assertIsNone(netprofile.parse_arp_output(
+            '192.168.1.1 (192.168.1.1) -- no entry'))
+
+
+class TestNetworkProfiles(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'netprofiles.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_remember_survives_restart(self):
+        profiles = netprofile.NetworkProfiles(self.dir)
+        profiles.remember('net', 'tcp', 443, True, '1.2.3.4')
+        profile = netprofile.NetworkProfiles(self.dir).get('net')
+        self.assertEqual((profile['protocol'], profile['port'],
+                          profile['obfsproxy'], profile['master']),
+                         ('tcp', 443, True, '1.2.3.4'))
+        profiles.remember('net', 'udp', 1194, False)
+        self.assertEqual(profiles.get('net')['master'], '1.2.3.4')
+        profiles.forget('net')
+        self.assertIsNone(netprofile.NetworkProfiles(self.dir).get('net'))
+
+    def test_least_recently_used_pruned(self):
+        profiles = netprofile.NetworkProfiles(self.dir)
+        for i in range(netprofile._MAX_PROFILES):
+            profiles.profiles['net{}'.format(i)] = {'last_used': 1000 + i}
+        profiles.remember('new', 'udp', 1194, False)
+        self.assertEqual(len(profiles.profiles), netprofile._MAX_PROFILES)
+        self.assertIsNone(profiles.get('net0'))
+        self.assertIsNotNone(profiles.get('net1'))
+        self.assertIsNotNone(profiles.get('new'))
+
+    def test_concurrent_updates(self):
+        profiles = netprofile.NetworkProfiles(self.dir)
+        threads = [threading.Thread(target=profiles.remember,
+                                    args=('net{}'.format(i), 'udp', 1194,
+                                          False))
+                   for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        saved = netprofile.NetworkProfiles(self.dir)
+        self.assertEqual(len(saved.profiles), 20)
+        self.assertEqual(os.listdir(self.dir), ['netprofiles.json'])
+
+    def test_corrupt_file_ignored(self):
+        with open(self.path, 'w') as f:
+            f.write('{"net": ')
+        profiles = netprofile.NetworkProfiles(self.dir)
+        self.assertIsNone(profiles.get('net'))
+        profiles.remember('net', 'udp', 53, False)
+        self.assertIsNotNone(netprofile.NetworkProfiles(self.dir).get('net'))
+
+    def test_file_not_a_dict_ignored(self):
+        with open(self.path, 'w') as f:
+            f.write('[1, 2]')
+        self.assertEqual(netprofile.NetworkProfiles(self.dir).profiles, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
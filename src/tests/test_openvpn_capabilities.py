@@ -0,0 +1,110 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from mullvad import openvpn_capabilities
+
+_VERSION = '''\
+OpenVPN {} x86_64-pc-linux-gnu [SSL (OpenSSL)] [LZO] [LZ4] [EPOLL] [MH/PKTINFO]
+library versions: OpenSSL 1.1.0g  2 Nov 2017, LZO 2.08
+Originally developed by James Yonan
+'''
+
+_HELP = '''\
+OpenVPN 2.4.4 x86_64-pc-linux-gnu
+
+General Options:
+--config file   : Read configuration options from file.
+--help          : Show options.
+--pull-filter accept|ignore|reject t : Filter each option received from
+                  the server if it starts with the text t.
+  --remote host [port] : Remote host name or ip address.
+Not an --option, as it is not first on its line
+'''
+
+
+class TestOpenVPNCapabilities(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.binary = os.path.join(self.dir, 'openvpn')
+        self.probes = os.path.join(self.dir, 'probes')
+        self._write_binary('2.4.4')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write_binary(self, version):
+        """Write a fake openvpn that answers --version and --help, and
+        counts how often it is asked for its version."""
+        for name, text in (('version', _VERSION.format(version)),
+                           ('help', _HELP)):
+            with open(os.path.join(self.dir, name), 'w') as f:
+                f.write(text)
+        with open(self.binary, 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'cd "$(dirname "$0")"\n'
+                    'case "$1" in\n'
+                    '--version) echo >> probes; cat version ;;\n'
+                    '*) cat help; exit 1 ;;\n'
+                    'esac\n'
+                    '# {}\n'.format(version))  # Changes the size as well
+        os.chmod(self.binary, stat.S_IRWXU)
+
+    def _probe_count(self):
+        if not os.path.exists(self.probes):
+            return 0
+        with open(self.probes) as f:
+            return len(f.readlines())
+
+    def test_probe(self):
+        caps = openvpn_capabilities.OpenVPNCapabilities(self.dir)
+        capabilities = caps.get(self.binary)
+        self.assertEqual(capabilities.version, (2, 4, 4))
+        self.assertTrue(capabilities.at_least(2, 4))
+        self.assertFalse(capabilities.at_least(2, 5))
+        self.assertEqual(capabilities.options, frozenset(
+            ['--config', '--help', '--pull-filter', '--remote']))
+        self.assertTrue(capabilities.supports('--pull-filter'))
+        self.assertFalse(capabilities.supports('--option'))
+
+    def test_version_without_patch_level(self):
+        self._write_binary('2.3')
+        caps = openvpn_capabilities.OpenVPNCapabilities(self.dir)
+        self.assertEqual(caps.get(self.binary).version, (2, 3, 0))
+
+    def test_unparsable_version(self):
+        self._write_binary('unknown')
+        caps = openvpn_capabilities.OpenVPNCapabilities(self.dir)
+        with self.assertRaises(RuntimeError):
+            caps.get(self.binary)
+
+    def test_cached(self):
+        caps = openvpn_capabilities.OpenVPNCapabilities(self.dir)
+        caps.get(self.binary)
+        caps.get(self.binary)
+        self.assertEqual(self._probe_count(), 1)
+        # Also by the next process
+        caps = openvpn_capabilities.OpenVPNCapabilities(self.dir)
+        self.assertEqual(caps.get(self.binary).version, (2, 4, 4))
+        self.assertEqual(self._probe_count(), 1)
+
+    def test_upgraded_binary_is_probed_again(self):
+        caps = openvpn_capabilities.OpenVPNCapabilities(self.dir)
+        caps.get(self.binary)
+        self._write_binary('2.4.10')
+        self.assertEqual(caps.get(self.binary).version, (2, 4, 10))
+        self.assertEqual(self._probe_count(), 2)
+        self.assertEqual(len(caps.cache), 1)
+
+    def test_unreadable_cache_is_ignored(self):
+        with open(os.path.join(self.dir, openvpn_capabilities._CACHE_FILE),
+                  'w') as f:
+            f.write('{Not JSON')
+        caps = openvpn_capabilities.OpenVPNCapabilities(self.dir)
+        self.assertEqual(caps.get(self.binary).version, (2, 4, 4))
+
+
+if __name__ == '__main__':
+    unittest.main()
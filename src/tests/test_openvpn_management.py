@@ -0,0 +1,174 @@
+import Queue
+import socket
+import threading
+import unittest
+
+from mullvad import openvpn_management
+
+
+class FakeManagementInterface(threading.Thread):
+    """Listens like OpenVPN's management interface and answers a few
+    commands. Everything received is recorded in self.commands."""
+
+    def __init__(self):
+        super(FakeManagementInterface, self).__init__()
+        self.daemon = True
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+        self.commands = Queue.Queue()
+        self.conn = None
+        self.connected = threading.Event()
+        self.start()
+
+    def run(self):
+        while True:
+            try:
+                conn, __ = self.listener.accept()
+            except socket.error:
+                return
+            self.conn = conn
+            conn.sendall(b'>INFO:OpenVPN Management Interface Version 1\r\n')
+            self.connected.set()
+            for line in iter(conn.makefile('rb').readline, b''):
+                command = line.strip()
+                self.commands.put(command)
+                if command == b'state':
+                    conn.sendall(b'1,CONNECTED,SUCCESS,10.8.0.2,1.2.3.4\r\n'
+                                 b'END\r\n')
+                elif command == b'bogus':
+                    conn.sendall(b'ERROR: unknown command\r\n')
+                else:
+                    conn.sendall(b'SUCCESS: ' + command + b'\r\n')
+            self.connected.clear()
+
+    def push(self, line):
+        self.conn.sendall(line + b'\r\n')
+
+    def drop(self):
+        self.conn.shutdown(socket.SHUT_RDWR)
+        self.conn.close()
+
+    def stop(self):
+        self.listener.close()
+
+
+class TestParseNotification(unittest.TestCase):
+    def test_state(self):
+        event = openvpn_management.parse_notification(
+            '>STATE:1496048022,CONNECTED,SUCCESS,10.8.0.2,185.65.132.1')
+        self.assertIsInstance(event, openvpn_management.StateEvent)
+        self.assertEqual(event.state, 'CONNECTED')
+        self.assertEqual(event.status, 'SUCCESS')
+        self.assertEqual(event.local_ip, '10.8.0.2')
+
+    def test_bytecount(self):
+        event = openvpn_management.parse_notification('>BYTECOUNT:10,20')
+        self.assertIsInstance(event, openvpn_management.ByteCountEvent)
+        self.assertEqual((event.rx, event.tx), (10, 20))
+
+    def test_log_keeps_commas_in_message(self):
+        event = openvpn_management.parse_notification('>LOG:1,I,a, b, c')
+        self.assertIsInstance(event, openvpn_management.LogEvent)
+        self.assertEqual(event.message, 'a, b, c')
+
+    def test_unknown(self):
+        event = openvpn_management.parse_notification('>PASSWORD:Need x')
+        self.assertIsInstance(event, openvpn_management.Notification)
+        self.assertEqual(event.name, 'PASSWORD')
+
+
+class TestManagementClient(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeManagementInterface()
+        self.client = openvpn_management.ManagementClient(
+            '127.0.0.1', self.server.port)
+        self.events = Queue.Queue()
+        self.client.add_listener(self.events.put)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def wait_for_event(self, event_class):
+        while True:
+            event = self.events.get(timeout=5)
+            if isinstance(event, event_class):
+                return event
+
+    def test_subscriptions_are_sent_on_connect(self):
+        self.client.subscribe('state on')
+        self.client.attach()
+        self.wait_for_event(openvpn_management.ConnectedEvent)
+        self.assertEqual(self.server.commands.get(timeout=5), 'state on')
+
+    def test_command_replies_are_correlated(self):
+        self.client.attach()
+        self.wait_for_event(openvpn_management.ConnectedEvent)
+        self.server.push(b'>BYTECOUNT:1,2')
+        self.assertEqual(self.client.command('state', multiline=True),
+                         ['1,CONNECTED,SUCCESS,10.8.0.2,1.2.3.4'])
+        self.assertEqual(self.client.command('bogus', multiline=True),
+                         ['ERROR: unknown command'])
+        self.assertTrue(self.client.kill())
+        self.wait_for_event(openvpn_management.ByteCountEvent)
+
+    def test_state_notifications_update_state(self):
+        self.client.attach()
+        self.wait_for_event(openvpn_management.ConnectedEvent)
+        self.server.push(b'>STATE:2,RECONNECTING,ping-restart,,')
+        self.wait_for_event(openvpn_management.StateEvent)
+        self.assertEqual(self.client.state.state, 'RECONNECTING')
+
+    def test_query_state(self):
+        self.client.attach()
+        self.wait_for_event(openvpn_management.ConnectedEvent)
+        self.server.push(b'>STATE:2,RECONNECTING,ping-restart,,')
+        self.wait_for_event(openvpn_management.StateEvent)
+        self.assertEqual(self.client.query_state().state, 'CONNECTED')
+        self.assertEqual(self.client.state.local_ip, '10.8.0.2')
+
+    def test_reconnects_after_connection_loss(self):
+        self.client.subscribe('state on')
+        self.client.attach()
+        self.wait_for_event(openvpn_management.ConnectedEvent)
+        self.server.drop()
+        self.wait_for_event(openvpn_management.DisconnectedEvent)
+        self.wait_for_event(openvpn_management.ConnectedEvent)
+        self.assertTrue(self.client.is_connected())
+
+    def test_close_stops_reader_thread(self):
+        self.client.attach()
+        self.wait_for_event(openvpn_management.ConnectedEvent)
+        self.client.close()
+        self.assertFalse(self.client.thread.is_alive())
+
+    def test_detach_while_closing(self):
+        # As when OpenVPN exits while the tunnel shuts down
+        client = self.client
+        client.attach()
+        self.wait_for_event(openvpn_management.ConnectedEvent)
+        thread = client.thread
+
+        class DetachBeforeJoin(object):
+            def join(self):
+                client.detach()
+                thread.join(5)
+
+        client.thread = DetachBeforeJoin()
+        client.close()
+        self.assertFalse(thread.is_alive())
+
+    def test_close_unattached(self):
+        self.client.close()
+        self.assertFalse(self.client.thread.is_alive())
+
+    def test_command_without_connection_fails(self):
+        with self.assertRaises(socket.error):
+            self.client.command('state', multiline=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from mullvad import pidfile
+
+
+class TestPidFile(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'children.json')
+        self.procs = []
+
+    def tearDown(self):
+        for p in self.procs:
+            if p.poll() is None:
+                p.kill()
+                p.wait()
+        shutil.rmtree(self.dir)
+
+    def start(self):
+        p = subprocess.Popen(['sleep', '30'])
+        self.procs.append(p)
+        return p
+
+    def test_kill_by_name(self):
+        children = pidfile.PidFile(self.path)
+        openvpn = self.start()
+        obfsproxy = self.start()
+        children.add(openvpn, 'openvpn')
+        children.add(obfsproxy, 'obfsproxy')
+        children.kill('openvpn', timeout=1)
+        self.assertIsNotNone(openvpn.wait())
+        self.assertIsNone(obfsproxy.poll())
+        self.assertEqual(children.pids(), [obfsproxy.pid])
+
+    def test_survives_restart(self):
+        child = self.start()
+        pidfile.PidFile(self.path).add(child, 'openvpn')
+        children = pidfile.PidFile(self.path)
+        self.assertEqual(children.pids('openvpn'), [child.pid])
+        children.kill(timeout=1)
+        self.assertIsNotNone(child.wait())
+        self.assertEqual(pidfile.PidFile(self.path).pids(), [])
+
+    def test_reused_pid_left_alone(self):
+        children = pidfile.PidFile(self.path)
+        child = self.start()
+        children.add(child, 'openvpn')
+        children.entries[unicode(child.pid)]['started'] -= 100
+        children.kill(timeout=1)
+        self.assertIsNone(child.poll())
+        self.assertEqual(children.pids(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import subprocess
+import unittest
+
+from mullvad import proc
+
+
+class TestProcManager(unittest.TestCase):
+    def setUp(self):
+        self.manager = proc.ProcManager()
+        self.child = subprocess.Popen(['sleep', '30'])
+
+    def tearDown(self):
+        self.child.kill()
+        self.child.wait()
+
+    def pids(self, procs):
+        return sorted(p.pid for p in procs)
+
+    def test_comm_matches_psutil(self):
+        by_comm = self.manager._get_procs_by_comm('sleep')
+        if by_comm is None:
+            self.skipTest('/proc not readable')
+        self.assertIn(self.child.pid, self.pids(by_comm))
+        self.assertEqual(self.pids(by_comm), self.pids(
+            self.manager._get_procs_by_psutil('sleep')))
+
+    def test_no_match(self):
+        self.assertEqual(
+            self.manager.get_procs_by_name('no-such-process-name-here'), [])
+        self.assertEqual(self.manager.get_procs_by_name('sleep-x'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import calendar
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+from mullvad import ssl_keys
+
+
+class TestCertParsing(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def create_cert(self, days, algorithm='rsa'):
+        key_path = os.path.join(self.dir, 'key.pem')
+        cert_path = os.path.join(self.dir, 'cert.pem')
+        subprocess.check_call(
+            ['openssl', 'req', '-x509', '-nodes', '-subj', '/CN=test',
+             '-days', str(days), '-keyout', key_path, '-out', cert_path] +
+            ssl_keys.get_newkey_options(algorithm),
+            stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        return cert_path
+
+    def test_matches_openssl(self):
+        cert_path = self.create_cert(30)
+        enddate = subprocess.check_output(
+            ['openssl', 'x509', '-in', cert_path, '-noout', '-enddate'])
+        expected = calendar.timegm(time.strptime(
+            enddate.strip().split('=', 1)[1], '%b %d %H:%M:%S %Y %Z'))
+        with open(cert_path) as f:
+            self.assertEqual(ssl_keys.get_cert_not_after(f.read()), expected)
+
+    def test_key_algorithm(self):
+        for algorithm in ssl_keys.KEY_ALGORITHMS:
+            with open(self.create_cert(1, algorithm)) as f:
+                self.assertEqual(ssl_keys.get_cert_key_algorithm(f.read()),
+                                 algorithm)
+
+    def test_garbage(self):
+        self.assertIsNone(ssl_keys.get_cert_not_after('not a certificate'))
+
+
+class TestVerificationCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'verified.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_persists_and_depends_on_content(self):
+        cache = ssl_keys.VerificationCache(self.path)
+        cache.set_verified('verify', time.time() + 365 * 24 * 3600,
+                           'cert', 'ca')
+        cache = ssl_keys.VerificationCache(self.path)
+        self.assertTrue(cache.is_verified('verify', 'cert', 'ca'))
+        self.assertFalse(cache.is_verified('verify', 'cert', 'other ca'))
+        self.assertFalse(cache.is_verified('key_match', 'cert', 'ca'))
+
+    def test_not_used_close_to_expiry(self):
+        cache = ssl_keys.VerificationCache(self.path)
+        cache.set_verified('verify', time.time() + 3600, 'cert', 'ca')
+        self.assertFalse(cache.is_verified('verify', 'cert', 'ca'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import socket
+import sys
+import unittest
+
+from mullvad import openvpn_management
+from mullvad import serverinfo
+from mullvad import standby
+
+_FAKE_OPENVPN = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'fake_openvpn.py')
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class TestStandbyTunnel(unittest.TestCase):
+    def setUp(self):
+        self.management = openvpn_management.ManagementClient(
+            '127.0.0.1', free_port())
+        self.management.subscribe('state on')
+        server = serverinfo.ServerInfo(
+            '1.2.3.4 1194 udp se1.mullvad.net se aes256')
+        self.standby = standby.StandbyTunnel(server, self.management)
+        self.standby.start([sys.executable, _FAKE_OPENVPN, '--management',
+                            '127.0.0.1', str(self.management.port)])
+
+    def tearDown(self):
+        self.standby.stop()
+        self.management.close()
+
+    def test_ready_after_hold_release(self):
+        self.assertTrue(self.standby.wait_until_ready(10))
+        self.assertEqual(self.management.state.local_ip, '10.9.0.2')
+
+    def test_stop(self):
+        self.assertTrue(self.standby.wait_until_ready(10))
+        process = self.standby.process
+        self.standby.stop()
+        self.assertIsNotNone(process.poll())
+        self.assertFalse(self.management.is_connected())
+
+    def test_release(self):
+        self.assertTrue(self.standby.wait_until_ready(10))
+        process, management = self.standby.release()
+        self.assertIs(management, self.management)
+        self.assertFalse(self.standby.is_alive())
+        self.standby.stop()  # Does nothing once released
+        self.assertIsNone(process.poll())
+        management.kill()
+        process.wait()
+
+
+if __name__ == '__main__':
+    unittest.main()
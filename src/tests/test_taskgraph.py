@@ -0,0 +1,88 @@
+import threading
+import time
+import unittest
+
+from mullvad import cancel
+from mullvad import taskgraph
+from mullvad import util
+
+
+class TestTaskGraph(unittest.TestCase):
+    def test_dependencies_run_first(self):
+        order = []
+        graph = taskgraph.TaskGraph()
+        graph.add('a', lambda: order.append('a') or 1)
+        graph.add('b', lambda: order.append('b') or 2, deps=['a'])
+        graph.add('c', lambda: order.append('c') or 3, deps=['b'])
+        self.assertEqual(graph.run(), {'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(order, ['a', 'b', 'c'])
+
+    def test_independent_tasks_run_concurrently(self):
+        barrier = threading.Event()
+        graph = taskgraph.TaskGraph(max_workers=2)
+        # 'a' only finishes early if 'b' runs while it waits
+        graph.add('a', lambda: barrier.wait(5) or barrier.set())
+        graph.add('b', lambda: barrier.set())
+        start = time.time()
+        graph.run()
+        self.assertLess(time.time() - start, 4)
+
+    def test_workers_are_bounded(self):
+        lock = threading.Lock()
+        running = [0, 0]  # current, max
+
+        def task():
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+
+        graph = taskgraph.TaskGraph(max_workers=2)
+        for name in 'abcde':
+            graph.add(name, task)
+        graph.run()
+        self.assertEqual(running[1], 2)
+
+    def test_failure_rolls_back_finished_tasks(self):
+        rolled_back = []
+
+        def fail():
+            raise ValueError('fail')
+
+        graph = taskgraph.TaskGraph(max_workers=1)
+        graph.add('a', lambda: 'A', rollback=rolled_back.append)
+        graph.add('b', lambda: 'B', deps=['a'], rollback=rolled_back.append)
+        graph.add('fail', fail, deps=['b'])
+        graph.add('never', lambda: self.fail('started'), deps=['fail'])
+        with self.assertRaises(ValueError):
+            graph.run()
+        self.assertEqual(rolled_back, ['B', 'A'])
+
+    def test_failure_cancels_running_tasks(self):
+        token = cancel.CancelToken()
+        started = threading.Event()
+
+        def wait_for_cancel():
+            started.set()
+            util.poll(lambda: not token.cancelled, 0.01, 5)
+            token.check()
+
+        def fail():
+            started.wait(5)
+            raise ValueError('fail')
+
+        graph = taskgraph.TaskGraph(max_workers=2)
+        graph.add('slow', wait_for_cancel)
+        graph.add('fail', fail)
+        start = time.time()
+        with self.assertRaises(ValueError):
+            graph.run(token)
+        self.assertLess(time.time() - start, 4)
+        self.assertTrue(token.cancelled)
+        token.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
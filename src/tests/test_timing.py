@@ -0,0 +1,45 @@
+import unittest
+
+from mullvad import timing
+
+
+class TestConnectTiming(unittest.TestCase):
+    def test_record(self):
+        t = timing.ConnectTiming()
+        with t.phase('a'):
+            pass
+        t.mark('b')
+        t.mark('b')
+        t.begin('unfinished')
+        record = t.record('connected')
+        self.assertEqual(record['result'], 'connected')
+        self.assertEqual(list(record['phases']), ['a', 'b', 'unfinished'])
+        self.assertEqual(record['phases']['b']['duration'], 0)
+        self.assertIsNone(record['phases']['unfinished']['duration'])
+
+    def test_timed_returns_result(self):
+        t = timing.ConnectTiming()
+        self.assertEqual(t.timed('a', lambda x: x * 2)(21), 42)
+        self.assertIn('a', t.record(None)['phases'])
+
+
+class TestPhaseHistograms(unittest.TestCase):
+    def test_stats_are_rolling(self):
+        histograms = timing.PhaseHistograms(size=3)
+        for duration in [100, 1, 2, 3]:
+            histograms.add({'total': duration, 'phases': {
+                'a': {'offset': 0, 'duration': duration},
+                'b': {'offset': 0, 'duration': None}}})
+        stats = histograms.stats()
+        self.assertNotIn('b', stats)
+        self.assertEqual(stats['a']['count'], 3)
+        self.assertEqual(stats['a']['max'], 3)
+        self.assertEqual(stats['a']['median'], 2)
+        self.assertEqual(stats['total']['mean'], 2)
+        # The sum and count keep growing when samples leave the window
+        self.assertEqual(stats['a']['total_count'], 4)
+        self.assertEqual(stats['a']['total_sum'], 106)
+
+
+if __name__ == '__main__':
+    unittest.main()
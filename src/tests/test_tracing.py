@@ -0,0 +1,46 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mullvad import tracing
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'trace.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def trace(self, request_id, method, lock_wait, execute):
+        tracer = tracing.RequestTracer(self.path)
+        tracer.trace(request_id, method, {
+            'wall': 1000.0, 'called': 10.0, 'locked': 10.0 + lock_wait,
+            'received': 10.1 + lock_wait,
+            'executed': 10.1 + lock_wait + execute,
+            'replied': 10.2 + lock_wait + execute})
+
+    def test_spans_round_trip(self):
+        self.trace(1, 'connect', 0.5, 2.0)
+        calls = tracing.load(self.path)
+        self.assertEqual(len(calls), 1)
+        spans = calls[0]['spans']
+        self.assertEqual(sorted(spans), sorted(tracing.SPANS))
+        self.assertAlmostEqual(spans['enqueue'], 0.5)
+        self.assertAlmostEqual(spans['execute'], 2.0)
+
+    def test_analyze(self):
+        for i in range(10):
+            self.trace(i, 'timeLeft', i / 10.0, 0.01)
+        self.trace(10, 'connect', 0, 3.0)
+        stats, waits = tracing.analyze(tracing.load(self.path), longest=2)
+        self.assertEqual(stats['timeLeft']['total']['count'], 10)
+        self.assertAlmostEqual(stats['connect']['execute']['max'], 3.0)
+        self.assertEqual([c['id'] for c in waits], [9, 8])
+        self.assertIn('Longest waits', tracing.format_report(stats, waits))
+
+
+if __name__ == '__main__':
+    unittest.main()
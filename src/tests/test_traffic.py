@@ -0,0 +1,58 @@
+import unittest
+
+from mullvad import traffic
+
+
+class TestTrafficMeter(unittest.TestCase):
+    def setUp(self):
+        self.meter = traffic.TrafficMeter(window=5)
+
+    def test_no_samples(self):
+        self.assertEqual(self.meter.stats(), dict(
+            rx_total=0, tx_total=0, rx_rate=0.0, tx_rate=0.0))
+        self.meter.add(100, 50, now=10.0)
+        self.assertEqual(self.meter.stats(), dict(
+            rx_total=100, tx_total=50, rx_rate=0.0, tx_rate=0.0))
+
+    def test_rate(self):
+        self.meter.add(0, 0, now=10.0)
+        self.meter.add(1000, 200, now=11.0)
+        self.meter.add(4000, 800, now=12.0)
+        self.assertEqual(self.meter.stats(), dict(
+            rx_total=4000, tx_total=800, rx_rate=2000.0, tx_rate=400.0))
+
+    def test_rate_over_window(self):
+        # Fast at first, then idle
+        self.meter.add(0, 0, now=0.0)
+        self.meter.add(10000, 10000, now=1.0)
+        for now in range(2, 10):
+            self.meter.add(10000, 10000, now=float(now))
+        stats = self.meter.stats()
+        self.assertEqual(stats['rx_total'], 10000)
+        self.assertEqual(stats['rx_rate'], 0.0)
+        self.assertEqual(stats['tx_rate'], 0.0)
+        # Only what covers the window is kept
+        self.assertEqual(len(self.meter.samples), 6)
+        self.assertEqual(self.meter.samples[0][0], 4.0)
+
+    def test_counter_restart(self):
+        self.meter.add(0, 0, now=10.0)
+        self.meter.add(5000, 5000, now=11.0)
+        # A new OpenVPN process counts from zero again
+        self.meter.add(100, 6000, now=12.0)
+        self.assertEqual(len(self.meter.samples), 1)
+        self.meter.add(1100, 6500, now=13.0)
+        self.assertEqual(self.meter.stats(), dict(
+            rx_total=1100, tx_total=6500, rx_rate=1000.0, tx_rate=500.0))
+
+    def test_reset(self):
+        self.meter.add(0, 0, now=10.0)
+        self.meter.add(5000, 5000, now=11.0)
+        self.meter.reset()
+        self.assertEqual(self.meter.stats()['rx_rate'], 0.0)
+        self.meter.add(5000, 5000, now=12.0)
+        self.assertEqual(self.meter.stats()['rx_total'], 5000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mullvad import mtunnel
+from mullvad import tunnelmanager
+
+
+class TestTunnelInstance(unittest.TestCase):
+    def test_default_is_not_isolated(self):
+        instance = mtunnel.TunnelInstance()
+        self.assertFalse(instance.isolated)
+        self.assertEqual(instance.management_port, 7505)
+        self.assertEqual(instance.path('backupservers.txt'),
+                         'backupservers.txt')
+        self.assertIsNone(instance.firewall_chain)
+
+    def test_isolated_instances_do_not_share(self):
+        a = mtunnel.TunnelInstance(1, '/a')
+        b = mtunnel.TunnelInstance(2, '/b')
+        ports = set([a.management_port, a.standby_management_port,
+                     b.management_port, b.standby_management_port, 7505,
+                     7506])
+        self.assertEqual(len(ports), 6)
+        self.assertNotEqual(a.route_table, b.route_table)
+        self.assertNotEqual(a.firewall_chain, b.firewall_chain)
+        self.assertEqual(a.path('harddnsbackup.txt'), '/a/harddnsbackup.txt')
+
+
+class TestTunnelManager(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.manager = tunnelmanager.TunnelManager(self.dir)
+
+    def tearDown(self):
+        self.manager.shutdown()
+        shutil.rmtree(self.dir)
+
+    def test_add_and_status(self):
+        self.manager.add('se', {'id': 1111})
+        self.manager.add('nl', {'id': 2222})
+        self.assertEqual(self.manager.get('nl').settings.getint('id'), 2222)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.dir, 'se', 'settings.ini')))
+        status = self.manager.status()
+        self.assertEqual(list(status['tunnels']), ['se', 'nl'])
+        self.assertEqual(status['states'], {'disconnected': 2})
+        self.assertEqual(status['tunnels']['se']['index'], 1)
+        self.assertEqual(status['tunnels']['nl']['index'], 2)
+        self.assertEqual(status['traffic']['rx_total'], 0)
+
+    def test_remove_frees_index(self):
+        self.manager.add('a')
+        self.manager.add('b')
+        self.manager.remove('a')
+        self.assertFalse(self.manager.get('b').finished())
+        self.assertEqual(self.manager.add('c').instance.index, 1)
+
+    def test_invalid_names(self):
+        self.manager.add('a')
+        self.assertRaises(ValueError, self.manager.add, 'a')
+        self.assertRaises(ValueError, self.manager.add, '../a')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from mullvad import util
+
+
+class TestWakeup(unittest.TestCase):
+    def setUp(self):
+        self.wakeup = util.Wakeup()
+
+    def test_timeout(self):
+        start = util.monotonic()
+        self.assertFalse(self.wakeup.wait(0.05))
+        self.assertGreaterEqual(util.monotonic() - start, 0.04)
+
+    def test_wake_before_wait_is_remembered_once(self):
+        self.wakeup.wake()
+        self.wakeup.wake()
+        self.assertTrue(self.wakeup.wait(0))
+        self.assertFalse(self.wakeup.wait(0))
+
+    def test_wake_from_other_thread(self):
+        timer = threading.Timer(0.05, self.wakeup.wake)
+        timer.start()
+        start = util.monotonic()
+        self.assertTrue(self.wakeup.wait(10))
+        self.assertLess(util.monotonic() - start, 5)
+        timer.join()
+
+    def test_many_wakes_do_not_block(self):
+        for __ in range(100000):
+            self.wakeup.wake()
+        self.assertTrue(self.wakeup.wait(0))
+
+    def test_event_fallback(self):
+        self.wakeup.close()
+        self.wakeup.event = threading.Event()  # As on Windows
+        self.wakeup.wake()
+        self.assertTrue(self.wakeup.wait(0))
+        self.assertFalse(self.wakeup.wait(0))
+        timer = threading.Timer(0.05, self.wakeup.wake)
+        timer.start()
+        self.assertTrue(self.wakeup.wait(10))
+        timer.join()
+
+    def test_wake_after_close_is_ignored(self):
+        self.wakeup.close()
+        self.wakeup.wake()
+
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestPeriodicScheduler(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.scheduler = util.PeriodicScheduler(clock=self.clock)
+        self.results = []
+
+    def task(self):
+        return self.results.pop(0) if self.results else None
+
+    def test_runs_on_the_interval(self):
+        self.scheduler.add('a', self.task, 30, delay=15)
+        self.assertEqual(self.scheduler.time_to_next(), 15)
+        self.assertEqual(self.scheduler.run_due(), {})
+        self.clock.now += 15
+        self.assertEqual(self.scheduler.run_due(), {'a': None})
+        self.clock.now += 2  # Woke up late, the next run is not delayed
+        self.assertEqual(self.scheduler.time_to_next(), 28)
+
+    def test_missed_deadline_is_not_caught_up(self):
+        self.scheduler.add('a', self.task, 30)
+        self.clock.now += 100
+        self.assertEqual(self.scheduler.run_due(), {'a': None})
+        self.assertEqual(self.scheduler.run_due(), {})
+        self.assertEqual(self.scheduler.time_to_next(), 30)
+        stats = self.scheduler.stats()['a']
+        self.assertEqual((stats['runs'], stats['missed']), (1, 1))
+        self.assertEqual(stats['max_late'], 70)
+
+    def test_backoff(self):
+        self.scheduler.add('a', self.task, 10, max_interval=25)
+        self.results = [False, False, True]
+        for interval in (20, 25, 10):
+            self.clock.now += self.scheduler.time_to_next()
+            self.scheduler.run_due()
+            self.assertEqual(self.scheduler.time_to_next(), interval)
+        self.assertEqual(self.scheduler.stats()['a']['failures'], 2)
+
+    def test_jitter(self):
+        self.scheduler.add('a', self.task, 100, jitter=0.1)
+        self.assertTrue(90 <= self.scheduler.time_to_next() <= 110)
+
+
+
+class TestResumeDetector(unittest.TestCase):
+    def test_suspend(self):
+        awake = FakeClock()
+        wall = FakeClock()
+        detector = util.ResumeDetector(10, clock=awake, wall_clock=wall)
+        awake.now += 5
+        wall.now += 5
+        self.assertEqual(detector.check(), 0)
+        awake.now += 5
+        wall.now += 305  # Slept for 300 s
+        self.assertEqual(detector.check(), 300)
+        self.assertEqual(detector.check(), 0)
+
+
+class TestWriteAtomically(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_replaces_content(self):
+        path = os.path.join(self.dir, 'servers.txt')
+        util.write_atomically(path, 'old\n')
+        util.write_atomically(path, 'new\n')
+        self.assertEqual(util.file_content(path), 'new\n')
+        self.assertEqual(os.listdir(self.dir), ['servers.txt'])
+
+
+if __name__ == '__main__':
+    unittest.main()